@@ -4,18 +4,21 @@ from helper import (
     int_to_little_endian,
     little_endian_to_int,
     read_varint,
+    read_varint_after,
     encode_varint,
     SIGHASH_ALL,
 )
 from io import BytesIO
 import json
 import requests
-from script import script
+from script import script, evaluate_spend
 from ecc import PrivateKey
 
 # Transaction class (version, inputs, outputs, locktime)
 class Tx:
     
+    __slots__ = ('version', 'tx_ins', 'tx_outs', 'locktime', 'testnet')
+    
     def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False):
         self.version = version
         self.tx_ins = tx_ins
@@ -43,33 +46,85 @@ class Tx:
         return hash256(self.serialize())[::-1]
     
     @classmethod
-    def parse(cls, s, testnet=False):
+    def parse(cls, s, testnet=False, keep_raw=False):
+        '''
+        keep_raw : scripts keep their raw bytes instead of cmds (compact)
+        Reads the legacy and the segwit (BIP144) serialization. The witness of
+        every input is kept in TxInput.witness but not verified : witness
+        programs are evaluated as by a node without segwit
+        '''
         version = little_endian_to_int(s.read(4))
         
-        n_inputs = read_varint(s)
+        # segwit marker (0x00, never a legacy input count) and flag, else the
+        # first byte of the input count (no seek, sockets cannot)
+        first = s.read(1)[0]
+        segwit = first == 0
+        if segwit:
+            flag = s.read(1)
+            if flag != b'\x01':
+                raise RuntimeError(f'unknown segwit flag {flag.hex()}')
+            n_inputs = read_varint(s)
+        else:
+            n_inputs = read_varint_after(s, first)
         inputs = []
         for _ in range(n_inputs):
-            inputs.append(TxInput.parse(s))
+            inputs.append(TxInput.parse(s, keep_raw=keep_raw))
         
         n_outputs = read_varint(s)
         outputs = []
         for _ in range(n_outputs):
-            outputs.append(TxOutput.parse(s))
+            outputs.append(TxOutput.parse(s, keep_raw=keep_raw))
+        
+        if segwit:
+            for tx_in in inputs:
+                tx_in.witness = [s.read(read_varint(s)) for _ in range(read_varint(s))]
             
         locktime = little_endian_to_int(s.read(4))
         return cls(version, inputs, outputs, locktime, testnet=testnet)
+    
+    def is_segwit(self):
+        '''True if any input has a witness'''
+        return any(tx_in.witness for tx_in in self.tx_ins)
         
     def serialize(self):
-        '''Returns the byte serialize of the Tx'''
-        result = int_to_little_endian(self.version, 4)
-        result += encode_varint(len(self.tx_ins))
+        '''Returns the byte serialize of the Tx (legacy, without witness, as hashed for the txid)'''
+        result = [int_to_little_endian(self.version, 4)]
+        result.append(encode_varint(len(self.tx_ins)))
         for tx_in in self.tx_ins:
-            result += tx_in.serialize()
-        result += encode_varint(len(self.tx_outs))
+            tx_in.serialize_into(result)
+        result.append(encode_varint(len(self.tx_outs)))
         for tx_out in self.tx_outs:
-            result += tx_out.serialize()
-        result += int_to_little_endian(self.locktime, 4)
-        return result
+            tx_out.serialize_into(result)
+        result.append(int_to_little_endian(self.locktime, 4))
+        # parts (raw scripts included) are copied once here
+        return b''.join(result)
+    
+    def serialize_segwit(self):
+        '''Serialization with the witness (BIP144) if any input has one, else the legacy one'''
+        if not self.is_segwit():
+            return self.serialize()
+        result = [int_to_little_endian(self.version, 4), b'\x00\x01']
+        result.append(encode_varint(len(self.tx_ins)))
+        for tx_in in self.tx_ins:
+            tx_in.serialize_into(result)
+        result.append(encode_varint(len(self.tx_outs)))
+        for tx_out in self.tx_outs:
+            tx_out.serialize_into(result)
+        for tx_in in self.tx_ins:
+            witness = tx_in.witness or []
+            result.append(encode_varint(len(witness)))
+            for item in witness:
+                result.append(encode_varint(len(item)))
+                result.append(item)
+        result.append(int_to_little_endian(self.locktime, 4))
+        return b''.join(result)
+    
+    def vsize(self):
+        '''virtual size (BIP141) : weight / 4 rounded up, the serialized size of a legacy tx'''
+        base = len(self.serialize())
+        if not self.is_segwit():
+            return base
+        return (base * 3 + len(self.serialize_segwit()) + 3) // 4
     
     def fee(self, testnet=False):
         '''Calculate fee'''
@@ -90,38 +145,44 @@ class Tx:
         for idx, tx_in in enumerate(self.tx_ins):
             if idx == input_index:
                 if redeem_script:
-                    tx_in.script_sig = redeem_script
+                    script_sig = redeem_script
                 else:
-                    tx_in.script_sig = tx_in.get_script_lock(self.testnet)
+                    script_sig = tx_in.get_script_lock(self.testnet)
             else:
-                tx_in.script_sig = None
-            result += TxInput(tx_in.prev_tx, tx_in.prev_index, tx_in.script_sig, tx_in.sequence).serialize()
+                script_sig = None
+            result += TxInput(tx_in.prev_tx, tx_in.prev_index, script_sig, tx_in.sequence).serialize()
         result += encode_varint(len(self.tx_outs))
-        for tx_out in enumerate(self.tx_outs):
+        for tx_out in self.tx_outs:
             result += tx_out.serialize()
-        result += int_to_little_endial(self.locktime, 4)
-        result += int_to_little_endial(SIGHASH_ALL, 4)
+        result += int_to_little_endian(self.locktime, 4)
+        result += int_to_little_endian(SIGHASH_ALL, 4)
         h256 = hash256(result)
         return int.from_bytes(h256, 'big')
     
-    def verify_input(self, input_index):
+    def verify_input(self, input_index, utxos=None):
+        '''
+        utxos : mapping (prev_tx, prev_index) -> TxOutput of the spent outputs,
+        if None they are fetched. False if the spent output is not in utxos
+        '''
         tx_in = self.tx_ins[input_index]
-        script_lock = tx_in.get_script_lock(testnet=self.testnet)
-        if script_lock.is_p2sh_script_pubkey():
+        tx_out = tx_in.prevout(testnet=self.testnet, utxos=utxos)
+        if tx_out is None:
+            return False
+        script_lock = tx_out.script_lock
+        if script_lock.is_p2sh_script_lock():
             cmd = tx_in.script_sig.cmds[-1] # last element in script_sig of p2sh is redeem script
             redeem_for_parsing = encode_varint(len(cmd)) + cmd # for parsing
             redeem_script = script.parse(BytesIO(redeem_for_parsing))
         else:
-            redeem_script = None
+            redeem_script = script_lock # what sig_hash would look up again
         z = self.sig_hash(input_index, redeem_script)
-        combined_script = tx_in.script_sig + script_lock
-        return combined_script.evalutate(z)
+        return evaluate_spend(tx_in.script_sig, script_lock, z)
         
     def sign_input(self, input_index, private_key):
         # added for signing p2sh script
         tx_in = self.tx_ins[input_index]
         script_lock = tx_in.get_script_lock(testnet=self.testnet)
-        if script_lock.is_p2sh_script_pubkey():
+        if script_lock.is_p2sh_script_lock():
             cmd = tx_in.script_sig.cmds[-1] # last element in script_sig of p2sh is redeem script
             redeem_for_parsing = encode_varint(len(cmd)) + cmd # for parsing
             redeem_script = script.parse(BytesIO(redeem_for_parsing))
@@ -131,7 +192,7 @@ class Tx:
         der = private_key.sign(z).der()
         sig = der + SIGHASH_ALL.to_bytes(1, 'big')
         sec = private_key.pubPoint.sec()
-        script_sig = Script([sig, sec])
+        script_sig = script([sig, sec])
         self.tx_ins[input_index].script_sig = script_sig
         return self.verify_input(input_index)
     
@@ -144,8 +205,13 @@ class Tx:
         '''
         if self.fee() < 0:
             return False
+        return self.verify_scripts()
+    
+    def verify_scripts(self, utxos=None):
+        '''Verify the script (signature) of every input, without the fee check
+        utxos : spent outputs as in verify_input'''
         for i in range(len(self.tx_ins)):
-            if not self.verify_input(i):
+            if not self.verify_input(i, utxos):
                 return False
         return True
     
@@ -162,7 +228,10 @@ class Tx:
 # Transaction input class        
 class TxInput:
     
-    def __init__(self, prev_tx, prev_index, script_sig=None, sequence=0xffffffff):
+    # witness : stack items (bytes) of a segwit input, None without witness
+    __slots__ = ('prev_tx', 'prev_index', 'script_sig', 'sequence', 'witness')
+    
+    def __init__(self, prev_tx, prev_index, script_sig=None, sequence=0xffffffff, witness=None):
         self.prev_tx = prev_tx
         self.prev_index = prev_index
         if script_sig is None:
@@ -170,44 +239,59 @@ class TxInput:
         else:
             self.script_sig = script_sig
         self.sequence = sequence
+        self.witness = witness
         
     def __repr__(self):
         return f'{self.prev_tx.hex()}:{self.prev_index}'
         
     @classmethod
-    def parse(cls, s):
+    def parse(cls, s, keep_raw=False):
 #         prev_tx = little_endian_to_int(s.read(32)) # need to check
         prev_tx = s.read(32)[::-1] # in bytes?
         prev_index = little_endian_to_int(s.read(4))
 #         len_script_sig = read_varint(s)
 #         script_sig = little_endian_to_int(s.read(len_script_sig))
-        script_sig = script.parse(s)
+        script_sig = script.parse(s, keep_raw=keep_raw)
         sequence = little_endian_to_int(s.read(4))
         return cls(prev_tx, prev_index, script_sig, sequence)
     
     def serialize(self):
         '''Returns the byte of serialization of Tx input'''
-        result = self.prev_tx[::-1]
-        result += int_to_little_endian(self.prev_index, 4)
-        result += self.script_sig.serialize()
-        result += int_to_little_endian(self.sequence, 4)
-        return result
+        result = []
+        self.serialize_into(result)
+        return b''.join(result)
+    
+    def serialize_into(self, result):
+        result.append(self.prev_tx[::-1])
+        result.append(int_to_little_endian(self.prev_index, 4))
+        self.script_sig.serialize_into(result)
+        result.append(int_to_little_endian(self.sequence, 4))
     
     def fetch_tx(self, testnet=False):
         return TxFetcher.fetch(self.prev_tx.hex(), testnet)
     
-    def value(self, testnet=False):
+    def prevout(self, testnet=False, utxos=None):
+        '''
+        TxOutput this input spends, from utxos ((prev_tx, prev_index) -> TxOutput,
+        None if absent) when given, else fetched
+        '''
+        if utxos is not None:
+            return utxos.get((self.prev_tx, self.prev_index))
         tx = self.fetch_tx(testnet=testnet)
-        return tx.tx_outs[self.prev_index].amount
+        return tx.tx_outs[self.prev_index]
+    
+    def value(self, testnet=False):
+        return self.prevout(testnet=testnet).amount
     
     def get_script_lock(self, testnet=False):
-        tx = self.fetch_tx(testnet=testnet)
-        return tx.tx_outs[self.prev_index].script_lock
+        return self.prevout(testnet=testnet).script_lock
     
     
 # Transacrion output class
 class TxOutput:
     
+    __slots__ = ('amount', 'script_lock')
+    
     def __init__(self, amount, script_lock):
         self.amount = amount
         self.script_lock = script_lock
@@ -216,16 +300,20 @@ class TxOutput:
         return f'{self.amount}(in satosi):{self.script_lock}'
     
     @classmethod
-    def parse(cls, s):
+    def parse(cls, s, keep_raw=False):
         amount = little_endian_to_int(s.read(8))
-        script_lock = script.parse(s)
+        script_lock = script.parse(s, keep_raw=keep_raw)
         return cls(amount, script_lock)
     
     def serialize(self):
         '''Returns the byte serialization of the Tx output'''
-        result = int_to_little_endian(self.amount, 8)
-        result += self.script_lock.serialize() # script class?
-        return result
+        result = []
+        self.serialize_into(result)
+        return b''.join(result)
+    
+    def serialize_into(self, result):
+        result.append(int_to_little_endian(self.amount, 8))
+        self.script_lock.serialize_into(result) # script class?
     
 # Tx Fetcher class
 class TxFetcher:
@@ -248,12 +336,7 @@ class TxFetcher:
                 raw = bytes.fromhex(response.text.strip())
             except ValueError:
                 raise ValueError(f'unexpected response :{response.text}')
-            if raw[4] == 0: # raw[4] == 0 은 어떤 케이스?
-                raw = raw[:4] + raw[6:]
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
-                tx.locktime = little_endian_to_int(raw[-4:])
-            else:
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
+            tx = Tx.parse(BytesIO(raw), testnet=testnet) # segwit txs included
             if tx.id() != tx_id:
                 raise ValueError(f'not the same id: {tx.id()} vs {tx_id}')
                 
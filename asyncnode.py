@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Peer-to-peer node on asyncio streams, talking to many peers from one process
+# Every peer has a read task (frame envelopes and dispatch them) and a write
+# task fed by a bounded send queue: send() waits when the queue is full, and
+# the write task waits on drain(), so a slow peer slows down its senders only.
+# Replies of the read task (verack, pong) never wait on the queue, see Peer.reply.
+
+import asyncio
+import time
+
+from random import randint
+
+from network import (
+    MAINNET_NETWORK_MAGIC,
+    MESSAGE_CLASSES,
+    TESTNET_NETWORK_MAGIC,
+    EnvelopeFramer,
+    NetworkEnvelope,
+    PingMessage,
+    PongMessage,
+    VerAckMessage,
+    VersionMessage,
+)
+
+DEFAULT_SEND_QUEUE_SIZE = 100 # serialized envelopes waiting per peer
+DEFAULT_CONNECT_CONCURRENCY = 16
+HANDSHAKE_TIMEOUT = 30
+READ_CHUNK_SIZE = 256 * 1024
+CHECKSUM_OFFLOAD_SIZE = 1024 * 1024 # payloads above this are checksummed in a thread
+
+
+class Peer:
+
+    def __init__(self, node, reader, writer):
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        # several connections can go to the same address, the local end tells them apart
+        self.key = (writer.get_extra_info('sockname'), self.address)
+        self.send_queue = asyncio.Queue(node.send_queue_size)
+        self.replies = [] # serialized replies waiting for room in the send queue
+        self.reply_task = None
+        self.waiters = {} # command -> futures resolved with the next envelope of that command
+        self.version = None # envelope of the peer's version message
+        self.version_sent = False
+        self.version_received = asyncio.Event()
+        self.verack_received = asyncio.Event()
+        self.closed = False
+        self.error = None # exception that closed the connection
+        self.dropped = 0 # envelopes whose handling raised
+        self.tasks = [asyncio.create_task(self.read_loop()), asyncio.create_task(self.write_loop())]
+
+    def __repr__(self):
+        host, port = self.address[:2] if self.address else ('?', '?')
+        return f'Peer({host}:{port})'
+
+    @property
+    def ready(self):
+        '''handshake done both ways'''
+        return self.version_received.is_set() and self.verack_received.is_set() and not self.closed
+
+    def frame(self, message):
+        envelope = NetworkEnvelope(message.command, message.serialize(), testnet=self.node.testnet)
+        if self.node.logging:
+            print(f'sending to {self}: {envelope}')
+        return envelope.serialize()
+
+    async def send(self, message):
+        '''queues message, waits while the peer's send queue is full'''
+        if self.closed:
+            raise ConnectionError(f'{self} is closed')
+        await self.send_queue.put(self.frame(message))
+
+    def reply(self, *messages):
+        '''
+        queues messages without waiting : used by the read loop (version, verack, pong)
+        so that two peers with full send queues do not stall each other's reads.
+        When the queue is full they wait in a task, in order
+        '''
+        if self.closed:
+            return
+        self.replies.extend(self.frame(message) for message in messages)
+        if self.reply_task is not None and not self.reply_task.done():
+            return
+        while self.replies and not self.send_queue.full():
+            self.send_queue.put_nowait(self.replies.pop(0))
+        if self.replies:
+            self.reply_task = asyncio.create_task(self.flush_replies())
+
+    async def flush_replies(self):
+        while self.replies:
+            await self.send_queue.put(self.replies.pop(0))
+
+    async def write_loop(self):
+        try:
+            while True:
+                data = await self.send_queue.get()
+                self.writer.write(data)
+                await self.writer.drain()
+        except Exception as e:
+            self.close(e)
+
+    async def read_loop(self):
+        framer = EnvelopeFramer(self.node.testnet, checksum_limit=CHECKSUM_OFFLOAD_SIZE)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await self.reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    raise ConnectionError('connection closed by peer')
+                for envelope in framer.feed(data):
+                    # big payloads are hashed in a thread, the other peers keep going
+                    if envelope.checksum is not None and \
+                        not await loop.run_in_executor(None, envelope.verify_checksum):
+                        continue
+                    if self.node.logging:
+                        print(f'receiving from {self}: {envelope}')
+                    try:
+                        await self.dispatch(envelope)
+                    except ConnectionError:
+                        raise
+                    except Exception as e:
+                        # a failing handler or a malformed payload drops this envelope only
+                        self.dropped += 1
+                        if self.node.logging:
+                            print(f'dropped {envelope.command} from {self}: {e!r}')
+        except Exception as e:
+            self.close(e)
+
+    async def dispatch(self, envelope):
+        command = envelope.command
+        if command == VersionMessage.command:
+            self.version = envelope
+            self.version_received.set()
+            if not self.version_sent: # inbound connection
+                self.version_sent = True
+                self.reply(self.node.version_message(), VerAckMessage())
+            else:
+                self.reply(VerAckMessage())
+        elif command == VerAckMessage.command:
+            self.verack_received.set()
+        elif command == PingMessage.command:
+            self.reply(PongMessage(envelope.payload))
+        for future in self.waiters.pop(command, []):
+            if not future.done():
+                future.set_result(envelope)
+        for handler in self.node.handlers.get(command, []):
+            result = handler(self, envelope)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def expect(self, *commands):
+        '''future resolved with the next envelope of any of commands (register before sending the request)'''
+        future = asyncio.get_running_loop().create_future()
+        for command in commands:
+            self.waiters.setdefault(command, []).append(future)
+        return future
+
+    async def wait_for(self, *message_classes, timeout=None, future=None):
+        '''next message of one of message_classes, parsed'''
+        command_to_class = {m.command: m for m in message_classes}
+        if future is None:
+            future = self.expect(*command_to_class)
+        try:
+            envelope = await asyncio.wait_for(future, timeout)
+        finally:
+            for command in command_to_class:
+                futures = self.waiters.get(command)
+                if futures and future in futures:
+                    futures.remove(future)
+        message_class = command_to_class[envelope.command]
+        if MESSAGE_CLASSES.get(envelope.command) is message_class:
+            return envelope.message() # parsed once even if handlers ask for it too
+        return message_class.parse(envelope.stream())
+
+    async def handshake(self, timeout=HANDSHAKE_TIMEOUT):
+        self.version_sent = True
+        await self.send(self.node.version_message())
+        await asyncio.wait_for(asyncio.gather(self.version_received.wait(),
+                                              self.verack_received.wait()), timeout)
+
+    async def ping(self, timeout=None):
+        '''round trip time in seconds'''
+        nonce = randint(0, 2**64 - 1).to_bytes(8, 'little')
+        future = self.expect(PongMessage.command)
+        start = time.perf_counter()
+        await self.send(PingMessage(nonce))
+        while True:
+            envelope = await asyncio.wait_for(future, timeout)
+            if envelope.payload == nonce:
+                return time.perf_counter() - start
+            future = self.expect(PongMessage.command)
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.error = error
+        current = asyncio.current_task()
+        for task in self.tasks + [self.reply_task]:
+            if task is not None and task is not current:
+                task.cancel()
+        self.writer.close()
+        for futures in self.waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ConnectionError(f'{self} closed: {error}'))
+        self.waiters = {}
+        self.node.peers.pop(self.key, None)
+        if self.node.logging:
+            print(f'{self} closed: {error}')
+
+
+class AsyncNode:
+
+    def __init__(self, testnet=False, logging=False, send_queue_size=DEFAULT_SEND_QUEUE_SIZE):
+        self.testnet = testnet
+        self.logging = logging
+        self.send_queue_size = send_queue_size
+        self.magic = TESTNET_NETWORK_MAGIC if testnet else MAINNET_NETWORK_MAGIC
+        self.peers = {} # (local address, peer address) -> Peer
+        self.handlers = {} # command -> callables (peer, envelope), may be coroutines, envelope.message() parses
+        self.server = None
+
+    def __repr__(self):
+        return f'AsyncNode : {len(self.peers)} peers'
+
+    def version_message(self):
+        return VersionMessage()
+
+    def on(self, command, handler):
+        '''calls handler(peer, envelope) for every envelope of command'''
+        self.handlers.setdefault(command, []).append(handler)
+
+    def add_peer(self, reader, writer):
+        peer = Peer(self, reader, writer)
+        self.peers[peer.key] = peer
+        return peer
+
+    async def connect(self, host, port=None, timeout=HANDSHAKE_TIMEOUT):
+        '''connects and handshakes, returns the Peer'''
+        if port is None:
+            port = 18333 if self.testnet else 8333
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        peer = self.add_peer(reader, writer)
+        try:
+            await peer.handshake(timeout)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            peer.close(e)
+            raise
+        return peer
+
+    async def connect_many(self, addresses, concurrency=DEFAULT_CONNECT_CONCURRENCY,
+                           timeout=HANDSHAKE_TIMEOUT):
+        '''connects to (host, port) addresses, at most concurrency at a time, None for failures'''
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def connect_one(host, port):
+            async with semaphore:
+                try:
+                    return await self.connect(host, port, timeout)
+                except (OSError, asyncio.TimeoutError, ConnectionError):
+                    return None
+
+        return await asyncio.gather(*(connect_one(host, port) for host, port in addresses))
+
+    async def serve(self, host='127.0.0.1', port=0):
+        '''accepts inbound peers (they handshake on their version), returns the listening port'''
+        self.server = await asyncio.start_server(self.add_peer, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def ready_peers(self):
+        return [peer for peer in self.peers.values() if peer.ready]
+
+    async def broadcast(self, message):
+        peers = self.ready_peers()
+        await asyncio.gather(*(peer.send(message) for peer in peers), return_exceptions=True)
+        return len(peers)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        peers = list(self.peers.values())
+        for peer in peers:
+            peer.close()
+        await asyncio.gather(*(task for peer in peers for task in peer.tasks), return_exceptions=True)
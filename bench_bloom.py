@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# False positive rate and throughput of BloomFilter.optimal filters
+# usage : python bench_bloom.py [number of elements] [number of probes]
+
+import os
+import sys
+import time
+
+from bloomfilter import BloomFilter
+
+FP_RATES = (0.1, 0.01, 0.001, 0.0001)
+
+
+def measure(element_count, fp_rate, probe_count):
+    '''returns (filter, empirical fp rate, adds/s, contains/s)'''
+    bloom_filter = BloomFilter.optimal(element_count, fp_rate, tweak=0)
+    elements = [os.urandom(32) for _ in range(element_count)]
+    probes = [os.urandom(32) for _ in range(probe_count)]
+    start = time.perf_counter()
+    for element in elements:
+        bloom_filter.add(element)
+    add_time = time.perf_counter() - start
+    start = time.perf_counter()
+    false_positives = sum(1 for probe in probes if bloom_filter.contains(probe))
+    contains_time = time.perf_counter() - start
+    return bloom_filter, false_positives / probe_count, element_count / add_time, probe_count / contains_time
+
+
+if __name__ == '__main__':
+    element_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    probe_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    print(f'{element_count} elements, {probe_count} probes')
+    print('target     size  funcs  expected   measured   add/s      contains/s')
+    for fp_rate in FP_RATES:
+        bloom_filter, measured, add_rate, contains_rate = measure(element_count, fp_rate, probe_count)
+        print(f'{fp_rate:<8}  {bloom_filter.size:>6}  {bloom_filter.function_count:>5}'
+              f'  {bloom_filter.expected_fp_rate(element_count):.6f}   {measured:.6f}'
+              f'   {add_rate:>8.0f}   {contains_rate:>8.0f}')
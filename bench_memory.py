@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Memory footprint of parsed transactions (per Tx)
+# before : the plain classes (per-instance __dict__, cmds list) the objects used to be
+# after : the __slots__ classes, with parsed cmds or with keep_raw
+# usage : python bench_memory.py [number of txs]
+
+import sys
+import tracemalloc
+
+from io import BytesIO
+
+from Tx import Tx, TxInput, TxOutput
+from script import script, get_p2pkh_script_lock
+
+
+def sample_tx_bytes():
+    # typical 2-in 2-out p2pkh tx (72 byte sig + 33 byte sec per input)
+    tx_ins = []
+    for i in range(2):
+        script_sig = script([b'\x30' * 71 + b'\x01', b'\x02' + bytes([i]) * 32])
+        tx_ins.append(TxInput(bytes([i + 1]) * 32, i, script_sig))
+    tx_outs = [
+        TxOutput(50000, get_p2pkh_script_lock(b'\x11' * 20)),
+        TxOutput(12345, get_p2pkh_script_lock(b'\x22' * 20)),
+    ]
+    return Tx(1, tx_ins, tx_outs, 0).serialize()
+
+
+# the layout before __slots__ : same attributes, in a __dict__
+class DictTx:
+
+    def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False):
+        self.version = version
+        self.tx_ins = tx_ins
+        self.tx_outs = tx_outs
+        self.locktime = locktime
+        self.testnet = testnet
+
+
+class DictTxInput:
+
+    def __init__(self, prev_tx, prev_index, script_sig, sequence):
+        self.prev_tx = prev_tx
+        self.prev_index = prev_index
+        self.script_sig = script_sig
+        self.sequence = sequence
+
+
+class DictTxOutput:
+
+    def __init__(self, amount, script_lock):
+        self.amount = amount
+        self.script_lock = script_lock
+
+
+class DictScript:
+
+    def __init__(self, cmds):
+        self.cmds = cmds
+
+
+def parse_dict_layout(s):
+    '''parses a tx into the dict-based classes (the parsed cmds are a list of pushes)'''
+    tx = Tx.parse(s)
+    tx_ins = [DictTxInput(tx_in.prev_tx, tx_in.prev_index, DictScript(list(tx_in.script_sig.cmds)), tx_in.sequence)
+              for tx_in in tx.tx_ins]
+    tx_outs = [DictTxOutput(tx_out.amount, DictScript(list(tx_out.script_lock.cmds)))
+               for tx_out in tx.tx_outs]
+    return DictTx(tx.version, tx_ins, tx_outs, tx.locktime, tx.testnet)
+
+
+def parse_slots(s):
+    return Tx.parse(s)
+
+
+def parse_slots_raw(s):
+    return Tx.parse(s, keep_raw=True)
+
+
+def measure(raw, count, parse):
+    '''returns bytes allocated per tx kept by parse(stream)'''
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    txs = [parse(BytesIO(raw)) for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del txs
+    return total / count
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    raw = sample_tx_bytes()
+    print(f'serialized size : {len(raw)} bytes')
+    print(f'before (__dict__)    : {measure(raw, count, parse_dict_layout):.0f} bytes/tx')
+    print(f'__slots__, cmds      : {measure(raw, count, parse_slots):.0f} bytes/tx')
+    print(f'__slots__, keep_raw  : {measure(raw, count, parse_slots_raw):.0f} bytes/tx')
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Reader for Bitcoin Core blk*.dat files
+# Files are memory-mapped and walked by their framing (network magic + 4 byte
+# size + block). Blocks are handed out as memoryviews into the map, and an
+# index of block hash -> (file number, offset, size) is persisted to disk.
+
+import mmap
+import os
+import re
+
+from block import Block
+from helper import (
+    BufferReader,
+    hash256,
+    int_to_little_endian,
+    little_endian_to_int,
+)
+from network import MAINNET_NETWORK_MAGIC, TESTNET_NETWORK_MAGIC
+
+BLK_FILE_PATTERN = re.compile(r'^blk(\d{5})\.dat$')
+INDEX_RECORD_SIZE = 44 # block hash (32) + file number (4) + offset (4) + size (4)
+
+
+def iter_framed_blocks(b, magic=MAINNET_NETWORK_MAGIC, offset=0):
+    '''(offset, size) of the blocks in blk*.dat framing (magic + 4 byte size + block)'''
+    end = len(b)
+    while offset + 8 <= end:
+        if b[offset:offset + 4] != magic:
+            break # zero padding at the end of the file
+        size = little_endian_to_int(b[offset + 4:offset + 8])
+        if offset + 8 + size > end: # block still being written
+            break
+        yield offset + 8, size
+        offset += 8 + size
+
+
+class BlockFileReader:
+
+    def __init__(self, directory, testnet=False, index_path=None):
+        '''index_path : where the block index is kept, default blkindex.dat in directory'''
+        self.directory = directory
+        self.magic = TESTNET_NETWORK_MAGIC if testnet else MAINNET_NETWORK_MAGIC
+        if index_path is None:
+            index_path = os.path.join(directory, 'blkindex.dat')
+        self.index_path = index_path
+        xor_path = os.path.join(directory, 'xor.dat')
+        if os.path.exists(xor_path):
+            with open(xor_path, 'rb') as f:
+                if any(f.read()):
+                    raise RuntimeError('blk files are obfuscated (xor.dat), start bitcoind with -blocksxor=0')
+        self.maps = {} # file number -> (file, mmap)
+        self.index = {} # block hash -> (file number, offset, size)
+        self.indexed_until = {} # file number -> end offset of the last indexed block
+        self.load_index()
+
+    def __repr__(self):
+        return f'BlockFileReader({self.directory}) : {len(self.index)} blocks indexed'
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for file_number in list(self.maps):
+            self.remap(file_number)
+
+    def file_numbers(self):
+        result = []
+        for name in os.listdir(self.directory):
+            match = BLK_FILE_PATTERN.match(name)
+            if match:
+                result.append(int(match.group(1)))
+        return sorted(result)
+
+    def path(self, file_number):
+        return os.path.join(self.directory, f'blk{file_number:05d}.dat')
+
+    def view(self, file_number):
+        '''memoryview of a whole blk file (mapped once, read only)'''
+        if file_number not in self.maps:
+            f = open(self.path(file_number), 'rb')
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[file_number] = (f, m)
+        return memoryview(self.maps[file_number][1])
+
+    def remap(self, file_number):
+        '''drop the map of a file that grew since it was mapped'''
+        entry = self.maps.pop(file_number, None)
+        if entry is None:
+            return
+        f, m = entry
+        try:
+            m.close()
+        except BufferError:
+            pass # blocks handed out still point into the map, it is unmapped with the last of them
+        f.close()
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        for i in range(0, len(data) - INDEX_RECORD_SIZE + 1, INDEX_RECORD_SIZE):
+            record = data[i:i + INDEX_RECORD_SIZE]
+            file_number = little_endian_to_int(record[32:36])
+            offset = little_endian_to_int(record[36:40])
+            size = little_endian_to_int(record[40:44])
+            self.index[record[:32]] = (file_number, offset, size)
+            if offset + size > self.indexed_until.get(file_number, 0):
+                self.indexed_until[file_number] = offset + size
+
+    def build_index(self):
+        '''indexes blocks not indexed yet (new files or appended blocks), returns how many'''
+        added = 0
+        with open(self.index_path, 'ab') as index_file:
+            for file_number in self.file_numbers():
+                start = self.indexed_until.get(file_number, 0)
+                if os.path.getsize(self.path(file_number)) <= start:
+                    continue
+                self.remap(file_number)
+                view = self.view(file_number)
+                records = []
+                for offset, size in iter_framed_blocks(view, self.magic, start):
+                    block_hash = hash256(view[offset:offset + 80])[::-1]
+                    self.index[block_hash] = (file_number, offset, size)
+                    self.indexed_until[file_number] = offset + size
+                    records.append(block_hash + int_to_little_endian(file_number, 4)
+                                   + int_to_little_endian(offset, 4) + int_to_little_endian(size, 4))
+                view.release()
+                index_file.write(b''.join(records))
+                added += len(records)
+        return added
+
+    def get(self, block_hash):
+        '''memoryview of the serialized block, None if not indexed'''
+        location = self.index.get(block_hash)
+        if location is None:
+            return None
+        file_number, offset, size = location
+        return self.view(file_number)[offset:offset + size]
+
+    def block(self, block_hash, include_txs=True):
+        '''
+        Block parsed from the file without copying, scripts keep views into the map
+        (witnesses of segwit txs are copied)
+        '''
+        view = self.get(block_hash)
+        if view is None:
+            return None
+        return Block.parse(BufferReader(view), include_txs=include_txs, keep_raw=True)
+
+    def header(self, block_hash):
+        return self.block(block_hash, include_txs=False)
+
+    def iter_blocks(self, file_numbers=None):
+        '''yields (block hash, memoryview) of every block in file order, lazily'''
+        if file_numbers is None:
+            file_numbers = self.file_numbers()
+        for file_number in file_numbers:
+            view = self.view(file_number)
+            for offset, size in iter_framed_blocks(view, self.magic):
+                block = view[offset:offset + size]
+                yield hash256(block[:80])[::-1], block
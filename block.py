@@ -4,7 +4,16 @@
 # In[1]:
 
 
-from helper import hash256, bits_to_target, little_endian_to_int, int_to_little_endian
+from helper import (
+    hash256,
+    bits_to_target,
+    bits_to_work,
+    little_endian_to_int,
+    int_to_little_endian,
+    merkle_root,
+    read_varint,
+    encode_varint,)
+from Tx import Tx
 
 GENESIS_BLOCK = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c')
 TESTNET_GENESIS_BLOCK = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae18')
@@ -12,7 +21,9 @@ LOWEST_BITS = bytes.fromhex('ffff001d')
 
 class Block:
     
-    def __init__(self, version, prev_block_hash, merkle_root, timestamp, bits, nonce, tx_hashes=None):
+    __slots__ = ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce', 'tx_hashes', 'txs')
+    
+    def __init__(self, version, prev_block_hash, merkle_root, timestamp, bits, nonce, tx_hashes=None, txs=None):
         self.version = version
         self.prev_block_hash = prev_block_hash
         self.merkle_root = merkle_root
@@ -20,16 +31,40 @@ class Block:
         self.bits = bits
         self.nonce = nonce
         self.tx_hashes = tx_hashes
+        self.txs = txs
         
     @classmethod
-    def parse(cls, s):
+    def parse(cls, s, include_txs=False, testnet=False, keep_raw=False):
+        '''Parses the 80 byte header, and the tx list after it if include_txs'''
         version = little_endian_to_int(s.read(4))
         prev_block_hash = s.read(32)[::-1]
         merkle_root = s.read(32)[::-1]
         timestamp = little_endian_to_int(s.read(4))
         bits = s.read(4)
         nonce = s.read(4)
-        return cls(version, prev_block_hash, merkle_root, timestamp, bits, nonce)
+        block = cls(version, prev_block_hash, merkle_root, timestamp, bits, nonce)
+        if include_txs:
+            block.parse_txs(s, testnet=testnet, keep_raw=keep_raw)
+        return block
+    
+    def parse_txs(self, s, testnet=False, keep_raw=False):
+        '''Reads the tx list that follows the header and fills txs and tx_hashes'''
+        num_txs = read_varint(s)
+        txs = []
+        spans = []
+        for _ in range(num_txs):
+            start = s.tell()
+            txs.append(Tx.parse(s, testnet=testnet, keep_raw=keep_raw))
+            spans.append((start, s.tell()))
+        self.txs = txs
+        # hash every tx at once from the bytes we already read (no re-serialization),
+        # the txid of a segwit tx is the hash of its serialization without witness
+        if hasattr(s, 'getbuffer'):
+            with s.getbuffer() as buf:
+                self.tx_hashes = [tx.hash() if tx.is_segwit() else hash256(buf[start:end])[::-1]
+                                  for tx, (start, end) in zip(txs, spans)]
+        else:
+            self.tx_hashes = [tx.hash() for tx in txs]
     
     def serialize(self):
         result = int_to_little_endian(self.version, 4)
@@ -56,6 +91,9 @@ class Block:
     def target(self):
         return bits_to_target(self.bits)
     
+    def work(self):
+        return bits_to_work(self.bits)
+    
     def difficulty(self):
         lowest = 0xffff * 256 ** (0x1d - 3)
         return lowest / self.target()
@@ -68,4 +106,87 @@ class Block:
         hashes = [h[::-1] for h in self.tx_hashes]
         root = merkle_root(hashes)[::-1]
         return root == self.merkle_root
+    
+    def serialize_txs(self):
+        '''Returns the byte serialization of the tx list (after the header)'''
+        result = [encode_varint(len(self.txs))]
+        for tx in self.txs:
+            result.append(tx.serialize_segwit())
+        return b''.join(result)
+    
+    def check_coinbase(self, height=None):
+        '''The first tx must be the only coinbase (BIP34 height checked if given)'''
+        if not self.txs or not self.txs[0].is_coinbase():
+            return False
+        for tx in self.txs[1:]:
+            if tx.is_coinbase():
+                return False
+        if height is not None and self.txs[0].coinbase_height() != height:
+            return False
+        return True
+    
+    def spent_outputs(self, utxos):
+        '''
+        For every non-coinbase tx, the outputs its inputs spend : from utxos
+        (mapping (prev_tx, prev_index) -> TxOutput) or from earlier txs of the
+        block. Outputs found in neither are left out
+        '''
+        created = {}
+        result = []
+        for i, (tx, txid) in enumerate(zip(self.txs, self.tx_hashes)):
+            if i > 0: # the coinbase spends nothing
+                spent = {}
+                for tx_in in tx.tx_ins:
+                    outpoint = (tx_in.prev_tx, tx_in.prev_index)
+                    tx_out = created.get(outpoint)
+                    if tx_out is None:
+                        tx_out = utxos.get(outpoint)
+                    if tx_out is not None:
+                        spent[outpoint] = tx_out
+                result.append(spent)
+            for index, tx_out in enumerate(tx.tx_outs):
+                created[(txid, index)] = tx_out
+        return result
+
+    def verify_scripts(self, executor=None, utxos=None):
+        '''Verify every non-coinbase input.
+        executor : concurrent.futures executor (e.g. ProcessPoolExecutor) to spread the txs over
+        utxos : mapping (prev_tx, prev_index) -> TxOutput of the outputs spent by the block
+        (outputs of earlier txs of the block are found without it), if None they are fetched'''
+        txs = self.txs[1:]
+        if utxos is None:
+            spent = [None] * len(txs)
+        else:
+            # only what each tx spends goes to the workers
+            spent = self.spent_outputs(utxos)
+        if executor is None:
+            results = map(verify_tx_scripts, txs, spent)
+        else:
+            chunksize = max(1, len(txs) // 64)
+            results = executor.map(verify_tx_scripts, txs, spent, chunksize=chunksize)
+        return all(results)
+    
+    def validate(self, height=None, executor=None, utxos=None):
+        '''
+        Validate the full block in stages, cheapest first
+        1. proof of work
+        2. merkle root
+        3. coinbase
+        4. scripts (dispatched to executor if given), spent outputs from utxos
+           as in verify_scripts, fetched if None
+        '''
+        if self.txs is None:
+            raise RuntimeError('txs not parsed, use Block.parse(s, include_txs=True)')
+        if not self.check_pow():
+            return False
+        if not self.validate_merkle_root():
+            return False
+        if not self.check_coinbase(height):
+            return False
+        return self.verify_scripts(executor, utxos)
+
+
+def verify_tx_scripts(tx, utxos=None):
+    # module level so that it can be sent to worker processes
+    return tx.verify_scripts(utxos)
 
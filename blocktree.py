@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Tree of headers with cumulative chainwork, several tips and best chain selection
+# Every node keeps a skip pointer (as Bitcoin Core's CBlockIndex::pskip) so that
+# the ancestor at any height is found in O(log n) steps.
+
+from io import BytesIO
+
+from block import Block
+
+
+def invert_lowest_one(n):
+    return n & (n - 1)
+
+
+def get_skip_height(height):
+    '''height the skip pointer of a node at height points to'''
+    if height < 2:
+        return 0
+    # any number strictly lower than height works, this choice keeps
+    # ancestor lookups at O(log n) steps
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+
+class BlockNode:
+
+    __slots__ = ('hash', 'header', 'height', 'chainwork', 'parent', 'skip')
+
+    def __init__(self, block_hash, header, parent=None):
+        self.hash = block_hash
+        self.header = header
+        self.parent = parent
+        if parent is None:
+            self.height = 0
+            self.chainwork = header.work()
+            self.skip = None
+        else:
+            self.height = parent.height + 1
+            self.chainwork = parent.chainwork + header.work()
+            self.skip = parent.ancestor(get_skip_height(self.height))
+
+    def __repr__(self):
+        return f'BlockNode({self.hash.hex()}, height {self.height}, chainwork {self.chainwork:x})'
+
+    def ancestor(self, height):
+        '''node at height on the chain ending at this node, None if height is out of range'''
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        height_walk = self.height
+        while height_walk > height:
+            height_skip = get_skip_height(height_walk)
+            height_skip_prev = get_skip_height(height_walk - 1)
+            # take the skip pointer unless the parent's skip gets closer
+            if walk.skip is not None and (height_skip == height or (height_skip > height and
+                    not (height_skip_prev < height_skip - 2 and height_skip_prev >= height))):
+                walk = walk.skip
+                height_walk = height_skip
+            else:
+                walk = walk.parent
+                height_walk -= 1
+        return walk
+
+
+def last_common_ancestor(a, b):
+    '''
+    fork point of the chains ending at a and b, in O(log d * log n) steps for a
+    fork d blocks deep : heights d = 1, 2, 4, ... below the tips are probed until
+    the chains agree, then the fork is binary searched between the last two probes
+    '''
+    if a.height > b.height:
+        a = a.ancestor(b.height)
+    elif b.height > a.height:
+        b = b.ancestor(a.height)
+    if a is b:
+        return a
+    # a and b : the chains differ at their height
+    step = 1
+    while True:
+        low = max(a.height - step, 0)
+        a_low = a.ancestor(low)
+        if a_low is b.ancestor(low):
+            break
+        if low == 0: # different genesis
+            return None
+        a, b = a_low, b.ancestor(low)
+        step *= 2
+    # common at low, different at a.height
+    while a.height - low > 1:
+        middle = (low + a.height) // 2
+        a_middle = a.ancestor(middle)
+        b_middle = b.ancestor(middle)
+        if a_middle is b_middle:
+            low = middle
+            a_low = a_middle
+        else:
+            a, b = a_middle, b_middle
+    return a_low
+
+
+class BlockTree:
+
+    def __init__(self, genesis):
+        '''genesis : Block or 80 bytes header of height 0'''
+        genesis = self.to_block(genesis)
+        node = BlockNode(genesis.hash256(), genesis)
+        self.genesis = node
+        self.nodes = {node.hash: node}
+        self.tips = {node.hash: node}
+        self.best = node
+
+    def __repr__(self):
+        return f'BlockTree : {len(self.nodes)} headers, {len(self.tips)} tips, best {self.best}'
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.nodes
+
+    @staticmethod
+    def to_block(header):
+        if isinstance(header, Block):
+            return header
+        return Block.parse(BytesIO(bytes(header)))
+
+    def get(self, block_hash):
+        return self.nodes.get(block_hash)
+
+    def add(self, header):
+        '''
+        Adds a header whose parent is known, returns (node, reorg)
+        reorg is None if the best chain did not change, else (disconnected, connected)
+        as returned by reorg_path. Raises RuntimeError for orphans and bad proof of work
+        '''
+        header = self.to_block(header)
+        block_hash = header.hash256()
+        node = self.nodes.get(block_hash)
+        if node is not None:
+            return node, None
+        parent = self.nodes.get(header.prev_block_hash)
+        if parent is None:
+            raise RuntimeError(f'orphan header {block_hash.hex()}')
+        if not header.check_pow():
+            raise RuntimeError(f'{block_hash.hex()} does not meet its proof of work target')
+        node = BlockNode(block_hash, header, parent)
+        self.nodes[block_hash] = node
+        self.tips.pop(parent.hash, None)
+        self.tips[block_hash] = node
+        # first seen wins on equal work
+        if node.chainwork > self.best.chainwork:
+            reorg = self.reorg_path(self.best, node)
+            self.best = node
+            return node, reorg
+        return node, None
+
+    def reorg_path(self, old_tip, new_tip):
+        '''
+        (disconnected, connected) node lists to move from old_tip to new_tip
+        disconnected goes from old_tip down, connected from the fork point up
+        '''
+        fork = last_common_ancestor(old_tip, new_tip)
+        disconnected = []
+        node = old_tip
+        while node is not fork:
+            disconnected.append(node)
+            node = node.parent
+        connected = []
+        node = new_tip
+        while node is not fork:
+            connected.append(node)
+            node = node.parent
+        connected.reverse()
+        return disconnected, connected
+
+    def best_chain_at(self, height):
+        '''node of the best chain at height'''
+        return self.best.ancestor(height)
+
+    def in_best_chain(self, block_hash):
+        node = self.nodes.get(block_hash)
+        return node is not None and self.best.ancestor(node.height) is node
+
+    def prune_tips(self, max_depth):
+        '''forget tips (and their branch) more than max_depth below the best height'''
+        removed = 0
+        for tip in list(self.tips.values()):
+            if tip is self.best or self.best.height - tip.height <= max_depth:
+                continue
+            fork = last_common_ancestor(tip, self.best)
+            del self.tips[tip.hash]
+            node = tip
+            while node is not fork:
+                child_count = sum(1 for other in self.tips.values() if other.ancestor(node.height) is node)
+                if child_count:
+                    break
+                del self.nodes[node.hash]
+                removed += 1
+                node = node.parent
+        return removed
+
+    @classmethod
+    def from_store(cls, store):
+        '''tree of the best chain of a HeaderStore'''
+        tree = cls(store.raw(0))
+        parent = tree.genesis
+        for height in range(1, len(store)):
+            header = Block.parse(BytesIO(store.raw(height)))
+            node = BlockNode(store.block_hash(height), header, parent)
+            tree.nodes[node.hash] = node
+            parent = node
+        tree.tips = {parent.hash: parent}
+        tree.best = parent
+        return tree
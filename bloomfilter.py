@@ -4,38 +4,228 @@
 # In[2]:
 
 
+import math
+
+from random import randint
+
+from classifier import MULTISIG, P2PK, classify_raw
 from helper import (
-    bit_field_to_bytes,
+    bytes_to_bit_field,
     encode_varint,
     int_to_little_endian,
+    little_endian_to_int,
     murmur3,
+    read_varint_at,
 )
 from network import GenericMessage
 
 
 BIP37_CONSTANT = 0xfba4c795
+# filterload flags : which outpoints a match inserts into the filter
+BLOOM_UPDATE_NONE = 0
+BLOOM_UPDATE_ALL = 1
+BLOOM_UPDATE_P2PUBKEY_ONLY = 2
+# BIP37 limits
+MAX_BLOOM_FILTER_SIZE = 36000 # bytes
+MAX_HASH_FUNCS = 50
+
+
+def script_pushes(raw):
+    '''data pushes of a raw script, stops at the first truncated push (as Bitcoin Core's GetOp)'''
+    result = []
+    i = 0
+    end = len(raw)
+    while i < end:
+        op = raw[i]
+        i += 1
+        if op > 78 or op == 0:
+            continue
+        if op <= 75:
+            length = op
+        else:
+            size = 1 if op == 76 else 2 if op == 77 else 4
+            if i + size > end:
+                break
+            length = little_endian_to_int(raw[i:i + size])
+            i += size
+        if i + length > end:
+            break
+        result.append(raw[i:i + length])
+        i += length
+    return result
+
+
+def raw_script(s):
+    return s.raw if s.raw is not None else s.raw_serialize()
+
+
+class TxItems:
+    '''
+    Everything of a tx a BIP37 filter is tested against, extracted once so a
+    block can be matched against many filters
+    '''
+    
+    __slots__ = ('txid', 'outputs', 'inputs')
+    
+    def __init__(self, tx, txid=None):
+        '''txid : as Tx.hash (Block.tx_hashes) if already known'''
+        if txid is None:
+            txid = tx.hash()
+        self.txid = txid[::-1] # as serialized, the form BIP37 matches
+        # (pushes, pays to a pubkey or bare multisig) per output
+        self.outputs = []
+        for tx_out in tx.tx_outs:
+            raw = raw_script(tx_out.script_lock)
+            self.outputs.append((script_pushes(raw), classify_raw(raw)[0] in (P2PK, MULTISIG)))
+        # (outpoint, pushes of script_sig) per input
+        self.inputs = []
+        for tx_in in tx.tx_ins:
+            outpoint = tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)
+            self.inputs.append((outpoint, script_pushes(raw_script(tx_in.script_sig))))
+
+
+def block_items(block):
+    '''TxItems of every tx of a block parsed with include_txs=True'''
+    return [TxItems(tx, txid) for tx, txid in zip(block.txs, block.tx_hashes)]
+
 
 class BloomFilter:
     
-    def __init__(self, size, function_count, tweak):
+    def __init__(self, size, function_count, tweak, flags=BLOOM_UPDATE_ALL):
+        '''an empty filter (size 0) matches nothing'''
+        if not 0 <= size <= MAX_BLOOM_FILTER_SIZE:
+            raise ValueError(f'filter size {size} is not in [0, {MAX_BLOOM_FILTER_SIZE}] bytes')
+        if not 0 <= function_count <= MAX_HASH_FUNCS:
+            raise ValueError(f'{function_count} hash functions, BIP37 allows at most {MAX_HASH_FUNCS}')
         self.size = size # in byte
-        self.bit_field = [0] * (size * 8)
+        self.bits = bytearray(size)
         self.function_count = function_count
         self.tweak = tweak
+        self.flags = flags
+        self.bit_count = size * 8
+        # murmur3 seed of every hash function
+        self.seeds = [(i * BIP37_CONSTANT + tweak) & 0xffffffff for i in range(function_count)]
+    
+    @classmethod
+    def optimal(cls, element_count, fp_rate, tweak=None, flags=BLOOM_UPDATE_ALL):
+        '''
+        Filter sized for element_count items at a false positive rate of fp_rate,
+        capped to the BIP37 limits (as Bitcoin Core's CBloomFilter). tweak is random if None
+        '''
+        if element_count < 1 or not 0 < fp_rate < 1:
+            raise ValueError('element_count must be positive and fp_rate in (0, 1)')
+        bit_count = -element_count * math.log(fp_rate) / math.log(2) ** 2
+        size = max(1, min(int(bit_count), MAX_BLOOM_FILTER_SIZE * 8) // 8)
+        function_count = int(size * 8 / element_count * math.log(2))
+        function_count = max(1, min(function_count, MAX_HASH_FUNCS))
+        if tweak is None:
+            tweak = randint(0, 2**32 - 1)
+        return cls(size, function_count, tweak, flags)
+    
+    def expected_fp_rate(self, element_count):
+        '''false positive rate expected once element_count items are added'''
+        if self.bit_count == 0:
+            return 0.0
+        return (1 - math.exp(-self.function_count * element_count / self.bit_count)) ** self.function_count
+    
+    @classmethod
+    def parse_filterload(cls, payload):
+        '''
+        filter sent by a peer in a filterload message, raises RuntimeError
+        if it is malformed or over the BIP37 limits
+        '''
+        try:
+            size, offset = read_varint_at(payload, 0)
+        except IndexError:
+            raise RuntimeError('filterload payload is empty')
+        if size > MAX_BLOOM_FILTER_SIZE:
+            raise RuntimeError(f'filterload of {size} bytes, BIP37 allows at most {MAX_BLOOM_FILTER_SIZE}')
+        if len(payload) != offset + size + 9:
+            raise RuntimeError(f'filterload payload of {len(payload)} bytes, expected {offset + size + 9}')
+        function_count = little_endian_to_int(payload[offset + size:offset + size + 4])
+        tweak = little_endian_to_int(payload[offset + size + 4:offset + size + 8])
+        try:
+            bloom_filter = cls(size, function_count, tweak, payload[offset + size + 8])
+        except ValueError as e:
+            raise RuntimeError(f'bad filterload: {e}')
+        bloom_filter.bits[:] = payload[offset:offset + size]
+        return bloom_filter
+    
+    @property
+    def bit_field(self):
+        return bytes_to_bit_field(self.bits)
         
     def add(self, item):
         '''Add an item to the filter'''
-        for i in range(self.function_count):
-            seed = i * BIP37_CONSTANT + self.tweak
-            hmur = murmur3(item, seed)
-            bit = hmur % (self.size * 8)
-            self.bit_field[bit] = 1
+        bits = self.bits
+        bit_count = self.bit_count
+        if bit_count == 0:
+            return
+        for seed in self.seeds:
+            bit = murmur3(item, seed) % bit_count
+            bits[bit >> 3] |= 1 << (bit & 7)
+    
+    def contains(self, item):
+        '''True if item may have been added (false positives possible)'''
+        bits = self.bits
+        bit_count = self.bit_count
+        if bit_count == 0: # no modulo by zero (CVE-2013-5700)
+            return False
+        for seed in self.seeds:
+            bit = murmur3(item, seed) % bit_count
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+    
+    def match_items(self, items):
+        '''
+        BIP37 relevance of a tx (TxItems) : txid, data pushes of the outputs,
+        spent outpoints and data pushes of the inputs. Outpoints of matched
+        outputs are added to the filter as the flags ask
+        '''
+        contains = self.contains
+        found = contains(items.txid)
+        for index, (pushes, pays_to_pubkey) in enumerate(items.outputs):
+            for data in pushes:
+                if data and contains(data):
+                    found = True
+                    if self.flags == BLOOM_UPDATE_ALL or \
+                        (self.flags == BLOOM_UPDATE_P2PUBKEY_ONLY and pays_to_pubkey):
+                        self.add(items.txid + int_to_little_endian(index, 4))
+                    break
+        if found:
+            return True
+        for outpoint, pushes in items.inputs:
+            if contains(outpoint):
+                return True
+            for data in pushes:
+                if data and contains(data):
+                    return True
+        return False
+    
+    def match_tx(self, tx, txid=None):
+        return self.match_items(TxItems(tx, txid))
+    
+    def match_block(self, block, items=None):
+        '''
+        txids (as Block.tx_hashes) of the block relevant to the filter, in block order,
+        ready for merkleblock.merkle_block. items : block_items(block) if already extracted
+        '''
+        if items is None:
+            items = block_items(block)
+        if not any(self.bits):
+            return []
+        if self.bits.count(0xff) == self.size:
+            return list(block.tx_hashes)
+        return [txid for txid, tx_items in zip(block.tx_hashes, items) if self.match_items(tx_items)]
             
     def filter_bytes(self):
-        return bit_field_to_bytes(self.bit_field)
+        return bytes(self.bits)
     
-    def filterload(self, flag=1):
+    def filterload(self, flag=None):
         command = b'filterload'
+        if flag is None:
+            flag = self.flags
         
         payload = encode_varint(self.size)
         payload += self.filter_bytes()
@@ -45,3 +235,7 @@ class BloomFilter:
         return GenericMessage(command, payload)
 
 
+def match_block_filters(block, filters):
+    '''matched txids of the block for every filter (one list per filter), txs are read once'''
+    items = block_items(block)
+    return [bloom_filter.match_block(block, items) for bloom_filter in filters]
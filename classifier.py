@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Bulk classification of output scripts (script_lock) by byte patterns,
+# without building script cmds. Results are kept in columns (arrays).
+
+import mmap
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from blkfile import iter_framed_blocks
+from helper import (
+    h160_to_p2pkh_address,
+    h160_to_p2sh_address,
+    hash160,
+    little_endian_to_int,
+    read_varint_at,
+)
+from network import MAINNET_NETWORK_MAGIC
+
+# script type codes
+NONSTANDARD = 0
+P2PKH = 1
+P2SH = 2
+P2PK = 3
+MULTISIG = 4
+NULL_DATA = 5
+P2WPKH = 6
+P2WSH = 7
+P2TR = 8
+
+SCRIPT_TYPE_NAMES = {
+    NONSTANDARD: 'nonstandard',
+    P2PKH: 'p2pkh',
+    P2SH: 'p2sh',
+    P2PK: 'p2pk',
+    MULTISIG: 'multisig',
+    NULL_DATA: 'nulldata',
+    P2WPKH: 'p2wpkh',
+    P2WSH: 'p2wsh',
+    P2TR: 'p2tr',
+}
+
+NO_HASH = b'\x00' * 20
+
+
+def classify_raw(raw):
+    '''
+    Returns (script type code, hash160) of a raw script_lock (without the length varint)
+    hash160 is the pubkey hash for p2pkh/p2wpkh/p2pk, the script hash for p2sh, else NO_HASH
+    '''
+    length = len(raw)
+    if length == 25 and raw[0] == 0x76 and raw[1] == 0xa9 and raw[2] == 0x14 \
+        and raw[23] == 0x88 and raw[24] == 0xac:
+        return P2PKH, bytes(raw[3:23])
+    if length == 23 and raw[0] == 0xa9 and raw[1] == 0x14 and raw[22] == 0x87:
+        return P2SH, bytes(raw[2:22])
+    if length == 22 and raw[0] == 0 and raw[1] == 0x14:
+        return P2WPKH, bytes(raw[2:22])
+    if length == 34 and raw[1] == 0x20:
+        if raw[0] == 0:
+            return P2WSH, NO_HASH
+        if raw[0] == 0x51:
+            return P2TR, NO_HASH
+    if (length == 35 and raw[0] == 0x21 or length == 67 and raw[0] == 0x41) and raw[-1] == 0xac:
+        return P2PK, hash160(raw[1:-1])
+    if length > 0 and raw[0] == 0x6a:
+        return NULL_DATA, NO_HASH
+    if length >= 37 and raw[-1] == 0xae and is_raw_multisig(raw):
+        return MULTISIG, NO_HASH
+    return NONSTANDARD, NO_HASH
+
+
+def sec_size(prefix):
+    '''size of a SEC pubkey starting with prefix, 0 if prefix is not a SEC prefix'''
+    if prefix in (2, 3):
+        return 33
+    if prefix in (4, 6, 7):
+        return 65
+    return 0
+
+
+def is_raw_multisig(raw):
+    '''OP_m <n SEC pubkeys> OP_n OP_CHECKMULTISIG with 1 <= m <= n <= 16'''
+    m = raw[0] - 0x50
+    n = raw[-2] - 0x50
+    if not 1 <= m <= n <= 16:
+        return False
+    i = 1
+    end = len(raw) - 2
+    keys = 0
+    while i < end:
+        size = raw[i]
+        # a 33 or 65 byte push whose prefix matches its size
+        if size not in (33, 65) or i + 1 + size > end or sec_size(raw[i + 1]) != size:
+            return False
+        i += 1 + size
+        keys += 1
+    return keys == n
+
+
+# Columnar classification result, row i is one output
+class ScriptColumns:
+
+    def __init__(self):
+        self.types = array('B')
+        self.amounts = array('Q')
+        self.tx_indexes = array('I')
+        self.output_indexes = array('I')
+        self.hash160s = bytearray() # 20 bytes per row
+
+    def __repr__(self):
+        counts = ', '.join(f'{name}: {count}' for name, count in self.counts().items())
+        return f'ScriptColumns({len(self)} outputs) {counts}'
+
+    def __len__(self):
+        return len(self.types)
+
+    def append(self, script_type, h160, amount=0, tx_index=0, output_index=0):
+        self.types.append(script_type)
+        self.hash160s += h160
+        self.amounts.append(amount)
+        self.tx_indexes.append(tx_index)
+        self.output_indexes.append(output_index)
+
+    def extend(self, other):
+        self.types.extend(other.types)
+        self.hash160s += other.hash160s
+        self.amounts.extend(other.amounts)
+        self.tx_indexes.extend(other.tx_indexes)
+        self.output_indexes.extend(other.output_indexes)
+
+    def hash160(self, i):
+        return bytes(self.hash160s[i * 20:(i + 1) * 20])
+
+    def address(self, i, testnet=False):
+        '''base58 address of row i, None for types without one'''
+        script_type = self.types[i]
+        if script_type in (P2PKH, P2PK):
+            return h160_to_p2pkh_address(self.hash160(i), testnet)
+        if script_type == P2SH:
+            return h160_to_p2sh_address(self.hash160(i), testnet)
+        return None
+
+    def addresses(self, testnet=False):
+        return [self.address(i, testnet) for i in range(len(self))]
+
+    def counts(self):
+        result = {}
+        for script_type in self.types:
+            name = SCRIPT_TYPE_NAMES[script_type]
+            result[name] = result.get(name, 0) + 1
+        return result
+
+
+def classify_scripts(raws):
+    '''classifies an iterable of raw script_locks'''
+    columns = ScriptColumns()
+    for raw in raws:
+        script_type, h160 = classify_raw(raw)
+        columns.append(script_type, h160)
+    return columns
+
+
+def classify_block(block, columns=None):
+    '''classifies every output of a Block parsed with include_txs=True'''
+    if columns is None:
+        columns = ScriptColumns()
+    for tx_index, tx in enumerate(block.txs):
+        for output_index, tx_out in enumerate(tx.tx_outs):
+            script_lock = tx_out.script_lock
+            raw = script_lock.raw if script_lock.raw is not None else script_lock.raw_serialize()
+            script_type, h160 = classify_raw(raw)
+            columns.append(script_type, h160, tx_out.amount, tx_index, output_index)
+    return columns
+
+
+def iter_block_outputs(b, offset=0):
+    '''
+    Walks a serialized block (header + txs, segwit allowed) in a buffer
+    yields (tx index, output index, amount, raw script_lock view)
+    '''
+    b = memoryview(b)
+    i = offset + 80
+    num_txs, i = read_varint_at(b, i)
+    for tx_index in range(num_txs):
+        i += 4 # version
+        # segwit marker and flag
+        segwit = b[i] == 0 and b[i + 1] == 1
+        if segwit:
+            i += 2
+        num_inputs, i = read_varint_at(b, i)
+        for _ in range(num_inputs):
+            i += 36 # prev_tx, prev_index
+            length, i = read_varint_at(b, i)
+            i += length + 4 # script_sig, sequence
+        num_outputs, i = read_varint_at(b, i)
+        for output_index in range(num_outputs):
+            amount = little_endian_to_int(b[i:i + 8])
+            length, i = read_varint_at(b, i + 8)
+            yield tx_index, output_index, amount, b[i:i + length]
+            i += length
+        if segwit:
+            for _ in range(num_inputs):
+                num_items, i = read_varint_at(b, i)
+                for _ in range(num_items):
+                    length, i = read_varint_at(b, i)
+                    i += length
+        i += 4 # locktime
+
+
+def classify_block_buffer(b, offset=0, columns=None):
+    '''classifies every output of a serialized block without parsing Tx objects'''
+    if columns is None:
+        columns = ScriptColumns()
+    for tx_index, output_index, amount, raw in iter_block_outputs(b, offset):
+        script_type, h160 = classify_raw(raw)
+        columns.append(script_type, h160, amount, tx_index, output_index)
+    return columns
+
+
+def classify_file(path, magic=MAINNET_NETWORK_MAGIC):
+    '''classifies every output in a blk*.dat file (tx_indexes restart per block)'''
+    columns = ScriptColumns()
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                for offset, _ in iter_framed_blocks(view, magic):
+                    classify_block_buffer(view, offset, columns)
+            finally:
+                view.release()
+    return columns
+
+
+def classify_files(paths, magic=MAINNET_NETWORK_MAGIC, processes=None):
+    '''classifies block files in worker processes, returns ScriptColumns per path'''
+    paths = list(paths)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(classify_file, paths, [magic] * len(paths)))
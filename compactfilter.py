@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# BIP158 basic block filters (Golomb-coded sets) and the filter header chain
+# A filter holds every output script of a block and every script its inputs
+# spend, hashed with SipHash into [0, N * M), sorted, and Golomb-Rice coded.
+
+from io import BytesIO
+
+from helper import (
+    encode_varint,
+    hash256,
+    little_endian_to_int,
+    read_varint,
+)
+
+BASIC_FILTER_TYPE = 0
+BASIC_FILTER_P = 19 # Golomb-Rice parameter (bits of the remainder)
+BASIC_FILTER_M = 784931 # inverse false positive rate
+MASK64 = 0xffffffffffffffff
+
+
+def rotl64(x, b):
+    return ((x << b) | (x >> (64 - b))) & MASK64
+
+
+def siphash24(k0, k1, data):
+    '''SipHash-2-4 of data with the 128 bit key (k0, k1), as int'''
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    length = len(data)
+    end = length - length % 8
+    tail = bytes(data[end:]) + bytes(7 - length % 8) + bytes([length & 0xff])
+    for offset in range(0, end + 8, 8):
+        if offset < end:
+            m = int.from_bytes(data[offset:offset + 8], 'little')
+        else:
+            m = int.from_bytes(tail, 'little')
+        v3 ^= m
+        for _ in range(2):
+            v0 = (v0 + v1) & MASK64; v1 = rotl64(v1, 13); v1 ^= v0; v0 = rotl64(v0, 32)
+            v2 = (v2 + v3) & MASK64; v3 = rotl64(v3, 16); v3 ^= v2
+            v0 = (v0 + v3) & MASK64; v3 = rotl64(v3, 21); v3 ^= v0
+            v2 = (v2 + v1) & MASK64; v1 = rotl64(v1, 17); v1 ^= v2; v2 = rotl64(v2, 32)
+        v0 ^= m
+    v2 ^= 0xff
+    for _ in range(4):
+        v0 = (v0 + v1) & MASK64; v1 = rotl64(v1, 13); v1 ^= v0; v0 = rotl64(v0, 32)
+        v2 = (v2 + v3) & MASK64; v3 = rotl64(v3, 16); v3 ^= v2
+        v0 = (v0 + v3) & MASK64; v3 = rotl64(v3, 21); v3 ^= v0
+        v2 = (v2 + v1) & MASK64; v1 = rotl64(v1, 17); v1 ^= v2; v2 = rotl64(v2, 32)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def filter_key(block_hash):
+    '''SipHash key (k0, k1) of a block : the first 16 bytes of its hash as serialized'''
+    key = block_hash[::-1]
+    return little_endian_to_int(key[:8]), little_endian_to_int(key[8:16])
+
+
+def hashed_set(items, key, f):
+    '''sorted hashes of items mapped into [0, f)'''
+    k0, k1 = key
+    return sorted((siphash24(k0, k1, item) * f) >> 64 for item in items)
+
+
+def golomb_encode(values, p=BASIC_FILTER_P):
+    '''Golomb-Rice coded differences of sorted values (bit stream, most significant bit first)'''
+    result = bytearray()
+    acc = 0
+    acc_bits = 0
+    last = 0
+    for value in values:
+        delta = value - last
+        last = value
+        q = delta >> p
+        # q ones, a zero, then the p low bits
+        acc = (acc << (q + 1 + p)) | (((1 << q) - 1) << (1 + p)) | (delta & ((1 << p) - 1))
+        acc_bits += q + 1 + p
+        while acc_bits >= 8:
+            acc_bits -= 8
+            result.append(acc >> acc_bits)
+            acc &= (1 << acc_bits) - 1
+    if acc_bits:
+        result.append(acc << (8 - acc_bits))
+    return bytes(result)
+
+
+def golomb_decode(data, n, p=BASIC_FILTER_P):
+    '''yields the n sorted values coded in data'''
+    if n == 0:
+        return
+    bits = format(int.from_bytes(data, 'big'), f'0{len(data) * 8}b')
+    position = 0
+    value = 0
+    for _ in range(n):
+        zero = bits.find('0', position)
+        if zero == -1 or zero + 1 + p > len(bits):
+            raise RuntimeError('golomb coded set ends early')
+        value += ((zero - position) << p) | int(bits[zero + 1:zero + 1 + p], 2)
+        position = zero + 1 + p
+        yield value
+
+
+def basic_filter_items(block, spent_scripts):
+    '''
+    Scripts of a basic filter : output scripts (not empty, not OP_RETURN) of the
+    block, and the spent_scripts (raw scripts locking the outputs the inputs spend)
+    '''
+    items = set()
+    for tx in block.txs:
+        for tx_out in tx.tx_outs:
+            script_lock = tx_out.script_lock
+            raw = script_lock.raw if script_lock.raw is not None else script_lock.raw_serialize()
+            if len(raw) and raw[0] != 0x6a:
+                items.add(bytes(raw))
+    for raw in spent_scripts:
+        if len(raw):
+            items.add(bytes(raw))
+    return list(items)
+
+
+class BlockFilter:
+
+    __slots__ = ('block_hash', 'n', 'encoded', '_values')
+
+    def __init__(self, block_hash, n, encoded):
+        '''encoded : the Golomb-Rice bit stream (without the count varint)'''
+        self.block_hash = block_hash
+        self.n = n
+        self.encoded = encoded
+        self._values = None
+
+    def __repr__(self):
+        return f'BlockFilter({self.block_hash.hex()}, {self.n} items)'
+
+    @classmethod
+    def from_items(cls, block_hash, items):
+        values = hashed_set(items, filter_key(block_hash), len(items) * BASIC_FILTER_M)
+        return cls(block_hash, len(values), golomb_encode(values))
+
+    @classmethod
+    def from_block(cls, block, spent_scripts=()):
+        '''
+        basic filter of a block parsed with include_txs=True
+        spent_scripts : script_lock (raw bytes) of every output spent by the block,
+        in any order (they come from the UTXO set or undo data, not from the block)
+        '''
+        return cls.from_items(block.hash256(), basic_filter_items(block, spent_scripts))
+
+    @classmethod
+    def parse(cls, s, block_hash):
+        '''filter as in a cfilter message or BIP158 test vector (count varint + bit stream)'''
+        data = s.read()
+        stream = BytesIO(data)
+        n = read_varint(stream)
+        return cls(block_hash, n, data[stream.tell():])
+
+    def serialize(self):
+        return encode_varint(self.n) + self.encoded
+
+    def hash(self):
+        return hash256(self.serialize())
+
+    def header(self, prev_header):
+        '''filter header committing to this filter and the previous filter header'''
+        return hash256(self.hash() + prev_header)
+
+    def values(self):
+        '''decoded sorted hashes (cached)'''
+        if self._values is None:
+            self._values = list(golomb_decode(self.encoded, self.n))
+        return self._values
+
+    def match(self, item):
+        return self.match_any([item])
+
+    def match_any(self, items):
+        '''True if any of items (raw scripts) may be in the filter'''
+        if self.n == 0 or not items:
+            return False
+        query = hashed_set(items, filter_key(self.block_hash), self.n * BASIC_FILTER_M)
+        values = self.values() if self._values is not None else golomb_decode(self.encoded, self.n)
+        # merge of the two sorted lists, stops at the first common value
+        i = 0
+        for value in values:
+            while query[i] < value:
+                i += 1
+                if i == len(query):
+                    return False
+            if query[i] == value:
+                return True
+        return False
+
+
+class FilterHeaderChain:
+    '''
+    Filter headers by height, next to a HeaderStore
+    header(i) = hash256(filter hash(i) + header(i - 1)), header(-1) = 32 zero bytes
+    '''
+
+    def __init__(self, store=None):
+        '''store : HeaderStore the filters' block hashes are checked against'''
+        self.store = store
+        self.headers = bytearray() # 32 bytes per height
+
+    def __repr__(self):
+        return f'FilterHeaderChain : {len(self)} filter headers'
+
+    def __len__(self):
+        return len(self.headers) // 32
+
+    def header(self, height):
+        if not 0 <= height < len(self):
+            raise IndexError(f'no filter header at height {height}')
+        return bytes(self.headers[height * 32:(height + 1) * 32])
+
+    def tip(self):
+        '''last filter header, 32 zero bytes when empty'''
+        if not self.headers:
+            return bytes(32)
+        return bytes(self.headers[-32:])
+
+    def append(self, block_filter):
+        '''adds the filter of the next height, returns its filter header'''
+        height = len(self)
+        if self.store is not None and self.store.block_hash(height) != block_filter.block_hash:
+            raise RuntimeError(f'filter for {block_filter.block_hash.hex()} is not for height {height}')
+        header = block_filter.header(self.tip())
+        self.headers += header
+        return header
+
+    def append_filter_hashes(self, filter_hashes):
+        '''extends the chain from filter hashes (as in cfheaders), returns the new tip'''
+        tip = self.tip()
+        for filter_hash in filter_hashes:
+            tip = hash256(filter_hash + tip)
+            self.headers += tip
+        return tip
@@ -194,6 +194,34 @@ class S256Point(ECPoint):
         res = u * G + v * self
         return res.x.num == sig.r
     
+    @classmethod
+    def recover(cls, z, sig):
+        '''
+        Public keys for which verify(z, sig) is True (at most two, one per
+        y of R). None if r or s is out of range, use verify in that case.
+        '''
+        if not (0 < sig.r < N and 0 < sig.s < N):
+            return None
+        x = S256Field(sig.r)
+        alpha = x**3 + S256Field(B)
+        beta = alpha.sqrt()
+        if beta * beta != alpha: # no point with x == r
+            return []
+        r_inv = pow(sig.r, N - 2, N)
+        # Q = r^-1 * (s * R - z * G), for R = (x, beta) and R = (x, -beta)
+        a = (r_inv * sig.s % N) * cls(x, beta)
+        b = (r_inv * z % N) * G
+        result = []
+        for point in (a + b.negate(), a.negate() + b.negate()):
+            if point.x is not None:
+                result.append(point)
+        return result
+    
+    def negate(self):
+        if self.x is None:
+            return self
+        return self.__class__(self.x, S256Field((P - self.y.num) % P))
+    
     def sec(self, compressed=True):
         '''returns the binary version of the SEC format'''
         if compressed:
@@ -249,6 +277,8 @@ G = S256Point(
 ## Signature class using S256Point
 class Signature:
     
+    __slots__ = ('r', 's')
+    
     def __init__(self, r, s):
         self.r = r
         self.s = s
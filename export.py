@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Columnar export of parsed Tx / Block objects into NumPy arrays
+# Every chunk is a directory of .npy files (one per column) that can be
+# loaded back memory-mapped:
+#   tx_txid (n, 32) uint8, tx_version, tx_locktime, tx_input_count,
+#   tx_output_count, tx_height (uint32), tx_first_output (uint64)
+#   out_amount (uint64), out_script_type (uint8), out_script_offset (uint64),
+#   out_script_length (uint32), out_tx (uint32, row in the tx columns)
+#   script_blob (uint8, every script_lock of the chunk back to back)
+
+import os
+
+from array import array
+
+import numpy as np
+
+from classifier import classify_raw
+from helper import hash256
+
+DEFAULT_CHUNK_OUTPUTS = 1000000
+DEFAULT_CHUNK_SCRIPT_BYTES = 64 * 1024 * 1024
+
+# array typecodes have platform item sizes, pick the 4 byte one
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+TX_COLUMNS = {
+    'tx_version': UINT32,
+    'tx_locktime': UINT32,
+    'tx_input_count': UINT32,
+    'tx_output_count': UINT32,
+    'tx_height': UINT32,
+    'tx_first_output': 'Q',
+}
+OUTPUT_COLUMNS = {
+    'out_amount': 'Q',
+    'out_script_type': 'B',
+    'out_script_offset': 'Q',
+    'out_script_length': UINT32,
+    'out_tx': UINT32,
+}
+NUMPY_TYPES = {'B': np.uint8, UINT32: np.uint32, 'Q': np.uint64}
+for code, dtype in NUMPY_TYPES.items():
+    assert array(code).itemsize == np.dtype(dtype).itemsize, f'array {code!r} is not {np.dtype(dtype)}'
+
+
+class ColumnarExporter:
+    '''
+    Collects txs into columns and writes a chunk every chunk_outputs outputs
+    (or chunk_script_bytes of scripts), so memory stays bounded
+    Chunks are numbered after the ones already in directory, so exporting
+    again into it appends
+    '''
+
+    def __init__(self, directory, chunk_outputs=DEFAULT_CHUNK_OUTPUTS,
+                 chunk_script_bytes=DEFAULT_CHUNK_SCRIPT_BYTES):
+        self.directory = directory
+        self.chunk_outputs = chunk_outputs
+        self.chunk_script_bytes = chunk_script_bytes
+        self.chunk_count = 0 # chunks written by this exporter
+        os.makedirs(directory, exist_ok=True)
+        self.next_chunk = next_chunk_number(directory)
+        self.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def reset(self):
+        self.columns = {name: array(code) for name, code in TX_COLUMNS.items()}
+        self.columns.update({name: array(code) for name, code in OUTPUT_COLUMNS.items()})
+        self.txids = bytearray()
+        self.script_blob = bytearray()
+
+    def add_tx(self, tx, height=0, txid=None):
+        '''txid : binary hash (big endian as Tx.hash) if already known'''
+        if txid is None:
+            txid = hash256(tx.serialize())[::-1]
+        columns = self.columns
+        tx_row = len(columns['tx_version'])
+        self.txids += txid
+        columns['tx_version'].append(tx.version)
+        columns['tx_locktime'].append(tx.locktime)
+        columns['tx_input_count'].append(len(tx.tx_ins))
+        columns['tx_output_count'].append(len(tx.tx_outs))
+        columns['tx_height'].append(height)
+        columns['tx_first_output'].append(len(columns['out_amount']))
+        for tx_out in tx.tx_outs:
+            script_lock = tx_out.script_lock
+            raw = script_lock.raw if script_lock.raw is not None else script_lock.raw_serialize()
+            columns['out_amount'].append(tx_out.amount)
+            columns['out_script_type'].append(classify_raw(raw)[0])
+            columns['out_script_offset'].append(len(self.script_blob))
+            columns['out_script_length'].append(len(raw))
+            columns['out_tx'].append(tx_row)
+            self.script_blob += raw
+        if len(columns['out_amount']) >= self.chunk_outputs \
+            or len(self.script_blob) >= self.chunk_script_bytes:
+            self.flush()
+
+    def add_block(self, block, height=0):
+        '''block parsed with include_txs=True'''
+        for i, tx in enumerate(block.txs):
+            txid = block.tx_hashes[i] if block.tx_hashes else None
+            self.add_tx(tx, height, txid)
+
+    def add_txs(self, txs, height=0):
+        for tx in txs:
+            self.add_tx(tx, height)
+
+    def add_blocks(self, blocks, start_height=0):
+        for height, block in enumerate(blocks, start_height):
+            self.add_block(block, height)
+
+    def flush(self):
+        '''writes the collected rows as a chunk directory'''
+        if len(self.columns['tx_version']) == 0:
+            return
+        path = os.path.join(self.directory, f'chunk_{self.next_chunk:05d}')
+        os.makedirs(path)
+        for name, column in self.columns.items():
+            np.save(os.path.join(path, f'{name}.npy'),
+                    np.frombuffer(column, dtype=NUMPY_TYPES[column.typecode]))
+        np.save(os.path.join(path, 'tx_txid.npy'),
+                np.frombuffer(self.txids, dtype=np.uint8).reshape(-1, 32))
+        np.save(os.path.join(path, 'script_blob.npy'),
+                np.frombuffer(self.script_blob, dtype=np.uint8))
+        self.next_chunk += 1
+        self.chunk_count += 1
+        self.reset()
+
+    def close(self):
+        self.flush()
+
+
+def export_txs(directory, txs, **kwargs):
+    with ColumnarExporter(directory, **kwargs) as exporter:
+        exporter.add_txs(txs)
+    return exporter.chunk_count
+
+
+def export_blocks(directory, blocks, start_height=0, **kwargs):
+    with ColumnarExporter(directory, **kwargs) as exporter:
+        exporter.add_blocks(blocks, start_height)
+    return exporter.chunk_count
+
+
+def chunk_names(directory):
+    '''(number, name) of the chunk directories, in the order they were written'''
+    return sorted((int(name[6:]), name) for name in os.listdir(directory)
+                  if name.startswith('chunk_') and name[6:].isdigit())
+
+
+def next_chunk_number(directory):
+    names = chunk_names(directory)
+    return names[-1][0] + 1 if names else 0
+
+
+def chunk_paths(directory):
+    return [os.path.join(directory, name) for _, name in chunk_names(directory)]
+
+
+def load_chunk(path, mmap_mode='r'):
+    '''column name -> array of one chunk (memory-mapped by default)'''
+    result = {}
+    for name in os.listdir(path):
+        if name.endswith('.npy'):
+            result[name[:-4]] = np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+    return result
+
+
+def iter_chunks(directory, mmap_mode='r'):
+    for path in chunk_paths(directory):
+        yield load_chunk(path, mmap_mode)
+
+
+def load_column(directory, name):
+    '''one column over every chunk (concatenated in memory)
+    offsets in out_script_offset/out_tx/tx_first_output are relative to their chunk'''
+    return np.concatenate([np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                           for path in chunk_paths(directory)])
+
+
+def output_script(chunk, i):
+    '''raw script_lock of output row i of a chunk'''
+    offset = int(chunk['out_script_offset'][i])
+    return bytes(chunk['script_blob'][offset:offset + int(chunk['out_script_length'][i])])
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Append-only header chain in a file of 80 byte records (record i = height i)
+# The file is memory-mapped, the block hashes are kept in one bytearray that is
+# saved next to it (path + '.hashes') so that reopening does not rehash the chain.
+# Only the most recent hashes are in a dict, older ones are found in the bytearray.
+
+import hashlib
+import mmap
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from block import Block
+from helper import (
+    bits_to_target,
+    calculate_new_bits,
+    hash256,
+    little_endian_to_int,
+)
+
+HEADER_SIZE = 80
+RETARGET_INTERVAL = 2016
+GROWTH_RECORDS = RETARGET_INTERVAL * 16 # file grows by this many records at a time
+RECENT_HASHES = RETARGET_INTERVAL * 4 # hash -> height dict covers this many latest heights
+PARALLEL_CHUNK_HEADERS = 50000 # headers per worker process in validate_headers
+
+
+def header_count(b):
+    '''number of 80 byte headers in b, ValueError if b has a partial header'''
+    count, rest = divmod(len(b), HEADER_SIZE)
+    if rest:
+        raise ValueError(f'{len(b)} bytes is not a whole number of {HEADER_SIZE} byte headers')
+    return count
+
+
+def validate_header_range(b, prev_hash=None, collect=False):
+    '''
+    Checks proof of work and prev hash linkage of the 80 byte headers in b
+    prev_hash : hash256 (as serialized, not reversed) the first header must point to
+    Returns (number of valid headers from the start, hash256 of the last valid one,
+    hash256 of every valid header concatenated if collect else None)
+    '''
+    b = memoryview(b)
+    count = header_count(b)
+    sha256 = hashlib.sha256
+    targets = {}
+    last_hash = prev_hash
+    hashes = bytearray() if collect else None
+    for i in range(count):
+        offset = i * HEADER_SIZE
+        header = b[offset:offset + HEADER_SIZE]
+        if last_hash is not None and header[4:36] != last_hash:
+            return i, last_hash, hashes
+        bits = header[72:76].tobytes()
+        target = targets.get(bits)
+        if target is None:
+            target = targets[bits] = bits_to_target(bits)
+        h = sha256(sha256(header).digest()).digest()
+        if int.from_bytes(h, 'little') >= target:
+            return i, last_hash, hashes
+        if collect:
+            hashes += h
+        last_hash = h
+    return count, last_hash, hashes
+
+
+def validate_headers(b, prev_hash=None, processes=None, hashes=None):
+    '''
+    Validates a contiguous buffer of 80 byte headers (proof of work against
+    each header's bits and prev hash linkage), large buffers are split across
+    worker processes. Returns the number of valid headers from the start
+    (len(b) // 80 when all are valid), raises ValueError if len(b) is not a
+    multiple of 80
+    hashes : bytearray the hash256 of every valid header is appended to
+    '''
+    collect = hashes is not None
+    count = header_count(b)
+    if processes == 1 or count < 2 * PARALLEL_CHUNK_HEADERS:
+        valid, _, valid_hashes = validate_header_range(b, prev_hash, collect)
+        if collect:
+            hashes += valid_hashes
+        return valid
+    view = memoryview(b)
+    chunks = []
+    for start in range(0, count, PARALLEL_CHUNK_HEADERS):
+        end = min(start + PARALLEL_CHUNK_HEADERS, count)
+        chunks.append(view[start * HEADER_SIZE:end * HEADER_SIZE].tobytes())
+    # linkage to the previous chunk is checked here, not in the workers
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(validate_header_range, chunks,
+                                    [None] * len(chunks), [collect] * len(chunks)))
+    valid = 0
+    last_hash = prev_hash
+    for chunk, (chunk_valid, chunk_last_hash, chunk_hashes) in zip(chunks, results):
+        if last_hash is not None and chunk[4:36] != last_hash:
+            return valid
+        valid += chunk_valid
+        if collect:
+            hashes += chunk_hashes
+        if chunk_valid * HEADER_SIZE != len(chunk):
+            return valid
+        last_hash = chunk_last_hash
+    return valid
+
+
+class HeaderStore:
+
+    def __init__(self, path, check_bits=True):
+        '''
+        check_bits : enforce the difficulty adjustment every 2016 blocks
+        (testnet minimum-difficulty blocks are not modeled, pass False for testnet/regtest)
+        '''
+        self.path = path
+        self.check_bits = check_bits
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.file = open(path, mode)
+        size = self.file.seek(0, 2)
+        self.capacity = size // HEADER_SIZE
+        self.map = None
+        if self.capacity == 0:
+            self.grow()
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        self.hashes = bytearray() # 32 bytes per height, as Block.hash256()
+        self.recent = {} # hash -> height of the last RECENT_HASHES heights
+        self.count = 0
+        self.saved = 0 # hashes already in the .hashes file
+        stored = self.stored_count()
+        self.load_hashes(stored)
+        for height in range(self.count, stored):
+            self.index_header(self.raw_record(height))
+
+    @property
+    def hashes_path(self):
+        return self.path + '.hashes'
+
+    def stored_count(self):
+        '''
+        number of headers in the file : the unused capacity at the end is zero
+        filled and headers are only appended, so the first empty record is
+        found by bisection
+        '''
+        empty = bytes(HEADER_SIZE)
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if self.raw_record(middle) == empty:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def raw_record(self, height):
+        return self.map[height * HEADER_SIZE:(height + 1) * HEADER_SIZE]
+
+    def load_hashes(self, stored):
+        '''hashes saved by the last close, if they match the headers'''
+        if not os.path.exists(self.hashes_path):
+            return
+        with open(self.hashes_path, 'rb') as f:
+            hashes = bytearray(f.read(stored * 32))
+        count = len(hashes) // 32
+        # the last saved hash must be the one of the header at that height
+        if count == 0 or hash256(self.raw_record(count - 1))[::-1] != hashes[-32:]:
+            return
+        self.hashes = hashes
+        self.count = self.saved = count
+        for height in range(max(0, count - RECENT_HASHES), count):
+            self.recent[self.block_hash(height)] = height
+
+    def save_hashes(self):
+        '''writes the hashes added since the last save'''
+        mode = 'r+b' if self.saved and os.path.exists(self.hashes_path) else 'wb'
+        with open(self.hashes_path, mode) as f:
+            f.truncate(self.saved * 32)
+            f.seek(self.saved * 32)
+            f.write(self.hashes[self.saved * 32:self.count * 32])
+        self.saved = self.count
+
+    def __repr__(self):
+        return f'HeaderStore({self.path}) : {self.count} headers'
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def grow(self):
+        self.capacity += GROWTH_RECORDS
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(self.capacity * HEADER_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def close(self):
+        '''flush, save the hashes and cut the unused capacity off the file'''
+        if self.map is None:
+            return
+        self.map.flush()
+        self.map.close()
+        self.map = None
+        self.file.truncate(self.count * HEADER_SIZE)
+        self.file.close()
+        self.save_hashes()
+
+    def index_header(self, raw, h256=None):
+        '''h256 : hash256 of raw if already computed'''
+        if h256 is None:
+            h256 = hash256(raw)
+        h = bytes(h256[::-1])
+        self.recent[h] = self.count
+        if self.count >= RECENT_HASHES:
+            del self.recent[self.block_hash(self.count - RECENT_HASHES)]
+        self.hashes += h
+        self.count += 1
+
+    @property
+    def height(self):
+        '''height of the tip, -1 when empty'''
+        return self.count - 1
+
+    def raw(self, height):
+        '''80 byte header at height (bytes)'''
+        if not 0 <= height < self.count:
+            raise IndexError(f'no header at height {height}')
+        return self.map[height * HEADER_SIZE:(height + 1) * HEADER_SIZE]
+
+    def header(self, height):
+        return Block.parse(BytesIO(self.raw(height)))
+
+    def block_hash(self, height):
+        if not 0 <= height < self.count:
+            raise IndexError(f'no header at height {height}')
+        return bytes(self.hashes[height * 32:(height + 1) * 32])
+
+    def tip_hash(self):
+        return self.block_hash(self.height)
+
+    def height_of(self, block_hash):
+        '''height of the header with block_hash, None if unknown'''
+        height = self.recent.get(block_hash)
+        if height is not None:
+            return height
+        if len(block_hash) != 32:
+            return None
+        # older headers : search the hashes, only at 32 byte boundaries
+        end = max(0, self.count - RECENT_HASHES) * 32
+        offset = self.hashes.find(block_hash, 0, end)
+        while offset != -1:
+            if offset % 32 == 0:
+                return offset // 32
+            offset = self.hashes.find(block_hash, offset + 1, end)
+        return None
+
+    def __contains__(self, block_hash):
+        return self.height_of(block_hash) is not None
+
+    def bits(self, height):
+        offset = height * HEADER_SIZE
+        return self.map[offset + 72:offset + 76]
+
+    def timestamp(self, height):
+        offset = height * HEADER_SIZE
+        return little_endian_to_int(self.map[offset + 68:offset + 72])
+
+    def expected_bits(self, height):
+        '''bits the header at height must have (height > 0)'''
+        previous_bits = self.bits(height - 1)
+        if height % RETARGET_INTERVAL != 0:
+            return previous_bits
+        first = height - RETARGET_INTERVAL
+        time_differential = self.timestamp(height - 1) - self.timestamp(first)
+        return calculate_new_bits(previous_bits, time_differential)
+
+    def validate(self, raw):
+        '''checks raw (80 bytes) as the next header, raises RuntimeError if invalid'''
+        if len(raw) != HEADER_SIZE:
+            raise RuntimeError(f'header must be {HEADER_SIZE} bytes, got {len(raw)}')
+        h = hash256(raw)
+        if little_endian_to_int(h) >= bits_to_target(raw[72:76]):
+            raise RuntimeError(f'{h[::-1].hex()} does not meet its proof of work target')
+        if self.count == 0:
+            return
+        if raw[4:36] != self.hashes[-32:][::-1]:
+            raise RuntimeError(f'{h[::-1].hex()} does not extend the tip {self.tip_hash().hex()}')
+        if self.check_bits and raw[72:76] != self.expected_bits(self.count):
+            raise RuntimeError(f'bad bits at height {self.count}: {raw[72:76].hex()}')
+
+    def append(self, header):
+        '''validates and stores a header (Block or 80 bytes), returns its height'''
+        if isinstance(header, Block):
+            raw = header.serialize()
+        else:
+            raw = bytes(header)
+        self.validate(raw)
+        if self.count == self.capacity:
+            self.grow()
+        offset = self.count * HEADER_SIZE
+        self.map[offset:offset + HEADER_SIZE] = raw
+        self.index_header(raw)
+        return self.count - 1
+
+    def extend_raw(self, b, processes=None):
+        '''
+        Appends a buffer of 80 byte headers, proof of work and linkage are
+        validated in bulk (validate_headers). Stops at the first invalid
+        header and raises RuntimeError, the valid ones before it are kept
+        '''
+        count = header_count(b)
+        prev_hash = bytes(self.hashes[-32:][::-1]) if self.count else None
+        hashes = bytearray()
+        valid = validate_headers(b, prev_hash, processes, hashes)
+        view = memoryview(b)
+        for i in range(valid):
+            raw = view[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]
+            if self.check_bits and self.count and raw[72:76] != self.expected_bits(self.count):
+                raise RuntimeError(f'bad bits at height {self.count}: {raw[72:76].hex()}')
+            if self.count == self.capacity:
+                self.grow()
+            offset = self.count * HEADER_SIZE
+            self.map[offset:offset + HEADER_SIZE] = raw
+            self.index_header(raw, hashes[i * 32:(i + 1) * 32])
+        if valid != count:
+            raise RuntimeError(f'invalid header at height {self.count}')
+        return self.height
+    
+    def extend(self, headers):
+        for header in headers:
+            self.append(header)
+        return self.height
+
+    def locator(self):
+        '''block hashes for getheaders : last 10, then exponentially spaced back to genesis'''
+        result = []
+        height = self.height
+        step = 1
+        while height > 0:
+            result.append(self.block_hash(height))
+            if len(result) >= 10:
+                step *= 2
+            height -= step
+        if self.count:
+            result.append(self.block_hash(0))
+        return result
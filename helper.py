@@ -5,6 +5,7 @@
 
 
 import hashlib
+import struct
 from io import BytesIO
 
 SIGHASH_ALL = 1
@@ -74,9 +75,51 @@ def int_to_little_endian(n, length):
     return n.to_bytes(length, 'little')
 
 
+class BufferReader:
+    '''Stream (read/tell/seek) over a bytes-like buffer.
+    read returns bytes, read_view returns a memoryview slice without copying'''
+    
+    def __init__(self, buffer, offset=0):
+        self.buffer = memoryview(buffer).cast('B').toreadonly()
+        self.position = offset
+        
+    def __len__(self):
+        return len(self.buffer)
+        
+    def read_view(self, n=-1):
+        start = self.position
+        if n is None or n < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + n, len(self.buffer))
+        self.position = end
+        return self.buffer[start:end]
+    
+    def read(self, n=-1):
+        return self.read_view(n).tobytes()
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.buffer)
+        self.position = offset
+        return offset
+    
+    def getbuffer(self):
+        return self.buffer[:]
+
+
 def read_varint(s):
     '''read_varint reads a variable integer from a stream'''
-    i = s.read(1)[0]
+    return read_varint_after(s, s.read(1)[0])
+
+
+def read_varint_after(s, i):
+    '''rest of a variable integer whose first byte i was already read from the stream'''
     if i == 0xfd:
         # 0xfd means the next two bytes are the number
         return little_endian_to_int(s.read(2))
@@ -91,6 +134,19 @@ def read_varint(s):
         return i
 
 
+def read_varint_at(b, offset):
+    '''reads a variable integer from a buffer at offset, returns (integer, next offset)'''
+    i = b[offset]
+    if i == 0xfd:
+        return little_endian_to_int(b[offset + 1:offset + 3]), offset + 3
+    elif i == 0xfe:
+        return little_endian_to_int(b[offset + 1:offset + 5]), offset + 5
+    elif i == 0xff:
+        return little_endian_to_int(b[offset + 1:offset + 9]), offset + 9
+    else:
+        return i, offset + 1
+
+
 def encode_varint(i):
     '''encodes an integer as a varint'''
     if i < 0xfd:
@@ -124,6 +180,10 @@ def bits_to_target(bits):
     target = coefficient * 256 ** (exponent - 3)
     return target
 
+def bits_to_work(bits):
+    '''expected number of hashes for a block with bits (exact integer, as chainwork)'''
+    return 2**256 // (bits_to_target(bits) + 1)
+
 def target_to_bits(target):
     raw_bytes = target.to_bytes(32, 'big')
     raw_bytes = raw_bytes.lstrip(b'\x00')
@@ -159,6 +219,20 @@ def merkle_parent_level(hashes):
         parent_level.append(parent)
     return parent_level
 
+def merkle_levels(hashes):
+    '''every level of the merkle tree of hashes, leaves first and root last
+    (the last hash of an odd level is paired with itself, levels are not padded)'''
+    if not hashes:
+        raise RuntimeError('a merkle tree needs at least 1 leaf')
+    level = list(hashes)
+    levels = [level]
+    while len(level) > 1:
+        last = len(level) - 1
+        level = [merkle_parent(level[i], level[i + 1] if i < last else level[i])
+                 for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
 def merkle_root(hashes):
     current_level = hashes
     while len(current_level) > 1:
@@ -185,42 +259,40 @@ def bit_field_to_bytes(b):
     
 def murmur3(data, seed=0):
     '''from http://stackoverflow.com/questions/13305290/is-there-a-pure-python-implementation-of-murmurhash'''
+    # 4 byte blocks are unpacked at once and every step is kept to 32 bits
     c1 = 0xcc9e2d51
     c2 = 0x1b873593
     length = len(data)
-    h1 = seed
+    h1 = seed & 0xffffffff
     roundedEnd = (length & 0xfffffffc)  # round down to 4 byte block
-    for i in range(0, roundedEnd, 4):
-        # little endian load order
-        k1 = (data[i] & 0xff) | ((data[i + 1] & 0xff) << 8) | \
-            ((data[i + 2] & 0xff) << 16) | (data[i + 3] << 24)
-        k1 *= c1
-        k1 = (k1 << 15) | ((k1 & 0xffffffff) >> 17)  # ROTL32(k1,15)
-        k1 *= c2
+    for k1 in struct.unpack_from(f'<{roundedEnd >> 2}I', data):
+        k1 = (k1 * c1) & 0xffffffff
+        k1 = ((k1 << 15) | (k1 >> 17)) & 0xffffffff  # ROTL32(k1,15)
+        k1 = (k1 * c2) & 0xffffffff
         h1 ^= k1
-        h1 = (h1 << 13) | ((h1 & 0xffffffff) >> 19)  # ROTL32(h1,13)
-        h1 = h1 * 5 + 0xe6546b64
+        h1 = ((h1 << 13) | (h1 >> 19)) & 0xffffffff  # ROTL32(h1,13)
+        h1 = (h1 * 5 + 0xe6546b64) & 0xffffffff
     # tail
     k1 = 0
     val = length & 0x03
     if val == 3:
-        k1 = (data[roundedEnd + 2] & 0xff) << 16
+        k1 = data[roundedEnd + 2] << 16
     # fallthrough
     if val in [2, 3]:
-        k1 |= (data[roundedEnd + 1] & 0xff) << 8
+        k1 |= data[roundedEnd + 1] << 8
     # fallthrough
     if val in [1, 2, 3]:
-        k1 |= data[roundedEnd] & 0xff
-        k1 *= c1
-        k1 = (k1 << 15) | ((k1 & 0xffffffff) >> 17)  # ROTL32(k1,15)
-        k1 *= c2
+        k1 |= data[roundedEnd]
+        k1 = (k1 * c1) & 0xffffffff
+        k1 = ((k1 << 15) | (k1 >> 17)) & 0xffffffff  # ROTL32(k1,15)
+        k1 = (k1 * c2) & 0xffffffff
         h1 ^= k1
     # finalization
     h1 ^= length
     # fmix(h1)
-    h1 ^= ((h1 & 0xffffffff) >> 16)
-    h1 *= 0x85ebca6b
-    h1 ^= ((h1 & 0xffffffff) >> 13)
-    h1 *= 0xc2b2ae35
-    h1 ^= ((h1 & 0xffffffff) >> 16)
-    return h1 & 0xffffffff
\ No newline at end of file
+    h1 ^= h1 >> 16
+    h1 = (h1 * 0x85ebca6b) & 0xffffffff
+    h1 ^= h1 >> 13
+    h1 = (h1 * 0xc2b2ae35) & 0xffffffff
+    h1 ^= h1 >> 16
+    return h1
\ No newline at end of file
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import heapq
+import time
+
+from helper import hash256
+
+DEFAULT_MAX_MEMPOOL_SIZE = 300 * 1000 * 1000 # in virtual bytes (BIP141)
+MAX_BLOCK_SIZE = 1000 * 1000 # in virtual bytes
+
+
+# Mempool entry (tx with the values the pool needs for ordering)
+# ancestor_* : totals of the tx and its in-pool ancestors (the package mined with it)
+# descendant_* : totals of the tx and its in-pool descendants (the package evicted with it)
+class MempoolEntry:
+
+    __slots__ = ('tx', 'txid', 'size', 'fee', 'fee_rate', 'time', 'parents', 'children',
+                 'ancestor_fee', 'ancestor_size', 'descendant_fee', 'descendant_size')
+
+    def __init__(self, tx, txid, size, fee, entry_time=None):
+        self.tx = tx
+        self.txid = txid
+        self.size = size # virtual size
+        self.fee = fee
+        self.fee_rate = fee / size # satoshi per virtual byte
+        if entry_time is None:
+            self.time = time.time()
+        else:
+            self.time = entry_time
+        self.parents = set() # txids of in-pool txs this tx spends
+        self.children = set() # txids of in-pool txs spending this tx
+        self.ancestor_fee = fee
+        self.ancestor_size = size
+        self.descendant_fee = fee
+        self.descendant_size = size
+
+    def __repr__(self):
+        return f'{self.txid.hex()}: {self.fee} sat, {self.size} vbytes ({self.fee_rate:.2f} sat/vbyte)'
+
+    def ancestor_fee_rate(self):
+        return self.ancestor_fee / self.ancestor_size
+
+    def eviction_score(self):
+        '''
+        fee rate of the tx with its descendants, or its own if higher (as Bitcoin Core) :
+        a parent is kept as long as a child pays for it
+        '''
+        return max(self.fee_rate, self.descendant_fee / self.descendant_size)
+
+
+# Unconfirmed tx pool
+# txs : txid -> MempoolEntry
+# spenders : (prev_tx, prev_index) -> txid spending the outpoint
+# eviction heap on MempoolEntry.eviction_score, an entry is pushed again when its
+# score changes and outdated items are dropped lazily when they reach the top
+class Mempool:
+
+    def __init__(self, max_size=DEFAULT_MAX_MEMPOOL_SIZE, testnet=False):
+        self.max_size = max_size
+        self.testnet = testnet
+        self.txs = {}
+        self.spenders = {}
+        self.total_size = 0
+        self._min_heap = []
+        self._counter = 0
+
+    def __repr__(self):
+        return f'Mempool : {len(self.txs)} txs, {self.total_size} bytes'
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, txid):
+        return txid in self.txs
+
+    def get(self, txid):
+        entry = self.txs.get(txid)
+        if entry is None:
+            return None
+        return entry.tx
+
+    def spender(self, prev_tx, prev_index):
+        '''txid of the in-pool tx spending the outpoint, None if unspent'''
+        return self.spenders.get((prev_tx, prev_index))
+
+    def is_spent(self, prev_tx, prev_index):
+        return (prev_tx, prev_index) in self.spenders
+
+    def conflicts(self, tx):
+        '''txids of in-pool txs spending any of the outpoints tx spends'''
+        result = set()
+        for tx_in in tx.tx_ins:
+            txid = self.spenders.get((tx_in.prev_tx, tx_in.prev_index))
+            if txid is not None:
+                result.add(txid)
+        return result
+
+    def input_value(self, tx_in):
+        '''amount of the output tx_in spends (from the pool, else fetched)'''
+        parent = self.txs.get(tx_in.prev_tx)
+        if parent is not None:
+            return parent.tx.tx_outs[tx_in.prev_index].amount
+        return tx_in.value(testnet=self.testnet)
+
+    def add(self, tx, fee=None, entry_time=None):
+        '''
+        Add tx to the pool and return its entry
+        fee : pass it if known, else it is calculated from the input values
+        Raises RuntimeError for double spends of in-pool outputs, and when the
+        pool is full and tx is the one evicted to make room
+        '''
+        raw = tx.serialize()
+        txid = hash256(raw)[::-1]
+        if txid in self.txs:
+            return self.txs[txid]
+        if tx.is_coinbase():
+            raise RuntimeError('coinbase tx cannot be in the mempool')
+        conflicts = self.conflicts(tx)
+        if conflicts:
+            raise RuntimeError(f'{txid.hex()} conflicts with {len(conflicts)} tx(s) in the mempool')
+        if fee is None:
+            fee = sum(self.input_value(tx_in) for tx_in in tx.tx_ins) \
+                - sum(tx_out.amount for tx_out in tx.tx_outs)
+        if fee < 0:
+            raise RuntimeError(f'{txid.hex()} has a negative fee')
+        size = tx.vsize() if tx.is_segwit() else len(raw) # no second serialization for legacy txs
+        entry = MempoolEntry(tx, txid, size, fee, entry_time)
+        for tx_in in tx.tx_ins:
+            self.spenders[(tx_in.prev_tx, tx_in.prev_index)] = txid
+            parent = self.txs.get(tx_in.prev_tx)
+            if parent is not None:
+                entry.parents.add(parent.txid)
+                parent.children.add(txid)
+        self.txs[txid] = entry
+        self.total_size += entry.size
+        for ancestor_id in self.ancestors(txid):
+            ancestor = self.txs[ancestor_id]
+            entry.ancestor_fee += ancestor.fee
+            entry.ancestor_size += ancestor.size
+            ancestor.descendant_fee += entry.fee
+            ancestor.descendant_size += entry.size
+            self._push(ancestor)
+        self._push(entry)
+        self.trim()
+        if txid not in self.txs:
+            raise RuntimeError(f'{txid.hex()} evicted, its fee rate is below the mempool minimum')
+        return entry
+
+    def _push(self, entry):
+        self._counter += 1
+        heapq.heappush(self._min_heap, (entry.eviction_score(), self._counter, entry))
+
+    def _top(self, heap):
+        '''top live entry of the heap (removed entries and outdated scores are dropped)'''
+        while heap:
+            score, _, entry = heap[0]
+            if self.txs.get(entry.txid) is entry and score == entry.eviction_score():
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    def _remove_entry(self, entry):
+        del self.txs[entry.txid]
+        self.total_size -= entry.size
+        for tx_in in entry.tx.tx_ins:
+            outpoint = (tx_in.prev_tx, tx_in.prev_index)
+            if self.spenders.get(outpoint) == entry.txid:
+                del self.spenders[outpoint]
+        for parent_id in entry.parents:
+            parent = self.txs.get(parent_id)
+            if parent is not None:
+                parent.children.discard(entry.txid)
+        for child_id in entry.children:
+            child = self.txs.get(child_id)
+            if child is not None:
+                child.parents.discard(entry.txid)
+        # the heap is cleaned lazily, rebuild when mostly stale
+        if len(self._min_heap) > 2 * len(self.txs) + 64:
+            self._min_heap = [item for item in self._min_heap if self.txs.get(item[2].txid) is item[2]
+                              and item[0] == item[2].eviction_score()]
+            heapq.heapify(self._min_heap)
+
+    def ancestors(self, txid):
+        '''txids of all in-pool txs txid depends on'''
+        result = set()
+        todo = list(self.txs[txid].parents)
+        while todo:
+            current = todo.pop()
+            if current not in result:
+                result.add(current)
+                todo.extend(self.txs[current].parents)
+        return result
+
+    def descendants(self, txid):
+        '''txids of all in-pool txs depending on txid'''
+        result = set()
+        todo = list(self.txs[txid].children)
+        while todo:
+            current = todo.pop()
+            if current not in result:
+                result.add(current)
+                todo.extend(self.txs[current].children)
+        return result
+
+    def remove(self, txid, with_descendants=True):
+        '''Remove txid (and the txs spending it), returns the removed txids'''
+        if txid not in self.txs:
+            return set()
+        removed = {txid}
+        if with_descendants:
+            removed |= self.descendants(txid)
+        # package totals of the txs staying in the pool
+        for current in removed:
+            entry = self.txs[current]
+            for ancestor_id in self.ancestors(current) - removed:
+                ancestor = self.txs[ancestor_id]
+                ancestor.descendant_fee -= entry.fee
+                ancestor.descendant_size -= entry.size
+                self._push(ancestor)
+            for descendant_id in self.descendants(current) - removed:
+                descendant = self.txs[descendant_id]
+                descendant.ancestor_fee -= entry.fee
+                descendant.ancestor_size -= entry.size
+        for current in removed:
+            self._remove_entry(self.txs[current])
+        return removed
+
+    def remove_for_block(self, txs):
+        '''Remove the txs confirmed in a block and everything conflicting with them'''
+        removed = set()
+        for tx in txs:
+            txid = tx.hash()
+            if txid in self.txs:
+                removed |= self.remove(txid, with_descendants=False)
+            if tx.is_coinbase():
+                continue
+            for conflict in self.conflicts(tx):
+                removed |= self.remove(conflict)
+        return removed
+
+    def trim(self):
+        '''Evict the lowest scored txs (with descendants) until the pool fits max_size'''
+        removed = set()
+        while self.total_size > self.max_size:
+            entry = self._top(self._min_heap)
+            if entry is None:
+                break
+            removed |= self.remove(entry.txid)
+        return removed
+
+    def min_fee_rate(self):
+        entry = self._top(self._min_heap)
+        if entry is None:
+            return 0
+        return entry.eviction_score()
+
+    def block_template(self, max_size=MAX_BLOCK_SIZE):
+        '''
+        Txs by ancestor package fee rate (a tx with its unselected in-pool ancestors,
+        so a child can pay for its parent) that fit in max_size vbytes, parents
+        before children. Returns (txs, total fee)
+        '''
+        # package totals of every tx, lowered as its ancestors get selected
+        package = {txid: (entry.ancestor_fee, entry.ancestor_size) for txid, entry in self.txs.items()}
+        heap = []
+        for txid, (fee, size) in package.items():
+            self._counter += 1
+            heap.append((-fee / size, self._counter, txid))
+        heapq.heapify(heap)
+        selected = set()
+        result = []
+        total_size = 0
+        fees = 0
+        while heap:
+            score, _, txid = heapq.heappop(heap)
+            if txid in selected:
+                continue
+            fee, size = package[txid]
+            if -score != fee / size: # outdated, pushed again with its new totals
+                continue
+            if size + total_size > max_size:
+                continue
+            members = [ancestor for ancestor in self.ancestors(txid) if ancestor not in selected]
+            members.append(txid)
+            # fewer in-pool ancestors first : parents before children
+            members.sort(key=lambda member: self.txs[member].ancestor_size)
+            for member in members:
+                entry = self.txs[member]
+                selected.add(member)
+                result.append(entry.tx)
+                total_size += entry.size
+                fees += entry.fee
+            for member in members:
+                entry = self.txs[member]
+                for descendant in self.descendants(member):
+                    if descendant in selected:
+                        continue
+                    fee, size = package[descendant]
+                    package[descendant] = (fee - entry.fee, size - entry.size)
+            for descendant in {d for member in members for d in self.descendants(member)} - selected:
+                fee, size = package[descendant]
+                self._counter += 1
+                heapq.heappush(heap, (-fee / size, self._counter, descendant))
+        return result, fees
@@ -4,34 +4,52 @@
 # In[6]:
 
 
-import math
-
+from collections import OrderedDict
 from io import BytesIO
 
 from helper import (
+    bit_field_to_bytes,
     bytes_to_bit_field,
+    encode_varint,
+    int_to_little_endian,
     little_endian_to_int,
+    merkle_levels,
     merkle_parent,
     read_varint,
 )
 
+BUILDER_CACHE_SIZE = 16 # blocks whose merkle levels are kept by merkle_block()
+
 class MerkleTree:
+    '''
+    Partial merkle tree kept in one flat list, level by level from the root
+    (level widths as in Bitcoin Core, a level has ceil(total / 2**height) nodes)
+    '''
     
     def __init__(self, total):
+        if total < 1:
+            raise RuntimeError('a merkle tree needs at least 1 leaf')
         self.total = total
-        self.max_depth = math.ceil(math.log(self.total, 2))
-        self.nodes = []
+        self.max_depth = (total - 1).bit_length()
+        self.widths = []
+        self.offsets = []
+        size = 0
         for depth in range(self.max_depth + 1):
-            level_hashes = [None] * (2**depth)
-            self.nodes.append(level_hashes)
+            height = self.max_depth - depth
+            width = (total + (1 << height) - 1) >> height
+            self.offsets.append(size)
+            self.widths.append(width)
+            size += width
+        self.nodes = [None] * size
+        self.matched = [] # leaves flagged as matches by the last populate_tree
         self.current_depth = 0
         self.current_index = 0
         
     def __repr__(self):
         result = []
-        for depth, level in enumerate(self.nodes):
+        for depth in range(self.max_depth + 1):
             items = []
-            for index, h in enumerate(level):
+            for index, h in enumerate(self.level(depth)):
                 if h is None:
                     short = 'None'
                 else:
@@ -43,6 +61,20 @@ class MerkleTree:
             result.append(', '.join(items))
         return '\n'.join(result)
     
+    def reset(self):
+        self.nodes[:] = [None] * len(self.nodes)
+        self.matched = []
+        self.current_depth = 0
+        self.current_index = 0
+    
+    def level(self, depth):
+        offset = self.offsets[depth]
+        return self.nodes[offset:offset + self.widths[depth]]
+    
+    def set_level(self, depth, hashes):
+        offset = self.offsets[depth]
+        self.nodes[offset:offset + self.widths[depth]] = hashes[:self.widths[depth]]
+    
     def up(self):
         self.current_depth -= 1
         self.current_index //=2
@@ -56,53 +88,89 @@ class MerkleTree:
         self.current_index = self.current_index * 2 + 1
     
     def root(self):
-        return self.nodes[0][0]
+        return self.nodes[0]
     
     def set_current_node(self, value):
-        self.nodes[self.current_depth][self.current_index] = value
+        self.nodes[self.offsets[self.current_depth] + self.current_index] = value
         
     def get_current_node(self):
-        return self.nodes[self.current_depth][self.current_index]
+        return self.nodes[self.offsets[self.current_depth] + self.current_index]
     
     def get_left_node(self):
-        return self.nodes[self.current_depth + 1][self.currnet_index * 2]
+        return self.nodes[self.offsets[self.current_depth + 1] + self.current_index * 2]
     
     def get_right_node(self):
-        return self.nodes[self.current_depth + 1][self.currnet_index * 2 + 1]
+        return self.nodes[self.offsets[self.current_depth + 1] + self.current_index * 2 + 1]
     
     def is_leaf(self):
         return self.current_depth == self.max_depth
     
     def right_exists(self):
-        return len(self.nodes[self.current_depth + 1]) > self.currnet_index * 2 + 1
+        return self.widths[self.current_depth + 1] > self.current_index * 2 + 1
     
     def populate_tree(self, flag_bits, hashes):
-        while self.root() is None:
-            if self.is_leaf():
-                flag_bits.pop(0)
-                self.set_current_node(hashes.pop(0))
-                self.up()
-            else:
-                left_hash = self.get_left_node()
+        '''
+        Depth first walk filling the tree from flag bits and hashes (little endian),
+        both read through cursors so the walk is linear in the size of the proof
+        '''
+        nodes = self.nodes
+        offsets = self.offsets
+        widths = self.widths
+        max_depth = self.max_depth
+        matched = []
+        flag_index = 0
+        hash_index = 0
+        depth = self.current_depth
+        index = self.current_index
+        try:
+            while nodes[0] is None:
+                position = offsets[depth] + index
+                if depth == max_depth:
+                    h = hashes[hash_index]
+                    if flag_bits[flag_index]:
+                        matched.append(h)
+                    flag_index += 1
+                    hash_index += 1
+                    nodes[position] = h
+                    depth -= 1
+                    index >>= 1
+                    continue
+                child = offsets[depth + 1] + index * 2
+                left_hash = nodes[child]
                 if left_hash is None:
-                    if flag_bits.pop(0) == 0: # pre-calculated hash
-                        self.set_current_node(hashes.pop(0))
-                        self.up()
+                    flag_index += 1
+                    if flag_bits[flag_index - 1] == 0: # pre-calculated hash
+                        nodes[position] = hashes[hash_index]
+                        hash_index += 1
+                        depth -= 1
+                        index >>= 1
                     else:
-                        self.left()
-                elif self.right_exists():
-                    right_hash = self.get_right_node()
+                        depth += 1
+                        index *= 2
+                elif index * 2 + 1 < widths[depth + 1]:
+                    right_hash = nodes[child + 1]
                     if right_hash is None:
-                        self.right()
+                        depth += 1
+                        index = index * 2 + 1
                     else:
-                        self.set_current_node(merkle_parent(left_hash, right_hash))
-                        self.up()
+                        # identical siblings would allow a second tree with the same root
+                        if right_hash == left_hash:
+                            raise RuntimeError('duplicate hashes in the partial merkle tree')
+                        nodes[position] = merkle_parent(left_hash, right_hash)
+                        depth -= 1
+                        index >>= 1
                 else:
-                    self.set_current_node(merkle_parent(left_hash, left_hash))
-                    self.up()
-        if len(hashes) != 0:
-            raise RuntimeError(f'hashes not all consumed {len(hashes)}')
-        for flag_bit in flag_bits:
+                    nodes[position] = merkle_parent(left_hash, left_hash)
+                    depth -= 1
+                    index >>= 1
+        except IndexError:
+            raise RuntimeError('not enough hashes or flag bits for the tree')
+        self.current_depth = max(depth, 0)
+        self.current_index = index
+        self.matched = matched
+        if hash_index != len(hashes):
+            raise RuntimeError(f'hashes not all consumed {len(hashes) - hash_index}')
+        for flag_bit in flag_bits[flag_index:]:
             if flag_bit != 0:
                 raise RuntimeError('flag bits not all consumed')
                 
@@ -120,12 +188,14 @@ class MerkleBlock:
         self.total = total
         self.hashes = hashes
         self.flags = flags
+        self.matched_txids = None # txids flagged as matches, set by is_valid
         
     def __repr__(self):
         result = f'{self.total}'
         for h in self.hashes:
             result += f'\t{h.hex()}\n'
-        result += f'self.flags.hex()'
+        result += f'{self.flags.hex()}'
+        return result
         
     @classmethod
     def parse(cls, s):
@@ -143,50 +213,147 @@ class MerkleBlock:
         flags_length = read_varint(s)
         flags = s.read(flags_length)
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce, total, hashes, flags)
+    
+    def serialize(self):
+        result = int_to_little_endian(self.version, 4)
+        result += self.prev_block[::-1]
+        result += self.merkle_root[::-1]
+        result += int_to_little_endian(self.timestamp, 4)
+        result += self.bits
+        result += self.nonce
+        result += int_to_little_endian(self.total, 4)
+        result += encode_varint(len(self.hashes))
+        result += b''.join(h[::-1] for h in self.hashes)
+        result += encode_varint(len(self.flags))
+        result += self.flags
+        return result
         
-    def is_valid(self):
-        mktree = MerkleTree(self.total)
+    def is_valid(self, tree=None):
+        '''
+        True if the partial merkle tree hashes up to merkle_root, False for a
+        wrong root or a malformed tree. matched_txids is set when valid
+        tree : MerkleTree of the same total to reuse (reset here)
+        '''
+        if tree is None:
+            if self.total < 1:
+                return False
+            tree = MerkleTree(self.total)
+        else:
+            tree.reset()
         flag_bits = bytes_to_bit_field(self.flags)
         hashes = [h[::-1] for h in self.hashes]
-        mktree.populate_tree(flag_bits, hashes)
-        return self.merkle_root == mktree.root()[::-1]
-        
+        try:
+            tree.populate_tree(flag_bits, hashes)
+        except RuntimeError:
+            return False
+        if self.merkle_root != tree.root()[::-1]:
+            return False
+        self.matched_txids = [h[::-1] for h in tree.matched]
+        return True
 
 
-# In[11]:
+def verify_many(merkleblocks):
+    '''validity of every MerkleBlock, trees are allocated once per distinct total'''
+    trees = {}
+    result = []
+    for mb in merkleblocks:
+        if mb.total < 1:
+            result.append(False)
+            continue
+        tree = trees.get(mb.total)
+        if tree is None:
+            tree = trees[mb.total] = MerkleTree(mb.total)
+        result.append(mb.is_valid(tree))
+    return result
 
 
-
-from helper import merkle_parent_level
-hex_hashes = [
-    "9745f7173ef14ee4155722d1cbf13304339fd00d900b759c6f9d58579b5765fb",
-    "5573c8ede34936c29cdfdfe743f7f5fdfbd4f54ba0705259e62f39917065cb9b",
-    "82a02ecbb6623b4274dfcab82b336dc017a27136e08521091e443e62582e8f05",
-    "507ccae5ed9b340363a0e6d765af148be9cb1c8766ccc922f83e4ae681658308",
-    "a7a4aec28e7162e1e9ef33dfa30f0bc0526e6cf4b11a576f6c5de58593898330",
-    "bb6267664bd833fd9fc82582853ab144fece26b7a8a5bf328f8a059445b59add",
-    "ea6d7ac1ee77fbacee58fc717b990c4fcccf1b19af43103c090f601677fd8836",
-    "457743861de496c429912558a106b810b0507975a49773228aa788df40730d41",
-    "7688029288efc9e9a0011c960a6ed9e5466581abf3e3a6c26ee317461add619a",
-    "b1ae7f15836cb2286cdd4e2c37bf9bb7da0a2846d06867a429f654b2e7f383c9",
-    "9b74f89fa3f93e71ff2c241f32945d877281a6a50a6bf94adac002980aafe5ab",
-    "b3a92b5b255019bdaf754875633c2de9fec2ab03e6b8ce669d07cb5b18804638",
-    "b5c0b915312b9bdaedd2b86aa2d0f8feffc73a2d37668fd9010179261e25e263",
-    "c9d52c5cb1e557b92c84c52e7c4bfbce859408bedffc8a5560fd6e35e10b8800",
-    "c555bc5fc3bc096df0a0c9532f07640bfb76bfe4fc1ace214b8b228a1297a4c2",
-    "f9dbfafc3af3400954975da24eb325e326960a25b87fffe23eef3e7ed2fb610e",
-]
-tree = MerkleTree(len(hex_hashes))
-tree.nodes[4] = [bytes.fromhex(h) for h in hex_hashes]
-tree.nodes[3] = merkle_parent_level(tree.nodes[4])
-tree.nodes[2] = merkle_parent_level(tree.nodes[3])
-tree.nodes[1] = merkle_parent_level(tree.nodes[2])
-tree.nodes[0] = merkle_parent_level(tree.nodes[1])
-print(tree)
-
-
-# In[ ]:
+class MerkleBlockBuilder:
+    '''
+    Produces the hashes and flag bits of MerkleBlock proofs for one block
+    Every level of the tree is hashed once here, a proof then only walks
+    the branches leading to its matches
+    '''
+    
+    def __init__(self, tx_hashes):
+        '''tx_hashes : txids of the block in order (as Block.tx_hashes)'''
+        self.levels = merkle_levels([h[::-1] for h in tx_hashes]) # leaves first, root last
+        self.total = len(self.levels[0])
+        self.positions = {h: i for i, h in enumerate(self.levels[0])}
+        self.height = len(self.levels) - 1
+    
+    def root(self):
+        '''merkle root (little endian)'''
+        return self.levels[-1][0]
+    
+    def filter_matches(self, bloom_filter):
+        '''txids of the block whose hash is in bloom_filter'''
+        return [h[::-1] for h in self.levels[0] if bloom_filter.contains(h)]
+    
+    def proof(self, matched):
+        '''
+        (hashes, flags) of the partial merkle tree proving matched
+        matched : txids (as Block.tx_hashes) or a BloomFilter, txids that are
+        not in the block are ignored
+        '''
+        if hasattr(matched, 'contains'):
+            matched = self.filter_matches(matched)
+        positions = self.positions
+        # (height, position) of every node with a match below it
+        marked = set()
+        for txid in matched:
+            index = positions.get(txid[::-1])
+            if index is None:
+                continue
+            for height in range(self.height + 1):
+                node = (height, index >> height)
+                if node in marked:
+                    break
+                marked.add(node)
+        levels = self.levels
+        flag_bits = []
+        hashes = []
+        stack = [(self.height, 0)]
+        while stack:
+            height, position = stack.pop()
+            parent_of_match = (height, position) in marked
+            flag_bits.append(1 if parent_of_match else 0)
+            if height == 0 or not parent_of_match:
+                hashes.append(levels[height][position][::-1])
+                continue
+            # right pushed first so the left subtree comes out first (depth first order)
+            if position * 2 + 1 < len(levels[height - 1]):
+                stack.append((height - 1, position * 2 + 1))
+            stack.append((height - 1, position * 2))
+        flag_bits += [0] * (-len(flag_bits) % 8)
+        return hashes, bit_field_to_bytes(flag_bits)
+    
+    def merkle_block(self, block, matched):
+        '''
+        MerkleBlock of block (whose txids built this tree) proving matched
+        a BloomFilter is matched against the whole txs (BIP37) when block has them
+        '''
+        if hasattr(matched, 'match_block') and block.txs is not None:
+            matched = matched.match_block(block)
+        hashes, flags = self.proof(matched)
+        return MerkleBlock(block.version, block.prev_block_hash, block.merkle_root, block.timestamp,
+                           block.bits, block.nonce, self.total, hashes, flags)
 
 
+_builders = OrderedDict() # block hash -> MerkleBlockBuilder, least recently used first
 
 
+def merkle_block(block, matched):
+    '''
+    MerkleBlock of block proving matched (txids or a BloomFilter). The tree
+    levels of the last BUILDER_CACHE_SIZE blocks are kept for the next proofs
+    '''
+    block_hash = block.hash256()
+    builder = _builders.get(block_hash)
+    if builder is None:
+        builder = MerkleBlockBuilder(block.tx_hashes)
+        _builders[block_hash] = builder
+        if len(_builders) > BUILDER_CACHE_SIZE:
+            _builders.popitem(last=False)
+    else:
+        _builders.move_to_end(block_hash)
+    return builder.merkle_block(block, matched)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Merkle inclusion proofs ("tx X is in block Y") served from stored tree levels
+# Every level of a block's merkle tree is kept back to back in one buffer of
+# 32 byte hashes (leaves first, root last), persisted as <block hash>.merkle
+# files, and the most used blocks stay in memory.
+
+import os
+
+from collections import OrderedDict
+
+from helper import (
+    int_to_little_endian,
+    little_endian_to_int,
+    merkle_levels,
+    merkle_parent,
+)
+
+DEFAULT_CACHE_SIZE = 64 # blocks kept in memory by MerkleIndex
+
+
+def level_widths(total):
+    '''width of every level of a merkle tree of total leaves, leaves first'''
+    widths = [total]
+    while widths[-1] > 1:
+        widths.append((widths[-1] + 1) // 2)
+    return widths
+
+
+class MerkleLevels:
+
+    __slots__ = ('total', 'buffer', 'widths', 'offsets', 'positions')
+
+    def __init__(self, total, buffer):
+        '''buffer : every level concatenated (little endian hashes, leaves first)'''
+        self.total = total
+        self.buffer = buffer
+        self.widths = level_widths(total)
+        self.offsets = []
+        offset = 0
+        for width in self.widths:
+            self.offsets.append(offset)
+            offset += width * 32
+        if offset != len(buffer):
+            raise RuntimeError(f'expected {offset} bytes of merkle levels, got {len(buffer)}')
+        self.positions = None # leaf -> index, built by the first index_of
+
+    def __repr__(self):
+        return f'MerkleLevels({self.total} txs, root {self.root()[::-1].hex()})'
+
+    @classmethod
+    def from_tx_hashes(cls, tx_hashes):
+        '''tx_hashes : txids of the block in order (as Block.tx_hashes)'''
+        levels = merkle_levels([h[::-1] for h in tx_hashes])
+        return cls(len(tx_hashes), b''.join(h for level in levels for h in level))
+
+    @classmethod
+    def from_block(cls, block):
+        return cls.from_tx_hashes(block.tx_hashes)
+
+    @classmethod
+    def parse(cls, s):
+        total = little_endian_to_int(s.read(4))
+        buffer = s.read(sum(level_widths(total)) * 32)
+        return cls(total, buffer)
+
+    def serialize(self):
+        return int_to_little_endian(self.total, 4) + self.buffer
+
+    def root(self):
+        '''merkle root (little endian)'''
+        return self.buffer[-32:]
+
+    def node(self, level, index):
+        offset = self.offsets[level] + index * 32
+        return self.buffer[offset:offset + 32]
+
+    def index_of(self, txid):
+        '''position of txid (as Tx.hash) in the block, None if absent'''
+        if self.positions is None:
+            buffer = self.buffer
+            # first occurrence wins, as a search from the start would
+            self.positions = {bytes(buffer[i:i + 32]): i // 32 for i in range(self.total * 32 - 32, -1, -32)}
+        return self.positions.get(bytes(txid[::-1]))
+
+    def branch(self, index):
+        '''sibling hashes (little endian) from the leaf at index up to the root'''
+        result = []
+        for level in range(len(self.widths) - 1):
+            sibling = index ^ 1
+            if sibling >= self.widths[level]:
+                sibling = index # last of an odd level pairs with itself
+            result.append(self.node(level, sibling))
+            index >>= 1
+        return result
+
+    def merkle_proof(self, txid):
+        '''(index, branch) proving txid, branch hashes as Tx.hash, None if txid is absent'''
+        index = self.index_of(txid)
+        if index is None:
+            return None
+        return index, [h[::-1] for h in self.branch(index)]
+
+
+def verify_merkle_proof(txid, index, branch, merkle_root):
+    '''True if branch (from merkle_proof) hashes txid at index up to merkle_root (as Block.merkle_root)'''
+    current = txid[::-1]
+    for sibling in branch:
+        sibling = sibling[::-1]
+        if index & 1:
+            current = merkle_parent(sibling, current)
+        else:
+            current = merkle_parent(current, sibling)
+        index >>= 1
+    return index == 0 and current[::-1] == merkle_root
+
+
+class MerkleIndex:
+    '''Merkle levels of many blocks on disk, the last cache_size used ones in memory'''
+
+    def __init__(self, directory, cache_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # block hash -> MerkleLevels, least recently used first
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f'MerkleIndex({self.directory}) : {len(self.cache)} blocks in memory'
+
+    def __contains__(self, block_hash):
+        return block_hash in self.cache or os.path.exists(self.path(block_hash))
+
+    def path(self, block_hash):
+        return os.path.join(self.directory, f'{block_hash.hex()}.merkle')
+
+    def remember(self, block_hash, levels):
+        self.cache[block_hash] = levels
+        self.cache.move_to_end(block_hash)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def add(self, block):
+        '''hashes the levels of block (parsed with txs or with tx_hashes) and stores them'''
+        levels = MerkleLevels.from_block(block)
+        block_hash = block.hash256()
+        if levels.root()[::-1] != block.merkle_root:
+            raise RuntimeError(f'tx hashes of {block_hash.hex()} do not match its merkle root')
+        with open(self.path(block_hash), 'wb') as f:
+            f.write(levels.serialize())
+        self.remember(block_hash, levels)
+        return levels
+
+    def get(self, block_hash):
+        '''MerkleLevels of a stored block, None if unknown'''
+        levels = self.cache.get(block_hash)
+        if levels is not None:
+            self.cache.move_to_end(block_hash)
+            return levels
+        path = self.path(block_hash)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            levels = MerkleLevels.parse(f)
+        self.remember(block_hash, levels)
+        return levels
+
+    def merkle_proof(self, block_hash, txid):
+        '''(index, branch) proving txid is in the block, None if block or tx is unknown'''
+        levels = self.get(block_hash)
+        if levels is None:
+            return None
+        return levels.merkle_proof(txid)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Nonce grinding for Block headers (meant for regtest-like low difficulty)
+# The sha256 state after the first 64 bytes of the header (midstate) is
+# computed once; each nonce only hashes the last 16 bytes from a copy of it.
+
+import hashlib
+import multiprocessing
+import os
+import queue
+import struct
+import time
+
+from helper import (
+    hash256,
+    int_to_little_endian,
+    merkle_root,
+)
+from script import script
+
+NONCE_SPACE = 2**32
+PROGRESS_INTERVAL = 0x10000 # nonces between progress reports / stop checks
+MAX_COINBASE_SCRIPT_SIZE = 100 # bytes (consensus limit)
+
+
+def grind(header, target, start=0, end=NONCE_SPACE, stop=None, progress=None):
+    '''
+    Searches nonces in [start, end) for header (at least the first 76 bytes)
+    Returns (nonce or None, number of hashes done)
+    stop : multiprocessing Event checked between batches
+    progress : queue that gets ('progress', hashes) after each batch
+    '''
+    midstate = hashlib.sha256(header[:64])
+    tail = header[64:76]
+    sha256 = hashlib.sha256
+    pack = struct.Struct('<I').pack
+    done = 0
+    for batch_start in range(start, end, PROGRESS_INTERVAL):
+        if stop is not None and stop.is_set():
+            break
+        batch_end = min(batch_start + PROGRESS_INTERVAL, end)
+        for nonce in range(batch_start, batch_end):
+            h = midstate.copy()
+            h.update(tail + pack(nonce))
+            if int.from_bytes(sha256(h.digest()).digest(), 'little') < target:
+                return nonce, done + nonce - batch_start + 1
+        done += batch_end - batch_start
+        if progress is not None:
+            progress.put(('progress', batch_end - batch_start))
+    return None, done
+
+
+def grind_worker(header, target, start, end, stop, results):
+    nonce, hashes = grind(header, target, start, end, stop, results)
+    if nonce is None:
+        results.put(('done', None))
+    else:
+        # hashes of the batch cut short (full batches were reported as progress)
+        partial = hashes - (hashes - 1) // PROGRESS_INTERVAL * PROGRESS_INTERVAL
+        results.put(('found', (nonce, partial)))
+
+
+class Miner:
+
+    def __init__(self, processes=None, logging=False):
+        self.processes = processes or os.cpu_count() or 1
+        self.logging = logging
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return f'Miner({self.processes} processes) : {self.hashes} hashes, {self.hashrate():.0f} H/s'
+
+    def hashrate(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.hashes / self.elapsed
+
+    def report(self, hashes, started):
+        elapsed = time.time() - started
+        if elapsed > 0:
+            print(f'{hashes} hashes in {elapsed:.1f}s, {hashes / elapsed:.0f} H/s')
+
+    def search(self, header, target, start=0, end=NONCE_SPACE):
+        '''nonce in [start, end) whose header hash is below target, None if there is none'''
+        started = time.time()
+        if self.processes == 1:
+            nonce, hashes = grind(header, target, start, end)
+            self.hashes += hashes
+            self.elapsed += time.time() - started
+            if self.logging:
+                self.report(hashes, started)
+            return nonce
+        context = multiprocessing.get_context()
+        stop = context.Event()
+        results = context.Queue()
+        step = -(-(end - start) // self.processes)
+        workers = []
+        for worker_start in range(start, end, step):
+            worker = context.Process(
+                target=grind_worker,
+                args=(header, target, worker_start, min(worker_start + step, end), stop, results))
+            worker.start()
+            workers.append(worker)
+        found = None
+        finished = 0 # workers that sent their last message
+        hashes = 0
+        last_report = started
+        try:
+            # every message is read before the workers are joined : a process
+            # with items still in its queue buffer does not exit, join would hang
+            while finished < len(workers):
+                try:
+                    kind, value = results.get(timeout=0.1)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        break # a worker died without its last message
+                    continue
+                if kind == 'progress':
+                    hashes += value
+                    if self.logging and time.time() - last_report >= 1:
+                        last_report = time.time()
+                        self.report(hashes, started)
+                    continue
+                finished += 1
+                if kind == 'found':
+                    nonce, partial = value
+                    hashes += partial
+                    if found is None:
+                        found = nonce
+                        stop.set()
+        except BaseException:
+            stop.set()
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+        self.hashes += hashes
+        self.elapsed += time.time() - started
+        if self.logging:
+            self.report(hashes, started)
+        return found
+
+    def mine(self, block, max_rolls=1000):
+        '''
+        Sets a valid nonce on block and returns it. When the nonce space runs out
+        the extranonce in the coinbase is rolled (block with txs) or else the timestamp
+        '''
+        target = block.target()
+        extranonce = 0
+        extranonce_index = None # position of the extranonce push, inserted on the first roll
+        for _ in range(max_rolls):
+            header = block.serialize()
+            nonce = self.search(header, target)
+            if nonce is not None:
+                block.nonce = int_to_little_endian(nonce, 4)
+                return block
+            if block.txs:
+                extranonce += 1
+                extranonce_index = roll_extranonce(block, extranonce, extranonce_index)
+            else:
+                block.timestamp += 1
+        raise RuntimeError(f'no valid nonce after {max_rolls} rolls')
+
+
+def roll_extranonce(block, extranonce, index=None):
+    '''
+    Sets the extranonce push of the coinbase script_sig and updates the merkle root
+    index : position of the push set by a previous roll, if None a push is inserted
+    after the height push (the other pushes are kept). Returns the position
+    '''
+    coinbase = block.txs[0]
+    tx_in = coinbase.tx_ins[0]
+    cmds = list(tx_in.script_sig.cmds)
+    extranonce_bytes = int_to_little_endian(extranonce, 8)
+    if index is None:
+        index = min(1, len(cmds))
+        cmds.insert(index, extranonce_bytes)
+    else:
+        cmds[index] = extranonce_bytes
+    script_sig = script(cmds)
+    if len(script_sig.raw_serialize()) > MAX_COINBASE_SCRIPT_SIZE:
+        raise RuntimeError(f'coinbase script_sig over {MAX_COINBASE_SCRIPT_SIZE} bytes with the extranonce')
+    tx_in.script_sig = script_sig
+    if block.tx_hashes is None:
+        block.tx_hashes = [tx.hash() for tx in block.txs]
+    block.tx_hashes[0] = hash256(coinbase.serialize())[::-1]
+    block.merkle_root = merkle_root([h[::-1] for h in block.tx_hashes])[::-1]
+    return index
+
+
+def mine(block, processes=None, logging=False):
+    return Miner(processes, logging).mine(block)
@@ -6,26 +6,42 @@
 
 import time
 import socket
+import struct
 
 from random import randint
 
 from io import BytesIO
 from helper import (
+    BufferReader,
     little_endian_to_int,
     int_to_little_endian,
     read_varint,
     hash256,
     encode_varint,)
 from block import Block
+from merkleblock import MerkleBlock
+from Tx import Tx
 
 MAINNET_NETWORK_MAGIC = b'\xf9\xbe\xb4\xd9'
 TESTNET_NETWORK_MAGIC = b'\x0b\x11\x09\x07'
+ENVELOPE_HEADER = struct.Struct('<4s12sI4s') # magic, command, payload length, checksum
+ENVELOPE_HEADER_SIZE = ENVELOPE_HEADER.size
+MAX_PAYLOAD_SIZE = 0x02000000 # larger lengths are treated as garbage (Bitcoin Core MAX_SIZE)
+IPV4_PREFIX = b'\x00' * 10 + b'\xff\xff' # IPv4-mapped IPv6 address
+
+# inventory types (inv / getdata)
+TX_DATA_TYPE = 1
+BLOCK_DATA_TYPE = 2
+FILTERED_BLOCK_DATA_TYPE = 3
+COMPACT_BLOCK_DATA_TYPE = 4
 
 class NetworkEnvelope:
     
-    def __init__(self, command, payload, testnet=False):
+    def __init__(self, command, payload, testnet=False, checksum=None):
         self.command = command # human-readable command, 12 bytes
-        self.payload = payload
+        self.payload = payload # bytes, or a memoryview from EnvelopeFramer
+        self.checksum = checksum # checksum still to verify (verify_checksum), None once checked
+        self._message = None # parsed payload, see message()
         if testnet:
             self.magic = TESTNET_NETWORK_MAGIC
         else:
@@ -63,8 +79,140 @@ class NetworkEnvelope:
         return result
     
     def stream(self):
-        return BytesIO(self.payload)
+        # reads straight from the payload, memoryview payloads are not copied
+        return BufferReader(self.payload)
+    
+    def message(self):
+        '''
+        Payload parsed by the class registered for the command (GenericMessage if
+        none is), on first call only : envelopes that are only routed or relayed
+        are never parsed
+        '''
+        if self._message is None:
+            message_class = MESSAGE_CLASSES.get(self.command)
+            if message_class is None:
+                self._message = GenericMessage(self.command, bytes(self.payload))
+            else:
+                self._message = message_class.parse(self.stream())
+        return self._message
+    
+    def verify_checksum(self):
+        '''checks a deferred checksum, True if it matches (or was checked already)'''
+        if self.checksum is None:
+            return True
+        if hash256(self.payload)[:4] != self.checksum:
+            return False
+        self.checksum = None
+        return True
     
+
+class EnvelopeFramer:
+    '''
+    Incremental envelope parser : feed() takes chunks as they arrive and
+    returns the complete envelopes. Envelopes inside a chunk keep a memoryview
+    of it as payload (chunks must not be modified after feed), an envelope
+    spanning chunks is copied once into a buffer of its exact size.
+    Bytes before a valid magic are skipped (resync) and envelopes with a bad
+    checksum are dropped. Payloads larger than checksum_limit are not hashed
+    here, their checksum is left for NetworkEnvelope.verify_checksum (which
+    can run in a thread, hashlib releases the GIL on large buffers)
+    '''
+    
+    def __init__(self, testnet=False, checksum_limit=None, max_payload=MAX_PAYLOAD_SIZE):
+        self.testnet = testnet
+        self.magic = TESTNET_NETWORK_MAGIC if testnet else MAINNET_NETWORK_MAGIC
+        self.checksum_limit = checksum_limit
+        self.max_payload = max_payload
+        self.head = b'' # start of an envelope whose header is not complete yet
+        self.partial = None # envelope of known size being filled
+        self.filled = 0
+        self.skipped = 0 # bytes dropped while looking for magic
+        self.bad_checksums = 0
+        
+    def __repr__(self):
+        return f'EnvelopeFramer : {self.skipped} bytes skipped, {self.bad_checksums} bad checksums'
+    
+    def pending(self):
+        '''bytes received but not framed yet'''
+        return len(self.head) + self.filled
+    
+    def envelope(self, command, checksum, payload):
+        '''NetworkEnvelope of a complete frame, None if its checksum is bad'''
+        envelope = NetworkEnvelope(command.strip(b'\x00'), payload, self.testnet, checksum)
+        if self.checksum_limit is None or len(payload) <= self.checksum_limit:
+            if not envelope.verify_checksum():
+                self.bad_checksums += 1
+                return None
+        return envelope
+    
+    def feed(self, data):
+        '''data : bytes received, returns the envelopes completed by it'''
+        result = []
+        position = 0
+        if self.partial is not None:
+            take = min(len(self.partial) - self.filled, len(data))
+            self.partial[self.filled:self.filled + take] = memoryview(data)[:take]
+            self.filled += take
+            if self.filled < len(self.partial):
+                return result
+            _, command, _, checksum = ENVELOPE_HEADER.unpack_from(self.partial)
+            envelope = self.envelope(command, checksum, memoryview(self.partial)[ENVELOPE_HEADER_SIZE:])
+            if envelope is not None:
+                result.append(envelope)
+            self.partial = None
+            self.filled = 0
+            position = take
+        if self.head:
+            # header cut between chunks, join it with the rest of this chunk
+            data = self.head + data[position:]
+            self.head = b''
+            position = 0
+        elif not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        view = memoryview(data)
+        end = len(data)
+        magic = self.magic
+        while end - position >= ENVELOPE_HEADER_SIZE:
+            if data[position:position + 4] != magic:
+                found = data.find(magic, position + 1)
+                if found == -1:
+                    # the last 3 bytes may start a magic
+                    found = end - 3
+                self.skipped += found - position
+                position = found
+                continue
+            _, command, length, checksum = ENVELOPE_HEADER.unpack_from(data, position)
+            if length > self.max_payload:
+                self.skipped += 1
+                position += 1
+                continue
+            size = ENVELOPE_HEADER_SIZE + length
+            if end - position < size:
+                self.partial = bytearray(size)
+                self.partial[:end - position] = view[position:end]
+                self.filled = end - position
+                return result
+            envelope = self.envelope(command, checksum, view[position + ENVELOPE_HEADER_SIZE:position + size])
+            if envelope is not None:
+                result.append(envelope)
+            position += size
+        self.head = bytes(data[position:end])
+        return result
+
+
+def serialize_ip(ip):
+    '''16 byte network address of a 4 byte IPv4 or 16 byte IPv6 address'''
+    if len(ip) == 16:
+        return ip
+    return IPV4_PREFIX + ip
+
+
+def parse_ip(raw):
+    if raw[:12] == IPV4_PREFIX:
+        return raw[12:]
+    return raw
+
+
 class VersionMessage:
     
     command = b'version'
@@ -101,10 +249,10 @@ class VersionMessage:
         result += int_to_little_endian(self.services, 8)
         result += int_to_little_endian(self.timestamp, 8)
         result += int_to_little_endian(self.receiver_services, 8)
-        result += b'\x00' * 10 + b'\xff\xff' + self.receiver_ip
+        result += serialize_ip(self.receiver_ip)
         result += self.receiver_port.to_bytes(2, 'big')
         result += int_to_little_endian(self.sender_services, 8)
-        result += b'\x00' * 10 + b'\xff\xff' + self.sender_ip
+        result += serialize_ip(self.sender_ip)
         result += self.sender_port.to_bytes(2, 'big')
         result += self.nonce
         result += encode_varint(len(self.user_agent))
@@ -116,6 +264,25 @@ class VersionMessage:
             result += b'\x00'
         return result
     
+    @classmethod
+    def parse(cls, s):
+        version = little_endian_to_int(s.read(4))
+        services = little_endian_to_int(s.read(8))
+        timestamp = little_endian_to_int(s.read(8))
+        receiver_services = little_endian_to_int(s.read(8))
+        receiver_ip = parse_ip(s.read(16))
+        receiver_port = int.from_bytes(s.read(2), 'big')
+        sender_services = little_endian_to_int(s.read(8))
+        sender_ip = parse_ip(s.read(16))
+        sender_port = int.from_bytes(s.read(2), 'big')
+        nonce = s.read(8)
+        user_agent = s.read(read_varint(s))
+        latest_block = little_endian_to_int(s.read(4))
+        # relay is missing before protocol version 70001
+        relay = s.read(1) == b'\x01'
+        return cls(version, services, timestamp, receiver_services, receiver_ip, receiver_port,
+                   sender_services, sender_ip, sender_port, nonce, user_agent, latest_block, relay)
+    
 class VerAckMessage:
     command = b'verack'
     
@@ -150,6 +317,7 @@ class PongMessage:
     def __init__(self, nonce):
         self.nonce = nonce
 
+    @classmethod
     def parse(cls, s):
         nonce = s.read(8)
         return cls(nonce)
@@ -194,7 +362,10 @@ class SimpleNode:
                 self.send(VerAckMessage())
             elif command == PingMessage.command:
                 self.send(PongMessage(envelope.payload))
-        return command_to_class[command].parse(envelope.stream())
+        message_class = command_to_class[command]
+        if MESSAGE_CLASSES.get(command) is message_class:
+            return envelope.message()
+        return message_class.parse(envelope.stream())
     
     def handshake(self):
         version = VersionMessage()
@@ -205,12 +376,20 @@ class GetHeadersMessage:
     command = b'getheaders'
     
     def __init__(self, version=70015, num_hashes=1,
-                start_block=None, end_block=None):
+                start_block=None, end_block=None, locator=None):
+        '''
+        locator : block hashes, most recent first (as HeaderStore.locator), it
+        defaults to [start_block]. num_hashes is len(locator)
+        '''
         self.version = version
-        self.num_hashes = num_hashes
-        if start_block is None:
-            raise RuntimeError('a start block is required')
-        self.start_block = start_block
+        if locator is None:
+            if start_block is None:
+                raise RuntimeError('a start block is required')
+            locator = [start_block]
+        self.locator = list(locator)
+        self.num_hashes = len(self.locator)
+        # None for an empty locator (headers from end_block only)
+        self.start_block = self.locator[0] if self.locator else None
         if end_block is None:
             self.end_block = b'\x00' * 32
         else:
@@ -218,11 +397,20 @@ class GetHeadersMessage:
             
     def serialize(self):
         result = int_to_little_endian(self.version, 4)
-        result += encode_varint(self.num_hashes)
-        result += self.start_block[::-1]
+        result += encode_varint(len(self.locator))
+        for block_hash in self.locator:
+            result += block_hash[::-1]
         result += self.end_block[::-1]
         return result
     
+    @classmethod
+    def parse(cls, s):
+        version = little_endian_to_int(s.read(4))
+        num_hashes = read_varint(s)
+        locator = [s.read(32)[::-1] for _ in range(num_hashes)]
+        end_block = s.read(32)[::-1]
+        return cls(version, end_block=end_block, locator=locator)
+    
 class HeadersMessage:
     command = b'headers'
     
@@ -239,6 +427,12 @@ class HeadersMessage:
             if num_txs != 0:
                 raise RuntimeError('num of txs not 0')
         return cls(blocks)
+    
+    def serialize(self):
+        result = encode_varint(len(self.blocks))
+        for block in self.blocks:
+            result += block.serialize() + b'\x00'
+        return result
        
 
 class GenericMessage:
@@ -247,21 +441,84 @@ class GenericMessage:
         self.command = command
         self.payload = payload
         
+    @classmethod
+    def parse(cls, s, command=b''):
+        return cls(command, s.read())
+        
     def serialize(self):
         return self.payload
     
-class GetDataMessage:
-    command = b'getdata'
+
+class InvMessage:
+    command = b'inv'
     
-    def __init__(self):
-        self.data = []
+    def __init__(self, data=None):
+        self.data = [] if data is None else data # (data type, identifier) pairs
+        
+    def __repr__(self):
+        return f'{self.command.decode()}: {len(self.data)} items'
         
     def add_data(self, data_type, identifier):
         self.data.append((data_type, identifier))
         
+    @classmethod
+    def parse(cls, s):
+        data = []
+        for _ in range(read_varint(s)):
+            data_type = little_endian_to_int(s.read(4))
+            data.append((data_type, s.read(32)[::-1]))
+        return cls(data)
+        
     def serialize(self):
         result = encode_varint(len(self.data))
         for data_type, identifier in self.data:
             result += int_to_little_endian(data_type, 4)
             result += identifier[::-1]
-        return result
\ No newline at end of file
+        return result
+    
+
+class GetDataMessage(InvMessage):
+    command = b'getdata'
+    
+
+class TxMessage:
+    command = b'tx'
+    
+    def __init__(self, tx):
+        self.tx = tx
+        
+    @classmethod
+    def parse(cls, s):
+        return cls(Tx.parse(s))
+        
+    def serialize(self):
+        return self.tx.serialize_segwit()
+    
+
+class BlockMessage:
+    command = b'block'
+    
+    def __init__(self, block):
+        self.block = block # parsed with its txs
+        
+    @classmethod
+    def parse(cls, s):
+        return cls(Block.parse(s, include_txs=True, keep_raw=True))
+        
+    def serialize(self):
+        return self.block.serialize() + self.block.serialize_txs()
+
+
+# command -> class with parse(s) and serialize(), used by NetworkEnvelope.message
+MESSAGE_CLASSES = {}
+
+
+def register_message(message_class):
+    MESSAGE_CLASSES[message_class.command] = message_class
+    return message_class
+
+
+for message_class in (VersionMessage, VerAckMessage, PingMessage, PongMessage,
+                      GetHeadersMessage, HeadersMessage, InvMessage, GetDataMessage,
+                      TxMessage, BlockMessage, MerkleBlock):
+    register_message(message_class)
@@ -5,6 +5,8 @@
 
 
 import hashlib
+
+from functools import lru_cache
 from helper import (
     hash160,
     hash256,
@@ -14,6 +16,9 @@ from ecc import (
     S256Point,
     Signature,
 )
+from sigcache import SIG_CACHE
+
+SEC_PARSE_CACHE_SIZE = 4096
 
 def encode_num(num):
     if num == 0:
@@ -52,42 +57,119 @@ def op_0(stack):
     stack.append(encode_num(0))
     return True
 
+def op_1(stack):
+    stack.append(encode_num(1))
+    return True
+
+def op_2(stack):
+    stack.append(encode_num(2))
+    return True
+
+def op_3(stack):
+    stack.append(encode_num(3))
+    return True
+
+def op_4(stack):
+    stack.append(encode_num(4))
+    return True
+
+def op_5(stack):
+    stack.append(encode_num(5))
+    return True
+
+def op_6(stack):
+    stack.append(encode_num(6))
+    return True
+
+def op_7(stack):
+    stack.append(encode_num(7))
+    return True
+
+def op_8(stack):
+    stack.append(encode_num(8))
+    return True
+
+def op_9(stack):
+    stack.append(encode_num(9))
+    return True
+
+def op_10(stack):
+    stack.append(encode_num(10))
+    return True
+
+def op_11(stack):
+    stack.append(encode_num(11))
+    return True
+
+def op_12(stack):
+    stack.append(encode_num(12))
+    return True
+
+def op_13(stack):
+    stack.append(encode_num(13))
+    return True
+
+def op_14(stack):
+    stack.append(encode_num(14))
+    return True
+
+def op_15(stack):
+    stack.append(encode_num(15))
+    return True
+
+def op_16(stack):
+    stack.append(encode_num(16))
+    return True
+
 def op_dup(stack):
-    if len(stack) < 0:
+    if len(stack) < 1:
         return False
     stack.append(stack[-1])
     return True
 
 def op_hash256(stack):
-    if len(stack) < 0:
+    if len(stack) < 1:
         return False
     element = stack.pop()
     stack.append(hash256(element))
     return True
 
 def op_hash160(stack):
-    if len(stack) < 0:
+    if len(stack) < 1:
         return False
     element = stack.pop()
     stack.append(hash160(element))
     return True
 
+@lru_cache(maxsize=SEC_PARSE_CACHE_SIZE)
+def parse_sec(sec):
+    '''S256Point.parse shared by the signature ops (pubkeys repeat across inputs)'''
+    return S256Point.parse(sec)
+
 def op_checksig(stack, z):
     if len(stack) < 2:
         return False
     pub_sec = stack.pop()
     sig_der = stack.pop()[:-1] # except hash_type
+    # verified before, skip parsing and the ECDSA math
+    if SIG_CACHE.contains(z, pub_sec, sig_der):
+        stack.append(encode_num(1))
+        return True
     try:
-        pub_point = S256Point.parse(pub_sec)
+        pub_point = parse_sec(pub_sec)
         sig = Signature.parse(sig_der)
     except (ValueError, SyntaxError) as e:
         return False
     if pub_point.verify(z, sig):
+        SIG_CACHE.add(z, pub_sec, sig_der)
         stack.append(encode_num(1))
     else:
         stack.append(encode_num(0))
     return True
 
+def op_checksigverify(stack, z):
+    return op_checksig(stack, z) and op_verify(stack)
+
 def op_equal(stack):
     if len(stack) < 2:
         return False
@@ -110,6 +192,19 @@ def op_verify(stack):
 def op_equalverify(stack):
     return op_equal(stack) and op_verify(stack)
     
+def matches_recovered(sec, recovered):
+    '''True if sec encodes one of the recovered points, None if sec is not canonical'''
+    if len(sec) == 33 and sec[0] in (2, 3):
+        compressed = True
+    elif len(sec) == 65 and sec[0] == 4:
+        compressed = False
+    else:
+        return None
+    for point in recovered:
+        if point.sec(compressed) == sec:
+            return True
+    return False
+
 def op_checkmultisig(stack, z):
     # m of n multi-sig
     if len(stack) < 1:
@@ -127,24 +222,68 @@ def op_checkmultisig(stack, z):
     for _ in range(m):
         der_signatures.append(stack.pop()[:-1])
     stack.pop() # Off-by-One bug
+    # back to script order
+    sec_pubkeys.reverse()
+    der_signatures.reverse()
     try:
-        pubPoints = [S256Point.parse(sec) for sec in sec_pubkeys]
         sigs = [Signature.parse(der) for der in der_signatures]
-        for sig in sigs:
-            if len(pubPoints) == 0:
-                return False
-            while pubPoints:
-                pubPoint = pubPoints.pop(0)
-                if pubPoint.verify(z, sig):
-                    break
-        stack.append(encode_num(1))
     except (ValueError, SyntaxError):
         return False
+    # signatures match pubkeys in order, each pubkey is tried once
+    key_index = 0
+    for sig_index, sig in enumerate(sigs):
+        der = der_signatures[sig_index]
+        recovered = None
+        while True:
+            # fail as soon as the remaining pubkeys cannot cover the remaining sigs
+            if m - sig_index > n - key_index:
+                stack.append(encode_num(0))
+                return True
+            sec = sec_pubkeys[key_index]
+            key_index += 1
+            if SIG_CACHE.contains(z, sec, der):
+                break
+            # more than one candidate pubkey left for this sig : recover the
+            # pubkeys from (z, sig) once and compare, instead of verifying each pair
+            if recovered is None and (n - key_index) - (m - sig_index - 1) > 0:
+                recovered = S256Point.recover(z, sig)
+            if recovered is not None:
+                matched = matches_recovered(sec, recovered)
+            else:
+                matched = None
+            if matched is None:
+                try:
+                    matched = parse_sec(sec).verify(z, sig)
+                except (ValueError, SyntaxError, IndexError): # bad pubkey never matches
+                    matched = False
+            if matched:
+                SIG_CACHE.add(z, sec, der)
+                break
+    stack.append(encode_num(1))
     return True
 
+def op_checkmultisigverify(stack, z):
+    return op_checkmultisig(stack, z) and op_verify(stack)
+
 
 OP_CODE_FUNCTIONS = {
     0: op_0,
+    81: op_1,
+    82: op_2,
+    83: op_3,
+    84: op_4,
+    85: op_5,
+    86: op_6,
+    87: op_7,
+    88: op_8,
+    89: op_9,
+    90: op_10,
+    91: op_11,
+    92: op_12,
+    93: op_13,
+    94: op_14,
+    95: op_15,
+    96: op_16,
     105: op_verify,
     118: op_dup,
     135: op_equal,
@@ -152,10 +291,29 @@ OP_CODE_FUNCTIONS = {
     169: op_hash160,
     170: op_hash256,
     172: op_checksig,
+    173: op_checksigverify,
+    174: op_checkmultisig,
+    175: op_checkmultisigverify,
 }
 
 OP_CODE_NAMES = {
     0: 'OP_0',
+    81: 'OP_1',
+    82: 'OP_2',
+    83: 'OP_3',
+    84: 'OP_4',
+    85: 'OP_5',
+    86: 'OP_6',
+    87: 'OP_7',
+    88: 'OP_8',
+    89: 'OP_9',
+    90: 'OP_10',
+    91: 'OP_11',
+    92: 'OP_12',
+    93: 'OP_13',
+    94: 'OP_14',
+    95: 'OP_15',
+    96: 'OP_16',
     105: 'OP_VERIFY',
     118: 'OP_DUP',
     135: 'OP_EQUAL',
@@ -163,5 +321,8 @@ OP_CODE_NAMES = {
     169: 'OP_HASH160',
     170: 'OP_HASH256',
     172: 'OP_CHECKSIG',
+    173: 'OP_CHECKSIGVERIFY',
+    174: 'OP_CHECKMULTISIG',
+    175: 'OP_CHECKMULTISIGVERIFY',
 }
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Opt-in instrumentation of the script interpreter
+#   PROFILER.enable() ... PROFILER.report()
+# When disabled the original op functions are in place, so the only cost
+# is one attribute check per evaluate / evaluate_spend call.
+
+import heapq
+
+from time import perf_counter
+
+from op import OP_CODE_FUNCTIONS, OP_CODE_NAMES
+
+SLOWEST_SCRIPTS = 10 # number of slowest scripts kept
+
+
+class ScriptProfiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.originals = {}
+        self.op_stats = {} # op code -> [count, seconds], shared with the wrapped ops
+        self.reset()
+
+    def __repr__(self):
+        state = 'enabled' if self.enabled else 'disabled'
+        return f'ScriptProfiler({state}) : {self.script_count} scripts'
+
+    def reset(self):
+        for stats in self.op_stats.values():
+            stats[0] = 0
+            stats[1] = 0.0
+        self.spend_stats = {} # spend type -> [count, seconds]
+        self.max_stack_depth = 0
+        self.script_count = 0
+        self.script_bytes = 0
+        self.max_script_size = 0
+        self.slowest = [] # min heap of (seconds, counter, size, script hex)
+        self.counter = 0
+
+    def enable(self):
+        '''wrap every op function (OP_CODE_FUNCTIONS and the compiled dispatch table)'''
+        if self.enabled:
+            return
+        for code, operation in OP_CODE_FUNCTIONS.items():
+            self.originals[code] = operation
+            OP_CODE_FUNCTIONS[code] = self.wrap(code, operation)
+        self.enabled = True
+        self.refresh_dispatch()
+
+    def disable(self):
+        '''put the original op functions back'''
+        if not self.enabled:
+            return
+        OP_CODE_FUNCTIONS.update(self.originals)
+        self.originals = {}
+        self.enabled = False
+        self.refresh_dispatch()
+
+    def refresh_dispatch(self):
+        # imported here, script imports this module
+        import script
+        script.DISPATCH = script.build_dispatch_table()
+
+    def wrap(self, code, operation):
+        stats = self.op_stats.setdefault(code, [0, 0.0])
+
+        def instrumented(stack, *args):
+            start = perf_counter()
+            try:
+                return operation(stack, *args)
+            finally:
+                stats[0] += 1
+                stats[1] += perf_counter() - start
+                if len(stack) > self.max_stack_depth:
+                    self.max_stack_depth = len(stack)
+        return instrumented
+
+    def record_script(self, size, seconds, raw):
+        self.script_count += 1
+        self.script_bytes += size
+        if size > self.max_script_size:
+            self.max_script_size = size
+        self.counter += 1
+        item = (seconds, self.counter, size, raw[:64].hex())
+        if len(self.slowest) < SLOWEST_SCRIPTS:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def profile_evaluate(self, script, z):
+        '''script.evaluate with timing and size recording'''
+        try:
+            raw = script.raw_serialize() if script.raw is None else bytes(script.raw)
+        except ValueError: # element too long to serialize
+            raw = b''
+        start = perf_counter()
+        result = script.evaluate_program(z)
+        self.record_script(len(raw), perf_counter() - start, raw)
+        return result
+
+    def profile_spend(self, evaluate_spend, script_sig, script_lock, z):
+        '''evaluate_spend timed per spend type of the script_lock'''
+        if script_lock.is_p2pkh_script_lock():
+            kind = 'p2pkh'
+        elif script_lock.is_p2sh_script_lock():
+            kind = 'p2sh'
+        else:
+            kind = 'non-standard'
+        stats = self.spend_stats.setdefault(kind, [0, 0.0])
+        start = perf_counter()
+        result = evaluate_spend(script_sig, script_lock, z)
+        stats[0] += 1
+        stats[1] += perf_counter() - start
+        return result
+
+    def snapshot(self):
+        '''copy of the collected numbers'''
+        return {
+            'ops': {OP_CODE_NAMES.get(code, f'OP_[{code}]'): {'count': count, 'seconds': seconds}
+                    for code, (count, seconds) in self.op_stats.items() if count},
+            'spends': {kind: {'count': count, 'seconds': seconds}
+                       for kind, (count, seconds) in self.spend_stats.items()},
+            'max_stack_depth': self.max_stack_depth,
+            'script_count': self.script_count,
+            'script_bytes': self.script_bytes,
+            'max_script_size': self.max_script_size,
+            'slowest_scripts': [{'seconds': seconds, 'size': size, 'hex': hex_prefix}
+                                for seconds, _, size, hex_prefix in sorted(self.slowest, reverse=True)],
+        }
+
+    def report(self):
+        '''human-readable summary'''
+        snap = self.snapshot()
+        lines = [f'{"op":<24}{"count":>10}{"total(ms)":>12}{"avg(us)":>10}']
+        ops = sorted(snap['ops'].items(), key=lambda item: item[1]['seconds'], reverse=True)
+        for name, stats in ops:
+            avg = stats['seconds'] / stats['count'] * 1e6
+            lines.append(f'{name:<24}{stats["count"]:>10}{stats["seconds"] * 1e3:>12.2f}{avg:>10.1f}')
+        for kind, stats in snap['spends'].items():
+            lines.append(f'spend {kind}: {stats["count"]} in {stats["seconds"] * 1e3:.2f} ms')
+        if snap['script_count']:
+            average = snap['script_bytes'] / snap['script_count']
+            lines.append(f'scripts: {snap["script_count"]}, avg size {average:.1f} bytes, max size {snap["max_script_size"]} bytes')
+        lines.append(f'max stack depth: {snap["max_stack_depth"]}')
+        for item in snap['slowest_scripts']:
+            lines.append(f'slow script {item["seconds"] * 1e3:.2f} ms, {item["size"]} bytes: {item["hex"]}')
+        return '\n'.join(lines)
+
+
+PROFILER = ScriptProfiler()
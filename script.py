@@ -1,24 +1,380 @@
+from array import array
 from io import BytesIO
 from helper import (
     encode_varint,
+    hash160,
     little_endian_to_int,
     int_to_little_endian,
     read_varint,
     encode_varint,)
-from op import OP_CODE_FUNCTIONS, OP_CODE_NAMES
+from op import (
+    encode_num,
+    op_equal,
+    op_hash160,
+    op_verify,
+    OP_CODE_FUNCTIONS,
+    OP_CODE_NAMES,)
+from profiler import PROFILER
 
 def get_p2pkh_script_lock(h160):
     # OP_DUP, OP_HASH160, hash160 value, OP_EQUALVERIFY, OPCHECKSIG 
     return script([0x76, 0xa9, h160, 0x88, 0xac])
 
+def get_p2sh_script_lock(h160):
+    # OP_HASH160, hash160 value, OP_EQUAL
+    return script([0xa9, h160, 0x87])
+
+def is_p2pkh_cmds(cmds):
+    # OP_DUP + OP_HASH160 + hash160 + OP_EQUALVERIFY + OP_CHECKSIG
+    return len(cmds) == 5 and cmds[0] == 0x76 \
+        and cmds[1] == 0xa9 \
+        and type(cmds[2]) == bytes and len(cmds[2]) == 20 \
+        and cmds[3] == 0x88 and cmds[4] == 0xac
+
+def is_p2sh_cmds(cmds):
+    # OP_HASH160 + hash160 + OP_EQUAL
+    return len(cmds) == 3 and cmds[0] == 0xa9 \
+        and type(cmds[1]) == bytes and len(cmds[1]) == 20 \
+        and cmds[2] == 0x87
+
+def is_multisig_cmds(cmds):
+    # OP_m + n sec pubkeys + OP_n + OP_CHECKMULTISIG (1 <= m <= n <= 16)
+    if len(cmds) < 4 or cmds[-1] != 0xae:
+        return False
+    m, n = cmds[0], cmds[-2]
+    if type(m) != int or type(n) != int or not 0x51 <= m <= n <= 0x60:
+        return False
+    pubkeys = cmds[1:-2]
+    if len(pubkeys) != n - 0x50:
+        return False
+    for pubkey in pubkeys:
+        if type(pubkey) != bytes:
+            return False
+    return True
+
+def read_cmds(s, length):
+    '''reads length bytes of script from the stream and returns the cmds'''
+    cmds = []
+    count = 0
+    while count < length:
+        # 1~78 : element, else: op_command
+        current_byte = s.read(1)[0]
+        count += 1
+        # if element shorter than 76 byte,
+        if current_byte >= 1 and current_byte <= 75:
+            len_element = current_byte
+            cmds.append(s.read(len_element))
+            count += len_element
+            
+        # OP_PUSHDATA1 (76~255 bytes)
+        elif current_byte == 76:
+            len_element = little_endian_to_int(s.read(1))
+            cmds.append(s.read(len_element))
+            count += len_element + 1
+        
+        # OP_PUSHDATA2 (256~520 bytes)
+        elif current_byte == 77:
+            len_element = little_endian_to_int(s.read(2))
+            cmds.append(s.read(len_element))
+            count += len_element + 2
+        
+        # command
+        else:
+            op_code = current_byte
+            cmds.append(op_code)
+            
+    if count != length:
+        raise SyntaxError('parsing script failed')
+    return cmds
+
+def push_element(cmd):
+    '''
+    element pushed by cmd, None for op codes other than OP_0
+    OP_0 (as parsed) and b'' (as built in a list) are the same empty push
+    '''
+    if type(cmd) == bytes:
+        return cmd
+    if cmd == 0:
+        return b''
+    return None
+
+def execute(cmds, stack, z):
+    '''runs cmds (consumed) on the stack, returns False when the script fails'''
+    altstack = []
+    while len(cmds) > 0:
+        cmd = cmds.pop(0)
+        element = push_element(cmd)
+        # command (op_code)
+        if element is None:
+            operation = OP_CODE_FUNCTIONS.get(cmd)
+            if operation is None: # unsupported op_code
+                return False
+            
+            # categorize with respect to input for the operation
+            
+            # OP_IF, OP_NOTIF
+            if cmd in (99, 100):
+                if not operation(stack, cmds):
+                    return False
+            
+            # OP_TOALTSTACK, OPFROMALTSTACK
+            elif cmd in (107, 108):
+                if not operation(stack, altstack):
+                    return False
+            
+            # OP_CHECKSIG, OP_CHECKSIGVERIFY, OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY
+            elif cmd in range(172, 176):
+                if not operation(stack, z):
+                    return False
+            
+            # else OP_CODE
+            else:
+                if not operation(stack):
+                    return False
+        
+        # element
+        else:
+            stack.append(element)
+            # screening script hash type : OP_HASH160 + hash 160 value + OP_EQUAL
+            if len(cmds) == 3 and cmds[0] == 0xa9 \
+                and type(cmds[1]) == bytes and len(cmds[1]) == 20 \
+                and cmds[2] == 0x87:
+                cmds.pop()
+                h160 = cmds.pop()
+                cmds.pop()
+                if not op_hash160(stack):
+                    return False
+                stack.append(h160)
+                if not op_equal(stack):
+                    return False
+                if not op_verify(stack):
+                    return False
+                cmds.extend(read_cmds(BytesIO(element), len(element)))
+    return True
+
+def stack_result(stack):
+    '''final check of a script : top of the stack should be non-zero'''
+    if len(stack) == 0: # should not be empty
+        return False
+    
+    if stack.pop() == b'':  # 0 means fail
+        return False
+    
+    return True
+
+# pseudo op code for data pushes in compiled programs
+PUSH = 0x100
+# max number of compiled redeem scripts kept in REDEEM_PROGRAMS
+REDEEM_PROGRAM_CACHE_SIZE = 4096
+
+# Compiled script : op codes with push-data offsets into the raw script
+class Program:
+    
+    __slots__ = ('raw', 'ops', 'starts', 'ends', 'p2sh_at', 'generic')
+    
+    def __init__(self, raw):
+        self.raw = raw
+        self.ops = array('H')
+        self.starts = array('I')
+        self.ends = array('I')
+        i = 0
+        length = len(raw)
+        while i < length:
+            current_byte = raw[i]
+            i += 1
+            # OP_0 is the empty push (see push_element)
+            if current_byte <= 75:
+                start = i
+            # OP_PUSHDATA1
+            elif current_byte == 76:
+                start = i + 1
+                if start > length:
+                    raise SyntaxError('parsing script failed')
+                current_byte = raw[i]
+            # OP_PUSHDATA2
+            elif current_byte == 77:
+                start = i + 2
+                if start > length:
+                    raise SyntaxError('parsing script failed')
+                current_byte = little_endian_to_int(raw[i:start])
+            # command
+            else:
+                self.ops.append(current_byte)
+                self.starts.append(0)
+                self.ends.append(0)
+                continue
+            i = start + current_byte
+            if i > length:
+                raise SyntaxError('parsing script failed')
+            self.ops.append(PUSH)
+            self.starts.append(start)
+            self.ends.append(i)
+        # index of the push followed by OP_HASH160 <20 bytes> OP_EQUAL (p2sh), else -1
+        n = len(self.ops)
+        if n >= 4 and self.ops[n - 4] == PUSH and self.ops[n - 3] == 0xa9 \
+            and self.ops[n - 2] == PUSH and self.ends[n - 2] - self.starts[n - 2] == 20 \
+            and self.ops[n - 1] == 0x87:
+            self.p2sh_at = n - 4
+        else:
+            self.p2sh_at = -1
+        # OP_IF/OP_NOTIF need the remaining cmds, run those with the generic interpreter
+        self.generic = 99 in self.ops or 100 in self.ops
+        
+    def __len__(self):
+        return len(self.ops)
+    
+    def element(self, i):
+        return self.raw[self.starts[i]:self.ends[i]]
+    
+    def is_multisig(self):
+        # OP_m + n pushes + OP_n + OP_CHECKMULTISIG (1 <= m <= n <= 16)
+        ops = self.ops
+        n = len(ops)
+        if n < 4 or ops[-1] != 0xae or not 0x51 <= ops[0] <= ops[-2] <= 0x60:
+            return False
+        if n - 3 != ops[-2] - 0x50:
+            return False
+        for i in range(1, n - 2):
+            if ops[i] != PUSH:
+                return False
+        return True
+    
+    def run(self, stack, altstack, z):
+        '''runs the program on the stack, returns False when the script fails'''
+        if self.generic:
+            return execute(read_cmds(BytesIO(self.raw), len(self.raw)), stack, z)
+        raw = self.raw
+        ops = self.ops
+        starts = self.starts
+        ends = self.ends
+        p2sh_at = self.p2sh_at
+        dispatch = DISPATCH
+        for pc in range(len(ops)):
+            op = ops[pc]
+            if op == PUSH:
+                element = raw[starts[pc]:ends[pc]]
+                stack.append(element)
+                if pc == p2sh_at:
+                    if not op_hash160(stack):
+                        return False
+                    stack.append(raw[starts[pc + 2]:ends[pc + 2]])
+                    if not op_equal(stack):
+                        return False
+                    if not op_verify(stack):
+                        return False
+                    # continue with the redeem script
+                    return redeem_program(element).run(stack, altstack, z)
+            else:
+                operation = dispatch[op]
+                if operation is None: # unsupported op_code
+                    return False
+                if not operation(stack, altstack, z):
+                    return False
+        return True
+
+
+def build_dispatch_table():
+    '''op code indexed list of operations taking (stack, altstack, z)'''
+    table = [None] * 256
+    for code, operation in OP_CODE_FUNCTIONS.items():
+        # OP_IF, OP_NOTIF (programs containing them use the generic interpreter)
+        if code in (99, 100):
+            continue
+        # OP_TOALTSTACK, OPFROMALTSTACK
+        elif code in (107, 108):
+            table[code] = lambda stack, altstack, z, operation=operation: operation(stack, altstack)
+        # OP_CHECKSIG, OP_CHECKSIGVERIFY, OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY
+        elif code in range(172, 176):
+            table[code] = lambda stack, altstack, z, operation=operation: operation(stack, z)
+        else:
+            table[code] = lambda stack, altstack, z, operation=operation: operation(stack)
+    return table
+
+DISPATCH = build_dispatch_table()
+
+# raw redeem script -> Program
+REDEEM_PROGRAMS = {}
+
+def redeem_program(raw):
+    '''compiled redeem script, cached since popular redeem scripts repeat'''
+    program = REDEEM_PROGRAMS.get(raw)
+    if program is None:
+        program = Program(raw)
+        if len(REDEEM_PROGRAMS) >= REDEEM_PROGRAM_CACHE_SIZE:
+            # drop the oldest entry
+            del REDEEM_PROGRAMS[next(iter(REDEEM_PROGRAMS))]
+        REDEEM_PROGRAMS[raw] = program
+    return program
+
 class script:
+    # raw : serialized script (without the length varint) for raw-backed scripts, else None
+    # _program : compiled Program, built on the first evaluate
+    # _program_cmds : cmds _program was compiled from (list-backed scripts), the
+    # list returned by cmds can be edited in place
+    __slots__ = ('_cmds', 'raw', '_program', '_program_cmds')
+    
     # do not include logger
     def __init__(self, cmds=None):
         if cmds is None:
-            self.cmds = []
+            self._cmds = []
         else:
-            self.cmds = cmds
-            
+            self._cmds = cmds
+        self.raw = None
+        self._program = None
+        self._program_cmds = None
+    
+    @classmethod
+    def from_raw(cls, raw):
+        '''
+        script that keeps only its raw bytes, cmds are decoded on every access
+        into a tuple : edit it by assigning cmds (which drops raw)
+        '''
+        result = cls.__new__(cls)
+        result._cmds = None
+        result.raw = raw
+        result._program = None
+        result._program_cmds = None
+        return result
+    
+    @property
+    def cmds(self):
+        if self.raw is None:
+            return self._cmds
+        # not cached to keep raw-backed scripts small, a tuple so that
+        # in-place edits fail instead of being lost on the next access
+        return tuple(read_cmds(BytesIO(self.raw), len(self.raw)))
+    
+    @cmds.setter
+    def cmds(self, cmds):
+        self._cmds = cmds
+        self.raw = None
+        self._program = None
+    
+    def program(self):
+        '''compiled Program of the script (cached), None if it cannot be compiled'''
+        if self.raw is not None:
+            if self._program is None:
+                self._program = Program(bytes(self.raw)) # stack elements are bytes
+            return self._program
+        cmds = tuple(self._cmds)
+        if self._program is None or cmds != self._program_cmds:
+            try:
+                raw = self.raw_serialize()
+            except ValueError: # element too long to serialize
+                return None
+            self._program = Program(raw)
+            self._program_cmds = cmds
+        return self._program
+
+    def __getstate__(self):
+        # raw may be a memoryview (not picklable), the program is rebuilt on demand
+        return (self._cmds, None if self.raw is None else bytes(self.raw))
+
+    def __setstate__(self, state):
+        self._cmds, self.raw = state
+        self._program = None
+        self._program_cmds = None
+
     def __repr__(self):
         result = []
         for cmd in self.cmds:
@@ -33,145 +389,130 @@ class script:
         return ' '.join(result)
             
     def __add__(self, other):
-        return self.__class__(self.cmds + other.cmds)
+        return self.__class__(list(self.cmds) + list(other.cmds))
     
     def evaluate(self, z):
-        cmds = self.cmds[:]
+        if PROFILER.enabled:
+            return PROFILER.profile_evaluate(self, z)
+        return self.evaluate_program(z)
+    
+    def evaluate_program(self, z):
         stack = []
-        altstack = []
-        while len(cmds) > 0:
-            cmd = cmds.pop()
-            # command (op_code)
-            if type(cmd) == int:
-                operation = OP_CODE_FUNCTIONS[cmd]
-                
-                # categorize with respect to input for the operation
-                
-                # OP_IF, OP_NOTIF
-                if cmd in (99, 100):
-                    if not operation(stack, cmds):
-                        return False
-                
-                # OP_TOALTSTACK, OPFROMALTSTACK
-                elif cmd in (107, 108):
-                    if not operation(stack, altstack):
-                        return False
-                
-                # OP_CHECKSIG, OP_CHECKSIGVERIFY, OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY
-                elif cmd in range(172, 176):
-                    if not operation(stack, z):
-                        return False
-                
-                # else OP_CODE
-                else:
-                    if not operation(stack):
-                        return False
-            
-            # element
-            else:
-                stack.append(cmd)
-                # screening script hash type : OP_HASH160 + hash 160 value + OP_EQUAL
-                if len(cmds) == 3 and cmds[0] == 0xa9 \
-                    and type(cmds[1]) == bytes and len(cmds[1]) == 20 \
-                    and cmds[2] == 0x87:
-                    cmds.pop()
-                    h160 = cmds.pop()
-                    cmds.pop()
-                    if not op_hash160(stack):
-                        return False
-                    stack.append(h160)
-                    if not op_equal(stack):
-                        return False
-                    if not op_verify(stack):
-                        return False
-                    redeem_script = encode_varint(len(cmd)) + cmd
-                    stream = BytesIO(redeem_script)
-                    cmds.extend(script.parse(stream).cmds)
-        
-        if len(stack) == 0: # should not be empty
+        program = self.program()
+        if program is None:
+            if not execute(list(self.cmds), stack, z):
+                return False
+        elif not program.run(stack, [], z):
             return False
-        
-        if stack.pop() == b'':  # 0 means fail
-            return False
-        
-        return True
+        return stack_result(stack)
             
     @classmethod
-    def parse(cls, s):
+    def parse(cls, s, keep_raw=False):
+        '''keep_raw : keep the raw bytes, a memoryview into the buffer (no copy)
+        when s is a BufferReader'''
         length = read_varint(s)
-        cmds = []
-        count = 0
-        while count < length:
-            # 1~78 : element, else: op_command
-            current_byte = s.read(1)[0]
-            count += 1
-            # if element shorter than 76 byte,
-            if current_byte >= 1 and current_byte <= 75:
-                len_element = current_byte
-                cmds.append(s.read(len_element))
-                count += len_element
-                
-            # OP_PUSHDATA1 (76~255 bytes)
-            elif current_byte == 76:
-                len_element = little_endian_to_int(s.read(1))
-                cmds.append(s.read(len_element))
-                count += len_element + 1
-            
-            # OP_PUSHDATA2 (256~520 bytes)
-            elif current_byte == 77:
-                len_element = little_endian_to_int(s.read(2))
-                cmds.append(s.read(len_element))
-                count += len_element + 2
-            
-            # command
-            else:
-                op_code = current_byte
-                cmds.append(op_code)
-                
-        if count != length:
-            raise SyntaxError('parsing script failed')
-        return cls(cmds)
+        if keep_raw:
+            read_view = getattr(s, 'read_view', s.read)
+            return cls.from_raw(read_view(length))
+        return cls(read_cmds(s, length))
     
     def raw_serialize(self):
-        result = b''
+        if self.raw is not None:
+            return bytes(self.raw)
+        result = []
         # cmd should be consist of command (int) and element (byte)
         for cmd in self.cmds:
             # op_command if its type is int
             if type(cmd) == int:
-                result += int_to_little_endian(cmd, 1)
+                result.append(int_to_little_endian(cmd, 1))
             # if its type is byte, element
             else:
                 len_element = len(cmd)
                 
                 # First, add length of element
-                if len_element < 75:
-                    result += int_to_little_endian(len_element, 1)
-                elif len_element > 75 and len_element < 0x100:
-                    result += int_to_little_endian(76, 1)
-                    result += int_to_little_endian(len_element, 1)
+                if len_element <= 75:
+                    result.append(int_to_little_endian(len_element, 1))
+                elif len_element < 0x100:
+                    result.append(int_to_little_endian(76, 1))
+                    result.append(int_to_little_endian(len_element, 1))
                 elif len_element >= 0x100 and len_element <= 520:
-                    result += int_to_little_endian(77, 1)
-                    result += int_to_little_endian(len_element, 2)
+                    result.append(int_to_little_endian(77, 1))
+                    result.append(int_to_little_endian(len_element, 2))
                 else:
                     raise ValueError('too long cmd')
                 # after length, add element
-                result += cmd
-        return result
+                result.append(cmd)
+        return b''.join(result)
+    
+    def serialize_into(self, result):
+        '''appends the serialization parts to the list result (raw passed through as is)'''
+        if self.raw is not None:
+            result.append(encode_varint(len(self.raw)))
+            result.append(self.raw)
+        else:
+            raw_serialized = self.raw_serialize()
+            result.append(encode_varint(len(raw_serialized)))
+            result.append(raw_serialized)
     
     def serialize(self):
-        raw_serialized = self.raw_serialize()
-        len_script = len(raw_serialized)
-        return encode_varint(len_script) + raw_serialized
+        result = []
+        self.serialize_into(result)
+        return b''.join(result)
     
     def is_p2pkh_script_lock(self):
-        # OP_DUP + OP_HASH160 + hash160 + OP_EQUALVERIFY + OP_CHECKSIG
-        return len(self.cmds) == 5 and self.cmds[0] == 0x76 \
-            and self.cmds[1] == 0xa9 \
-            and type(self.comds[2]) == bytes and len(self.cmds[2]) == 20 \ 
-            and self.cmds[3] == 0x88 and self.cmds[4] == 0xac
+        return is_p2pkh_cmds(self.cmds)
 
     def is_p2sh_script_lock(self):
-        # OP_HASH160 + hash160 + OP_EQUAL
-        return len(self.cmds) == 3 and self.cmds[0] == 0xa9 \
-            and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 20 \
-            and self.cmds[2] == 0x87
+        return is_p2sh_cmds(self.cmds)
+    
+    def is_multisig_script(self):
+        return is_multisig_cmds(self.cmds)
+
+
+def evaluate_spend(script_sig, script_lock, z):
+    '''
+    Evaluates script_sig + script_lock
+    p2pkh and p2sh (multisig redeem script) spends are validated directly,
+    others go through the generic interpreter. The result is the same as
+    (script_sig + script_lock).evaluate(z)
+    '''
+    if PROFILER.enabled:
+        return PROFILER.profile_spend(evaluate_template, script_sig, script_lock, z)
+    return evaluate_template(script_sig, script_lock, z)
+
+def evaluate_template(script_sig, script_lock, z):
+    sig_cmds = script_sig.cmds
+    lock_cmds = script_lock.cmds
+    
+    # p2pkh : <sig> <sec>
+    if is_p2pkh_cmds(lock_cmds):
+        stack = [push_element(cmd) for cmd in sig_cmds]
+        if len(stack) == 2 and None not in stack:
+            if hash160(stack[1]) != lock_cmds[2]:
+                return False
+            # through OP_CODE_FUNCTIONS so that instrumented ops are counted
+            if not OP_CODE_FUNCTIONS[0xac](stack, z):
+                return False
+            return stack_result(stack)
+    
+    # p2sh : pushes (or OP_0) followed by <redeem script>
+    elif is_p2sh_cmds(lock_cmds):
+        stack = [push_element(cmd) for cmd in sig_cmds]
+        if len(stack) > 0 and None not in stack:
+            redeem = stack.pop()
+            if hash160(redeem) != lock_cmds[1]:
+                return False
+            program = redeem_program(redeem)
+            if program.is_multisig():
+                stack.append(encode_num(program.ops[0] - 0x50))
+                for i in range(1, len(program) - 2):
+                    stack.append(program.element(i))
+                stack.append(encode_num(program.ops[-2] - 0x50))
+                if not OP_CODE_FUNCTIONS[0xae](stack, z):
+                    return False
+            elif not program.run(stack, [], z):
+                return False
+            return stack_result(stack)
+    
+    # non-standard
+    return (script_sig + script_lock).evaluate(z)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import os
+
+DEFAULT_SIG_CACHE_SIZE = 100000 # entries (32 bytes key each)
+
+
+# Cache of successful signature verifications
+# keys are salted sha256 of (z, sec pubkey, der signature), lengths prefixed, so that nobody
+# can predict or collide entries without knowing the salt
+class SignatureCache:
+
+    def __init__(self, max_entries=DEFAULT_SIG_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.salt = os.urandom(32)
+        self.entries = {} # used as an insertion ordered set
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'SignatureCache : {len(self.entries)}/{self.max_entries} entries, hit rate {self.hit_rate():.2%}'
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, z, sec, der):
+        h = hashlib.sha256(self.salt)
+        h.update(z.to_bytes(32, 'big'))
+        # lengths keep (sec, der) and (sec + der[:1], der[1:]) apart
+        h.update(len(sec).to_bytes(4, 'little'))
+        h.update(sec)
+        h.update(len(der).to_bytes(4, 'little'))
+        h.update(der)
+        return h.digest()
+
+    def contains(self, z, sec, der):
+        '''True if this signature was verified before (counted as hit/miss)'''
+        if self.key(z, sec, der) in self.entries:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, z, sec, der):
+        '''record a successful verification'''
+        if self.max_entries <= 0:
+            return
+        key = self.key(z, sec, der)
+        if key in self.entries:
+            return
+        while len(self.entries) >= self.max_entries:
+            # evict the oldest entry
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = None
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def flush(self):
+        '''drop every entry (and pick a new salt)'''
+        self.entries = {}
+        self.salt = os.urandom(32)
+        self.reset_stats()
+
+
+# shared by op_checksig and op_checkmultisig
+SIG_CACHE = SignatureCache()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio
+
+from unittest import TestCase
+
+from asyncnode import AsyncNode
+from network import (
+    GenericMessage,
+    GetHeadersMessage,
+    HeadersMessage,
+    NetworkEnvelope,
+    PingMessage,
+    VerAckMessage,
+)
+
+TIMEOUT = 5
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 30))
+
+
+async def connected_pair(**client_options):
+    '''(fake peer node, client node, client side Peer) over 127.0.0.1'''
+    fake = AsyncNode(testnet=True)
+    port = await fake.serve()
+    client = AsyncNode(testnet=True, **client_options)
+    peer = await client.connect('127.0.0.1', port, timeout=TIMEOUT)
+    return fake, client, peer
+
+
+async def close_all(*nodes):
+    for node in nodes:
+        await node.close()
+
+
+async def silent_peer():
+    '''
+    fake peer that never reads what it is sent : returns (server, port, writers),
+    the writers of its connections send raw envelopes to the connected node
+    '''
+    writers = []
+
+    async def accept(reader, writer):
+        writers.append(writer)
+
+    server = await asyncio.start_server(accept, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], writers
+
+
+def envelope(message):
+    return NetworkEnvelope(message.command, message.serialize(), testnet=True).serialize()
+
+
+class AsyncNodeTest(TestCase):
+
+    def test_handshake(self):
+        async def main():
+            fake, client, peer = await connected_pair()
+            self.assertTrue(peer.ready)
+            await asyncio.sleep(0.05) # the fake side gets our verack
+            self.assertEqual(len(fake.ready_peers()), 1)
+            await close_all(client, fake)
+            self.assertEqual(client.peers, {})
+        run(main())
+
+    def test_ping(self):
+        async def main():
+            fake, client, peer = await connected_pair()
+            rtt = await peer.ping(timeout=TIMEOUT)
+            self.assertGreaterEqual(rtt, 0)
+            self.assertLess(rtt, TIMEOUT)
+            await close_all(client, fake)
+        run(main())
+
+    def test_handler_dispatch(self):
+        async def main():
+            fake, client, peer = await connected_pair()
+            requests = []
+
+            async def on_getheaders(fake_peer, envelope):
+                requests.append(envelope.message())
+                await fake_peer.send(HeadersMessage([]))
+
+            fake.on(GetHeadersMessage.command, on_getheaders)
+            future = peer.expect(HeadersMessage.command)
+            await peer.send(GetHeadersMessage(start_block=bytes(32)))
+            headers = await peer.wait_for(HeadersMessage, timeout=TIMEOUT, future=future)
+            self.assertEqual(headers.blocks, [])
+            self.assertEqual(requests[0].start_block, bytes(32))
+            await close_all(client, fake)
+        run(main())
+
+    def test_malformed_payload_keeps_connection(self):
+        async def main():
+            fake, client, peer = await connected_pair()
+            fake.on(b'tx', lambda fake_peer, envelope: envelope.message())
+            await peer.send(GenericMessage(b'tx', b'\x01'))
+            await peer.ping(timeout=TIMEOUT)
+            fake_peer, = fake.peers.values()
+            self.assertEqual(fake_peer.dropped, 1)
+            self.assertFalse(fake_peer.closed)
+            await close_all(client, fake)
+        run(main())
+
+    def test_send_backpressure(self):
+        async def main():
+            server, port, writers = await silent_peer()
+            client = AsyncNode(testnet=True, send_queue_size=2)
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            peer = client.add_peer(reader, writer)
+            big = GenericMessage(b'junk', bytes(1000000))
+            with self.assertRaises(asyncio.TimeoutError):
+                # the socket buffers fill, then the queue : send waits
+                for _ in range(100):
+                    await asyncio.wait_for(peer.send(big), 0.5)
+            self.assertTrue(peer.send_queue.full())
+            self.assertFalse(peer.closed)
+            await client.close()
+            server.close()
+        run(main())
+
+    def test_replies_do_not_block_reads(self):
+        async def main():
+            server, port, writers = await silent_peer()
+            client = AsyncNode(testnet=True, send_queue_size=2)
+            inv = []
+            client.on(b'inv', lambda peer, envelope: inv.append(envelope))
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            peer = client.add_peer(reader, writer)
+            big = GenericMessage(b'junk', bytes(1000000))
+            with self.assertRaises(asyncio.TimeoutError):
+                for _ in range(100):
+                    await asyncio.wait_for(peer.send(big), 0.5)
+            # pings to answer while our send queue is full, then an inv
+            fake_writer, = writers
+            fake_writer.write(envelope(PingMessage(bytes(8))) * 3 + envelope(GenericMessage(b'inv', b'\x00')))
+            for _ in range(100):
+                if inv:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(len(inv), 1)
+            self.assertFalse(peer.closed)
+            await client.close()
+            server.close()
+        run(main())
+
+    def test_broadcast(self):
+        async def main():
+            fake, client, peer = await connected_pair()
+            self.assertEqual(await client.broadcast(VerAckMessage()), 1)
+            await close_all(client, fake)
+        run(main())
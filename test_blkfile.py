@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import tempfile
+
+from unittest import TestCase
+
+from blkfile import BlockFileReader, iter_framed_blocks
+from helper import hash256, int_to_little_endian
+from network import MAINNET_NETWORK_MAGIC, TESTNET_NETWORK_MAGIC
+from test_compactfilter import GENESIS_BLOCK
+from test_tx import SEGWIT_TX
+
+# genesis header with another timestamp (a different hash), plus a segwit tx
+SEGWIT_BLOCK = GENESIS_BLOCK[:68] + bytes(4) + GENESIS_BLOCK[72:80] + b'\x02' + GENESIS_BLOCK[81:] + SEGWIT_TX
+
+
+def frame(raw, magic=MAINNET_NETWORK_MAGIC):
+    return magic + int_to_little_endian(len(raw), 4) + raw
+
+
+def block_hash(raw):
+    return hash256(raw[:80])[::-1]
+
+
+class FramingTest(TestCase):
+
+    def test_iter_framed_blocks(self):
+        b = frame(GENESIS_BLOCK) + frame(SEGWIT_BLOCK)
+        first = 8 + len(GENESIS_BLOCK)
+        self.assertEqual(list(iter_framed_blocks(b)),
+                         [(8, len(GENESIS_BLOCK)), (first + 8, len(SEGWIT_BLOCK))])
+        self.assertEqual(list(iter_framed_blocks(b, offset=first)), [(first + 8, len(SEGWIT_BLOCK))])
+        # zero padding at the end
+        self.assertEqual(len(list(iter_framed_blocks(b + bytes(1000)))), 2)
+        # block still being written
+        self.assertEqual(len(list(iter_framed_blocks(b[:-1]))), 1)
+        self.assertEqual(len(list(iter_framed_blocks(b[:first + 6]))), 1)
+        # other network
+        self.assertEqual(list(iter_framed_blocks(b, TESTNET_NETWORK_MAGIC)), [])
+        self.assertEqual(len(list(iter_framed_blocks(frame(GENESIS_BLOCK, TESTNET_NETWORK_MAGIC),
+                                                     TESTNET_NETWORK_MAGIC))), 1)
+
+
+class BlockFileReaderTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, file_number, data, mode='wb'):
+        with open(os.path.join(self.directory.name, f'blk{file_number:05d}.dat'), mode) as f:
+            f.write(data)
+
+    def test_index(self):
+        self.write(0, frame(GENESIS_BLOCK) + bytes(100))
+        self.write(1, frame(SEGWIT_BLOCK))
+        with open(os.path.join(self.directory.name, 'rev00000.dat'), 'wb') as f:
+            f.write(b'not a block file')
+        with BlockFileReader(self.directory.name) as reader:
+            self.assertEqual(reader.file_numbers(), [0, 1])
+            self.assertEqual(reader.build_index(), 2)
+            self.assertEqual(reader.build_index(), 0)
+            self.assertIn(block_hash(GENESIS_BLOCK), reader)
+            self.assertEqual(bytes(reader.get(block_hash(SEGWIT_BLOCK))), SEGWIT_BLOCK)
+            self.assertIsNone(reader.get(hash256(b'unknown')))
+            block = reader.block(block_hash(SEGWIT_BLOCK))
+            self.assertEqual(len(block.txs), 2)
+            self.assertEqual(block.tx_hashes[1].hex(), 'e8151a2af31c368a35053ddd4bdb285a8595c769a3ad83e0fa02314a602d4609')
+            self.assertIsNone(reader.header(block_hash(GENESIS_BLOCK)).txs)
+            self.assertEqual([h for h, _ in reader.iter_blocks()],
+                             [block_hash(GENESIS_BLOCK), block_hash(SEGWIT_BLOCK)])
+            del block
+        # the index is read back, not rebuilt
+        with BlockFileReader(self.directory.name) as reader:
+            self.assertEqual(len(reader), 2)
+            self.assertEqual(reader.index[block_hash(SEGWIT_BLOCK)], (1, 8, len(SEGWIT_BLOCK)))
+            self.assertEqual(reader.build_index(), 0)
+
+    def test_appended_blocks(self):
+        other = GENESIS_BLOCK[:68] + b'\x01' * 4 + GENESIS_BLOCK[72:]
+        self.write(0, frame(GENESIS_BLOCK))
+        with BlockFileReader(self.directory.name) as reader:
+            self.assertEqual(reader.build_index(), 1)
+            view = reader.get(block_hash(GENESIS_BLOCK))
+            self.write(0, frame(other), 'ab')
+            self.write(2, frame(SEGWIT_BLOCK))
+            self.assertEqual(reader.build_index(), 2)
+            self.assertEqual(reader.index[block_hash(other)], (0, 16 + len(GENESIS_BLOCK), len(other)))
+            # views handed out before the remap stay usable
+            self.assertEqual(bytes(view), GENESIS_BLOCK)
+            view.release()
+        with BlockFileReader(self.directory.name) as reader:
+            self.assertEqual(len(reader), 3)
+            self.assertEqual(bytes(reader.get(block_hash(other))), other)
+
+    def test_testnet_and_xor(self):
+        self.write(0, frame(GENESIS_BLOCK, TESTNET_NETWORK_MAGIC))
+        with BlockFileReader(self.directory.name, testnet=True) as reader:
+            self.assertEqual(reader.build_index(), 1)
+        index_path = os.path.join(self.directory.name, 'mainnet.idx')
+        with BlockFileReader(self.directory.name, index_path=index_path) as reader:
+            self.assertEqual(reader.build_index(), 0)
+        with open(os.path.join(self.directory.name, 'xor.dat'), 'wb') as f:
+            f.write(bytes(8))
+        BlockFileReader(self.directory.name).close()
+        with open(os.path.join(self.directory.name, 'xor.dat'), 'wb') as f:
+            f.write(b'\x01' * 8)
+        with self.assertRaises(RuntimeError):
+            BlockFileReader(self.directory.name)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from unittest import TestCase
+
+from bloomfilter import (
+    BLOOM_UPDATE_ALL,
+    BLOOM_UPDATE_NONE,
+    BLOOM_UPDATE_P2PUBKEY_ONLY,
+    MAX_BLOOM_FILTER_SIZE,
+    BloomFilter,
+    TxItems,
+    match_block_filters,
+    script_pushes,
+)
+from ecc import G
+from helper import encode_varint, hash160, hash256, int_to_little_endian
+from script import get_p2pkh_script_lock, script
+from test_merkleindex import make_block
+from Tx import Tx, TxInput, TxOutput
+
+# Bitcoin Core bloom_tests : bloom_create_insert_serialize
+CORE_ITEMS = [
+    bytes.fromhex('99108ad8ed9bb6274d3980bab5a85c048f0950c8'),
+    bytes.fromhex('b5a2c786d9ef4658287ced5914b37a1b4aa32eee'),
+    bytes.fromhex('b9300670b4c5366e95b2699e8b18bc75e5f729c5'),
+]
+SEC = (12345 * G).sec()
+
+
+def paying_tx(script_lock, tag):
+    return Tx(1, [TxInput(hash256(tag), 0)], [TxOutput(1000, script_lock)], 0)
+
+
+def spending_tx(txid, index=0):
+    return Tx(1, [TxInput(txid, index, script([b'sig']))], [TxOutput(900, script([0x51]))], 0)
+
+
+class BloomFilterTest(TestCase):
+
+    def test_core_vectors(self):
+        for tweak, expected in ((0, '03614e9b050000000000000001'), (2147483649, '03ce4299050000000100008001')):
+            bloom_filter = BloomFilter.optimal(3, 0.01, tweak=tweak, flags=BLOOM_UPDATE_ALL)
+            self.assertFalse(bloom_filter.contains(CORE_ITEMS[0]))
+            for item in CORE_ITEMS:
+                bloom_filter.add(item)
+            self.assertTrue(bloom_filter.contains(CORE_ITEMS[0]))
+            self.assertFalse(bloom_filter.contains(bytes.fromhex('19108ad8ed9bb6274d3980bab5a85c048f0950c8')))
+            self.assertEqual(bloom_filter.filterload().payload.hex(), expected)
+
+    def test_book_vector(self):
+        bloom_filter = BloomFilter(10, 5, 99)
+        for item in (b'Hello World', b'Goodbye!'):
+            bloom_filter.add(item)
+        self.assertEqual(bloom_filter.filter_bytes().hex(), '4000600a080000010940')
+        self.assertEqual(bloom_filter.filterload(flag=1).payload.hex(), '0a4000600a080000010940050000006300000001')
+
+    def test_optimal(self):
+        bloom_filter = BloomFilter.optimal(1000, 0.001, tweak=7)
+        self.assertEqual(bloom_filter.size, 1797)
+        self.assertEqual(bloom_filter.function_count, 9)
+        self.assertLess(bloom_filter.expected_fp_rate(1000), 0.0011)
+        for i in range(1000):
+            bloom_filter.add(i.to_bytes(4, 'little'))
+        false_positives = sum(bloom_filter.contains(b'x' + i.to_bytes(4, 'little')) for i in range(20000))
+        self.assertLess(false_positives / 20000, 0.004)
+        # capped to the BIP37 limits
+        capped = BloomFilter.optimal(10**7, 0.0001)
+        self.assertEqual(capped.size, MAX_BLOOM_FILTER_SIZE)
+        self.assertEqual(BloomFilter.optimal(1, 10**-30).function_count, 50)
+        self.assertIsNotNone(BloomFilter.optimal(10, 0.1).tweak)
+        for element_count, fp_rate in ((0, 0.1), (10, 0), (10, 1)):
+            with self.assertRaises(ValueError):
+                BloomFilter.optimal(element_count, fp_rate)
+
+    def test_limits(self):
+        with self.assertRaises(ValueError):
+            BloomFilter(MAX_BLOOM_FILTER_SIZE + 1, 5, 0)
+        with self.assertRaises(ValueError):
+            BloomFilter(10, 51, 0)
+        empty = BloomFilter(0, 5, 0)
+        empty.add(b'item')
+        self.assertFalse(empty.contains(b'item'))
+        self.assertEqual(empty.expected_fp_rate(10), 0.0)
+
+    def test_parse_filterload(self):
+        bloom_filter = BloomFilter.optimal(3, 0.01, tweak=2147483649, flags=BLOOM_UPDATE_P2PUBKEY_ONLY)
+        for item in CORE_ITEMS:
+            bloom_filter.add(item)
+        payload = bloom_filter.filterload().payload
+        parsed = BloomFilter.parse_filterload(payload)
+        self.assertEqual(parsed.filter_bytes(), bloom_filter.filter_bytes())
+        self.assertEqual((parsed.function_count, parsed.tweak, parsed.flags), (5, 2147483649, BLOOM_UPDATE_P2PUBKEY_ONLY))
+        self.assertTrue(parsed.contains(CORE_ITEMS[1]))
+        too_big = encode_varint(MAX_BLOOM_FILTER_SIZE + 1) + bytes(MAX_BLOOM_FILTER_SIZE + 1) + bytes(9)
+        too_many_functions = payload[:-9] + int_to_little_endian(51, 4) + payload[-5:]
+        for bad in (b'', payload[:-1], payload + b'\x00', too_big, too_many_functions):
+            with self.assertRaises(RuntimeError):
+                BloomFilter.parse_filterload(bad)
+
+
+class BloomMatchTest(TestCase):
+
+    def filter_with(self, item, flags):
+        bloom_filter = BloomFilter(100, 10, 5, flags)
+        bloom_filter.add(item)
+        return bloom_filter
+
+    def test_script_pushes(self):
+        raw = bytes([0x02]) + b'ab' + bytes([0x00, 0x76, 0x4c, 0x01]) + b'c' + bytes([0x4d, 0x02, 0x00]) + b'de'
+        self.assertEqual(script_pushes(raw), [b'ab', b'c', b'de'])
+        # truncated push ends the script
+        self.assertEqual(script_pushes(bytes([0x01, 0x51, 0x05, 0x01])), [b'\x51'])
+        self.assertEqual(script_pushes(bytes([0x4e, 0x01])), [])
+
+    def test_update_flags(self):
+        p2pk = paying_tx(script([SEC, 0xac]), b'p2pk')
+        p2pkh = paying_tx(get_p2pkh_script_lock(hash160(SEC)), b'p2pkh')
+        cases = [
+            # flags, item, tx, outpoint inserted
+            (BLOOM_UPDATE_ALL, SEC, p2pk, True),
+            (BLOOM_UPDATE_ALL, hash160(SEC), p2pkh, True),
+            (BLOOM_UPDATE_NONE, SEC, p2pk, False),
+            (BLOOM_UPDATE_P2PUBKEY_ONLY, SEC, p2pk, True),
+            (BLOOM_UPDATE_P2PUBKEY_ONLY, hash160(SEC), p2pkh, False),
+        ]
+        for flags, item, tx, inserted in cases:
+            bloom_filter = self.filter_with(item, flags)
+            self.assertTrue(bloom_filter.match_tx(tx))
+            outpoint = tx.hash()[::-1] + int_to_little_endian(0, 4)
+            self.assertEqual(bloom_filter.contains(outpoint), inserted, (flags, tx.tx_outs[0].script_lock))
+            # the spending tx matches through the inserted outpoint
+            self.assertEqual(bloom_filter.match_tx(spending_tx(tx.hash())), inserted)
+
+    def test_match_inputs_and_txid(self):
+        tx = spending_tx(hash256(b'prev'), 3)
+        self.assertTrue(self.filter_with(tx.hash()[::-1], BLOOM_UPDATE_NONE).match_tx(tx))
+        outpoint = hash256(b'prev')[::-1] + int_to_little_endian(3, 4)
+        self.assertTrue(self.filter_with(outpoint, BLOOM_UPDATE_NONE).match_tx(tx))
+        self.assertTrue(self.filter_with(b'sig', BLOOM_UPDATE_NONE).match_tx(tx))
+        self.assertFalse(self.filter_with(b'other', BLOOM_UPDATE_NONE).match_tx(tx))
+        self.assertEqual(TxItems(tx).txid, tx.hash()[::-1])
+
+    def test_match_block(self):
+        p2pk = paying_tx(script([SEC, 0xac]), b'p2pk')
+        spend = spending_tx(p2pk.hash())
+        other = paying_tx(script([0x51]), b'other')
+        block = make_block([tx.hash() for tx in (p2pk, other, spend)])
+        block.txs = [p2pk, other, spend]
+        filters = [
+            self.filter_with(SEC, BLOOM_UPDATE_ALL),
+            self.filter_with(SEC, BLOOM_UPDATE_NONE),
+            BloomFilter(10, 5, 0),
+        ]
+        full = BloomFilter(2, 1, 0)
+        full.bits[:] = b'\xff\xff'
+        filters.append(full)
+        self.assertEqual(match_block_filters(block, filters),
+                         [[p2pk.hash(), spend.hash()], [p2pk.hash()], [], block.tx_hashes])
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import tempfile
+
+from unittest import TestCase
+
+from block import Block
+from classifier import (
+    MULTISIG,
+    NO_HASH,
+    NONSTANDARD,
+    NULL_DATA,
+    P2PK,
+    P2PKH,
+    P2SH,
+    P2TR,
+    P2WPKH,
+    P2WSH,
+    classify_block,
+    classify_block_buffer,
+    classify_file,
+    classify_files,
+    classify_raw,
+    classify_scripts,
+)
+from ecc import G
+from helper import BufferReader, hash160, int_to_little_endian
+from network import MAINNET_NETWORK_MAGIC, TESTNET_NETWORK_MAGIC
+from test_compactfilter import GENESIS_BLOCK
+from test_tx import SEGWIT_TX
+
+H160 = hash160(b'key')
+COMPRESSED = (1 * G).sec()
+UNCOMPRESSED = (2 * G).sec(compressed=False)
+
+
+def multisig(m, keys, n=None):
+    '''raw OP_m <keys> OP_n OP_CHECKMULTISIG'''
+    n = len(keys) if n is None else n
+    return bytes([0x50 + m]) + b''.join(bytes([len(key)]) + key for key in keys) + bytes([0x50 + n, 0xae])
+
+
+class ClassifyRawTest(TestCase):
+
+    def test_types(self):
+        cases = [
+            (bytes([0x76, 0xa9, 0x14]) + H160 + bytes([0x88, 0xac]), P2PKH, H160),
+            (bytes([0xa9, 0x14]) + H160 + bytes([0x87]), P2SH, H160),
+            (bytes([0, 0x14]) + H160, P2WPKH, H160),
+            (bytes([0, 0x20]) + bytes(32), P2WSH, NO_HASH),
+            (bytes([0x51, 0x20]) + bytes(32), P2TR, NO_HASH),
+            (bytes([0x21]) + COMPRESSED + bytes([0xac]), P2PK, hash160(COMPRESSED)),
+            (bytes([0x41]) + UNCOMPRESSED + bytes([0xac]), P2PK, hash160(UNCOMPRESSED)),
+            (bytes([0x6a, 0x04]) + b'data', NULL_DATA, NO_HASH),
+            (b'', NONSTANDARD, NO_HASH),
+            (bytes([0x51]), NONSTANDARD, NO_HASH),
+        ]
+        for raw, script_type, h160 in cases:
+            self.assertEqual(classify_raw(raw), (script_type, h160), raw.hex())
+            self.assertEqual(classify_raw(memoryview(raw)), (script_type, h160))
+
+    def test_multisig(self):
+        keys = [COMPRESSED, UNCOMPRESSED, (3 * G).sec()]
+        for raw in (multisig(1, keys[:1]), multisig(2, keys), multisig(3, keys), multisig(1, keys[1:2])):
+            self.assertEqual(classify_raw(raw), (MULTISIG, NO_HASH), raw.hex())
+
+    def test_not_multisig(self):
+        keys = [COMPRESSED, (3 * G).sec()]
+        cases = [
+            multisig(3, keys), # m > n
+            multisig(1, keys, n=3), # n does not match the number of keys
+            multisig(1, keys, n=1),
+            multisig(1, [COMPRESSED, b'\x00' * 33]), # not a SEC prefix
+            multisig(1, [COMPRESSED, b'\x04' + bytes(32)]), # uncompressed prefix, 33 bytes
+            multisig(1, [COMPRESSED, b'\x02' + bytes(64)]), # compressed prefix, 65 bytes
+            multisig(1, [COMPRESSED, b'\x02' * 40]), # 40 byte push
+            multisig(1, [COMPRESSED, H160]),
+            multisig(1, [COMPRESSED + b'\x00', COMPRESSED]), # push overruns OP_n
+            bytes([0x60]) + bytes([0x21]) + COMPRESSED + bytes([0x60, 0xae]), # 16-of-1
+            bytes([0x50]) + bytes([0x21]) + COMPRESSED + bytes([0x51, 0xae]), # OP_RESERVED as m
+        ]
+        for raw in cases:
+            self.assertEqual(classify_raw(raw)[0], NONSTANDARD, raw.hex())
+
+
+class ClassifyBlockTest(TestCase):
+
+    def test_block_buffer(self):
+        raw_block = GENESIS_BLOCK[:80] + b'\x02' + GENESIS_BLOCK[81:] + SEGWIT_TX
+        block = Block.parse(BufferReader(raw_block), include_txs=True)
+        from_buffer = classify_block_buffer(raw_block)
+        parsed = classify_block(block)
+        self.assertEqual(len(from_buffer), 3)
+        for name in ('types', 'amounts', 'tx_indexes', 'output_indexes', 'hash160s'):
+            self.assertEqual(getattr(from_buffer, name), getattr(parsed, name))
+        self.assertEqual(list(from_buffer.types), [P2PK, P2PKH, P2PKH])
+        self.assertEqual(list(from_buffer.tx_indexes), [0, 1, 1])
+        self.assertEqual(list(from_buffer.output_indexes), [0, 0, 1])
+        self.assertEqual(from_buffer.amounts[0], 5000000000)
+        self.assertEqual(from_buffer.counts(), {'p2pk': 1, 'p2pkh': 2})
+        # the genesis output pays to Satoshi's key
+        self.assertEqual(from_buffer.address(0), '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+
+    def test_classify_scripts(self):
+        raws = [bytes([0x6a]), multisig(1, [COMPRESSED]), bytes([0xa9, 0x14]) + H160 + bytes([0x87])]
+        columns = classify_scripts(raws)
+        self.assertEqual(list(columns.types), [NULL_DATA, MULTISIG, P2SH])
+        self.assertEqual(columns.hash160(2), H160)
+        self.assertEqual(columns.addresses()[:2], [None, None])
+
+
+class ClassifyFileTest(TestCase):
+
+    def write_blk(self, directory, name, blocks, magic=MAINNET_NETWORK_MAGIC, padding=0):
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            for raw in blocks:
+                f.write(magic + int_to_little_endian(len(raw), 4) + raw)
+            f.write(bytes(padding))
+        return path
+
+    def test_files(self):
+        segwit_block = GENESIS_BLOCK[:80] + b'\x02' + GENESIS_BLOCK[81:] + SEGWIT_TX
+        with tempfile.TemporaryDirectory() as directory:
+            first = self.write_blk(directory, 'blk00000.dat', [GENESIS_BLOCK, segwit_block], padding=100)
+            second = self.write_blk(directory, 'blk00001.dat', [segwit_block])
+            columns = classify_file(first)
+            self.assertEqual(list(columns.types), [P2PK, P2PK, P2PKH, P2PKH])
+            self.assertEqual(list(columns.tx_indexes), [0, 0, 1, 1])
+            results = classify_files([first, second], processes=2)
+            self.assertEqual([len(result) for result in results], [4, 3])
+            self.assertEqual(results[0].hash160s, columns.hash160s)
+            # other network : no block is framed with its magic
+            self.assertEqual(len(classify_file(first, TESTNET_NETWORK_MAGIC)), 0)
+            testnet = self.write_blk(directory, 'blk00002.dat', [GENESIS_BLOCK], TESTNET_NETWORK_MAGIC)
+            self.assertEqual(len(classify_file(testnet, TESTNET_NETWORK_MAGIC)), 1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import random
+
+from unittest import TestCase
+
+from block import Block
+from compactfilter import (
+    BASIC_FILTER_M,
+    BlockFilter,
+    FilterHeaderChain,
+    filter_key,
+    golomb_decode,
+    golomb_encode,
+    hashed_set,
+    siphash24,
+)
+from helper import BufferReader, hash256
+
+# BIP158 test vector (testnet-19.json) : testnet genesis block
+GENESIS_COINBASE = bytes.fromhex('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+GENESIS_BLOCK = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae1801') + GENESIS_COINBASE
+GENESIS_HASH = '000000000933ea01ad0ee984209779baaec3ced90fa3f408719526f8d77f4943'
+GENESIS_FILTER = '019dfca8'
+GENESIS_FILTER_HEADER = '21584579b7eb08997773e5aeff3a7f932700042d0ed2a6129012b7d7ae81b750'
+
+
+class SipHashTest(TestCase):
+
+    def test_reference_vectors(self):
+        # SipHash-2-4 paper : key 00..0f, message 00..(n - 1)
+        k0 = int.from_bytes(bytes(range(8)), 'little')
+        k1 = int.from_bytes(bytes(range(8, 16)), 'little')
+        vectors = {
+            0: '310e0edd47db6f72',
+            1: 'fd67dc93c539f874',
+            2: '5a4fa9d909806c0d',
+            8: '6224939a79f5f593',
+            15: 'e545be4961ca29a1',
+        }
+        for n, expected in vectors.items():
+            self.assertEqual(siphash24(k0, k1, bytes(range(n))).to_bytes(8, 'little').hex(), expected)
+
+
+class GolombTest(TestCase):
+
+    def test_round_trip(self):
+        rng = random.Random(158)
+        for n in (0, 1, 2, 100, 1000):
+            values = sorted(rng.randrange(n * BASIC_FILTER_M + 1) for _ in range(n))
+            self.assertEqual(list(golomb_decode(golomb_encode(values), n)), values)
+
+    def test_small_parameter(self):
+        values = [0, 1, 1, 5, 40, 41]
+        self.assertEqual(list(golomb_decode(golomb_encode(values, p=2), len(values), p=2)), values)
+
+    def test_truncated(self):
+        encoded = golomb_encode([1000, 2000000, 3000000])
+        with self.assertRaises(RuntimeError):
+            list(golomb_decode(encoded[:-2], 3))
+
+
+class BlockFilterTest(TestCase):
+
+    def genesis(self):
+        return Block.parse(BufferReader(GENESIS_BLOCK), include_txs=True)
+
+    def test_genesis_vector(self):
+        block = self.genesis()
+        self.assertEqual(block.hash256().hex(), GENESIS_HASH)
+        block_filter = BlockFilter.from_block(block)
+        self.assertEqual(block_filter.serialize().hex(), GENESIS_FILTER)
+        self.assertEqual(block_filter.header(bytes(32))[::-1].hex(), GENESIS_FILTER_HEADER)
+
+    def test_parse(self):
+        block_hash = bytes.fromhex(GENESIS_HASH)
+        block_filter = BlockFilter.parse(BufferReader(bytes.fromhex(GENESIS_FILTER)), block_hash)
+        self.assertEqual(block_filter.n, 1)
+        self.assertEqual(block_filter.serialize().hex(), GENESIS_FILTER)
+        script_lock = self.genesis().txs[0].tx_outs[0].script_lock.raw_serialize()
+        self.assertTrue(block_filter.match(script_lock))
+        self.assertFalse(block_filter.match(b'\x51'))
+
+    def test_match(self):
+        rng = random.Random(47)
+        items = [rng.randbytes(25) for _ in range(200)]
+        block_hash = hash256(b'block')
+        block_filter = BlockFilter.from_items(block_hash, items)
+        self.assertEqual(block_filter.values(), hashed_set(items, filter_key(block_hash), 200 * BASIC_FILTER_M))
+        for item in items[::20]:
+            self.assertTrue(block_filter.match(item))
+        self.assertTrue(block_filter.match_any([b'absent', items[7]]))
+        self.assertFalse(block_filter.match_any([b'absent', b'missing']))
+        self.assertFalse(BlockFilter.from_items(block_hash, []).match(items[0]))
+
+
+class FilterHeaderChainTest(TestCase):
+
+    def test_chaining(self):
+        chain = FilterHeaderChain()
+        self.assertEqual(chain.tip(), bytes(32))
+        genesis = BlockFilter.from_block(Block.parse(BufferReader(GENESIS_BLOCK), include_txs=True))
+        header = chain.append(genesis)
+        self.assertEqual(header[::-1].hex(), GENESIS_FILTER_HEADER)
+        second = BlockFilter.from_items(hash256(b'second'), [b'\x51'])
+        header = chain.append(second)
+        self.assertEqual(header, hash256(second.hash() + bytes.fromhex(GENESIS_FILTER_HEADER)[::-1]))
+        self.assertEqual(len(chain), 2)
+        self.assertEqual(chain.header(1), chain.tip())
+        # the same chain from filter hashes (as in cfheaders)
+        other = FilterHeaderChain()
+        self.assertEqual(other.append_filter_hashes([genesis.hash(), second.hash()]), chain.tip())
+        self.assertEqual(other.headers, chain.headers)
+        with self.assertRaises(IndexError):
+            chain.header(2)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from io import BytesIO
+from unittest import TestCase
+
+from ecc import G, N, Signature
+from helper import hash160
+from script import (
+    evaluate_spend,
+    execute,
+    get_p2pkh_script_lock,
+    get_p2sh_script_lock,
+    script,
+    stack_result,
+)
+from sigcache import SIG_CACHE
+
+Z = 0x6c2a7f3e9d0b4c1e8a5f2d7b3e9c0a4f1d8b6e2c7a3f9d0b5e1c8a4f2d7b3e9c
+OTHER_Z = Z ^ 1
+SECRETS = [8675309, 12345, 0xdeadbeef, 0x1234567890abcdef]
+PUBKEYS = [(secret * G).sec() for secret in SECRETS]
+
+
+def sign(secret, z, k):
+    r = (k * G).x.num
+    s = (z + r * secret) * pow(k, N - 2, N) % N
+    if s > N // 2:
+        s = N - s
+    return Signature(r, s).der() + b'\x01'
+
+
+def generic(script_sig, script_lock, z):
+    '''reference : the generic interpreter on the cmds of script_sig + script_lock'''
+    stack = []
+    if not execute(list(script_sig.cmds) + list(script_lock.cmds), stack, z):
+        return False
+    return stack_result(stack)
+
+
+def outcome(f):
+    '''result of f, or the name of the exception it raised'''
+    try:
+        return f()
+    except Exception as e:
+        return type(e).__name__
+
+
+class EvaluateSpendTest(TestCase):
+    '''evaluate_spend and the compiled program against the generic interpreter'''
+
+    def setUp(self):
+        SIG_CACHE.flush()
+
+    def assertSameResult(self, script_sig, script_lock, expected):
+        # raw-backed scripts (as parsed from blocks) take the same paths
+        raw_sig = script.parse(BytesIO(script_sig.serialize()), keep_raw=True)
+        raw_lock = script.parse(BytesIO(script_lock.serialize()), keep_raw=True)
+        for sig, lock in ((script_sig, script_lock), (raw_sig, raw_lock)):
+            message = f'{sig} | {lock}'
+            reference = outcome(lambda: generic(sig, lock, Z))
+            self.assertEqual(reference, expected, message)
+            self.assertEqual(outcome(lambda: evaluate_spend(sig, lock, Z)), reference, message)
+            self.assertEqual(outcome(lambda: (sig + lock).evaluate(Z)), reference, message)
+
+    def test_p2pkh(self):
+        for i, (secret, sec) in enumerate(zip(SECRETS, PUBKEYS)):
+            lock = get_p2pkh_script_lock(hash160(sec))
+            other_sec = PUBKEYS[(i + 1) % len(PUBKEYS)]
+            k = 1000 + i
+            self.assertSameResult(script([sign(secret, Z, k), sec]), lock, True)
+            self.assertSameResult(script([sign(secret, OTHER_Z, k), sec]), lock, False)
+            self.assertSameResult(script([sign(secret, Z, k), other_sec]), lock, False)
+            self.assertSameResult(script([b'\x30\x01\x01', sec]), lock, False)
+
+    def test_p2pkh_non_template_script_sig(self):
+        sec = PUBKEYS[0]
+        lock = get_p2pkh_script_lock(hash160(sec))
+        self.assertSameResult(script([sign(SECRETS[0], Z, 7)]), lock, False)
+        self.assertSameResult(script([sign(SECRETS[0], Z, 7), sec, sec]), lock, False)
+
+    def test_p2sh_multisig(self):
+        redeem = script([0x52] + PUBKEYS[:3] + [0x53, 0xae]).raw_serialize()
+        lock = get_p2sh_script_lock(hash160(redeem))
+        for a, b, expected in [(0, 1, True), (0, 2, True), (1, 2, True), (1, 0, False), (0, 3, False)]:
+            sig_a = sign(SECRETS[a], Z, 2000 + a)
+            sig_b = sign(SECRETS[b], Z, 3000 + b)
+            self.assertSameResult(script([0, sig_a, sig_b, redeem]), lock, expected)
+            bad_a = sign(SECRETS[a], OTHER_Z, 2000 + a)
+            self.assertSameResult(script([0, bad_a, sig_b, redeem]), lock, False)
+
+    def test_p2sh_wrong_redeem_script(self):
+        redeem = script([0x52] + PUBKEYS[:3] + [0x53, 0xae]).raw_serialize()
+        lock = get_p2sh_script_lock(hash160(redeem))
+        sigs = [sign(SECRETS[0], Z, 11), sign(SECRETS[1], Z, 12)]
+        # OP_CHECKMULTISIGVERIFY instead of OP_CHECKMULTISIG : hash mismatch
+        self.assertSameResult(script([0] + sigs + [redeem[:-1] + b'\xaf']), lock, False)
+
+    def test_p2sh_non_multisig_redeem_script(self):
+        redeem = script([0x51]).raw_serialize()
+        lock = get_p2sh_script_lock(hash160(redeem))
+        self.assertSameResult(script([redeem]), lock, True)
+        self.assertSameResult(script([0x52, redeem]), lock, True)
+        redeem = script([0x00]).raw_serialize()
+        lock = get_p2sh_script_lock(hash160(redeem))
+        self.assertSameResult(script([redeem]), lock, False)
+
+    def test_p2sh_empty_redeem_script(self):
+        # b'' in a list and OP_0 once parsed are the same empty push
+        lock = get_p2sh_script_lock(hash160(b''))
+        for empty in (b'', 0):
+            self.assertSameResult(script([empty]), lock, False)
+            self.assertSameResult(script([0x51, empty]), lock, True)
+            self.assertSameResult(script([b'', empty]), lock, False)
+
+    def test_non_standard(self):
+        self.assertSameResult(script([0x51]), script([0x51, 0x87]), True)
+        self.assertSameResult(script([0x52]), script([0x51, 0x87]), False)
+        self.assertSameResult(script([b'\x01' * 80]), script([0x76, 0x87]), True)
+        self.assertSameResult(script([0x51]), script([0x69, 0x51]), True)
+        self.assertSameResult(script([0x00]), script([0x69, 0x51]), False)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import tempfile
+
+from array import array
+from unittest import TestCase
+
+from export import NUMPY_TYPES, ColumnarExporter, chunk_paths, export_txs, iter_chunks, load_column, output_script
+from helper import hash160, hash256
+from script import get_p2pkh_script_lock, script
+from Tx import Tx, TxInput, TxOutput
+
+
+def make_txs(n, start=0):
+    txs = []
+    for i in range(start, start + n):
+        tx_outs = [TxOutput(1000 * i + j, get_p2pkh_script_lock(hash160(bytes([i, j])))) for j in range(2)]
+        txs.append(Tx(1, [TxInput(hash256(bytes([i])), 0)], tx_outs, i))
+    return txs
+
+
+class ExportTest(TestCase):
+
+    def test_item_sizes(self):
+        for code, dtype in NUMPY_TYPES.items():
+            self.assertEqual(array(code).itemsize, dtype().itemsize)
+
+    def test_chunks(self):
+        txs = make_txs(5)
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(export_txs(directory, txs, chunk_outputs=4), 3)
+            chunks = list(iter_chunks(directory))
+            self.assertEqual([len(chunk['tx_version']) for chunk in chunks], [2, 2, 1])
+            first = chunks[0]
+            self.assertEqual(bytes(first['tx_txid'][1]), txs[1].hash())
+            self.assertEqual(list(first['out_tx']), [0, 0, 1, 1])
+            self.assertEqual(list(first['tx_first_output']), [0, 2])
+            self.assertEqual(output_script(first, 3), txs[1].tx_outs[1].script_lock.raw_serialize())
+            self.assertEqual(list(load_column(directory, 'tx_locktime')), list(range(5)))
+            self.assertEqual(list(load_column(directory, 'out_amount')),
+                             [tx_out.amount for tx in txs for tx_out in tx.tx_outs])
+
+    def test_export_again_appends(self):
+        with tempfile.TemporaryDirectory() as directory:
+            export_txs(directory, make_txs(3), chunk_outputs=2)
+            with ColumnarExporter(directory, chunk_outputs=2) as exporter:
+                self.assertEqual(exporter.next_chunk, 3)
+                exporter.add_txs(make_txs(2, start=3))
+            self.assertEqual(exporter.chunk_count, 2)
+            self.assertEqual([os.path.basename(path) for path in chunk_paths(directory)],
+                             [f'chunk_{i:05d}' for i in range(5)])
+            self.assertEqual(list(load_column(directory, 'tx_locktime')), list(range(5)))
+
+    def test_empty_script(self):
+        tx = Tx(1, [TxInput(hash256(b'prev'), 0)], [TxOutput(0, script([]))], 0)
+        with tempfile.TemporaryDirectory() as directory:
+            export_txs(directory, [tx])
+            chunk = next(iter_chunks(directory))
+            self.assertEqual(output_script(chunk, 0), b'')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import tempfile
+
+from unittest import TestCase, mock
+
+from block import Block
+from headerstore import HeaderStore, validate_headers
+from helper import hash256, little_endian_to_int
+
+REGTEST_BITS = bytes.fromhex('ffff7f20')
+
+
+def mine_headers(n, prev_hash=bytes(32), timestamp=1600000000):
+    '''n linked regtest headers (raw bytes) after prev_hash (as Block.hash256())'''
+    headers = []
+    for i in range(n):
+        block = Block(1, prev_hash, hash256(bytes([i])), timestamp + i, REGTEST_BITS, bytes(4))
+        nonce = 0
+        while not block.check_pow():
+            nonce += 1
+            block.nonce = nonce.to_bytes(4, 'little')
+        headers.append(block.serialize())
+        prev_hash = block.hash256()
+    return headers
+
+
+class ValidateHeadersTest(TestCase):
+
+    def test_valid_prefix(self):
+        headers = mine_headers(6)
+        hashes = bytearray()
+        self.assertEqual(validate_headers(b''.join(headers), hashes=hashes), 6)
+        self.assertEqual(bytes(hashes), b''.join(hash256(raw) for raw in headers))
+        self.assertEqual(validate_headers(b''.join(headers[1:]), prev_hash=hash256(headers[0])), 5)
+        self.assertEqual(validate_headers(b''.join(headers[1:]), prev_hash=bytes(32)), 0)
+        broken = headers[:3] + [headers[4]] + headers[5:]
+        self.assertEqual(validate_headers(b''.join(broken)), 3)
+        bad_pow = bytearray(headers[2])
+        bad_pow[72:76] = bytes.fromhex('ffff001d') # mainnet minimum difficulty
+        self.assertEqual(validate_headers(b''.join(headers[:2]) + bad_pow), 2)
+
+    def test_partial_header(self):
+        raw = b''.join(mine_headers(2))
+        with self.assertRaises(ValueError):
+            validate_headers(raw[:-1])
+        with self.assertRaises(ValueError):
+            validate_headers(raw + b'\x00')
+
+    def test_processes(self):
+        headers = mine_headers(5)
+        with mock.patch('headerstore.PARALLEL_CHUNK_HEADERS', 2):
+            hashes = bytearray()
+            self.assertEqual(validate_headers(b''.join(headers), processes=2, hashes=hashes), 5)
+            self.assertEqual(len(hashes), 5 * 32)
+            broken = headers[:3] + headers[4:]
+            self.assertEqual(validate_headers(b''.join(broken), processes=2), 3)
+
+
+class HeaderStoreTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'headers')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append_and_lookup(self):
+        headers = mine_headers(5)
+        with HeaderStore(self.path, check_bits=False) as store:
+            for height, raw in enumerate(headers):
+                self.assertEqual(store.append(raw), height)
+            self.assertEqual(len(store), 5)
+            for height, raw in enumerate(headers):
+                self.assertEqual(store.raw(height), raw)
+                self.assertEqual(store.block_hash(height), hash256(raw)[::-1])
+                self.assertEqual(store.height_of(store.block_hash(height)), height)
+            self.assertNotIn(hash256(b'unknown'), store)
+            with self.assertRaises(RuntimeError):
+                store.append(headers[2])
+            with self.assertRaises(IndexError):
+                store.raw(5)
+            with self.assertRaises(ValueError):
+                store.extend_raw(mine_headers(1, store.tip_hash())[0][:79])
+            self.assertEqual(len(store), 5)
+
+    def test_reopen_uses_saved_hashes(self):
+        headers = mine_headers(20)
+        with HeaderStore(self.path, check_bits=False) as store:
+            store.extend_raw(b''.join(headers))
+            hashes = bytes(store.hashes)
+        self.assertEqual(os.path.getsize(self.path), 20 * 80)
+        self.assertEqual(os.path.getsize(self.path + '.hashes'), 20 * 32)
+        with mock.patch('headerstore.hash256', wraps=hash256) as hashing:
+            with HeaderStore(self.path, check_bits=False) as store:
+                self.assertEqual(len(store), 20)
+                self.assertEqual(bytes(store.hashes), hashes)
+                # only the last saved hash is checked
+                self.assertEqual(hashing.call_count, 1)
+                store.extend_raw(b''.join(mine_headers(3, store.block_hash(19))))
+        with HeaderStore(self.path, check_bits=False) as store:
+            self.assertEqual(len(store), 23)
+            self.assertEqual(store.saved, 23)
+
+    def test_reopen_rehashes_unsaved(self):
+        headers = mine_headers(10)
+        with HeaderStore(self.path, check_bits=False) as store:
+            store.extend_raw(b''.join(headers[:6]))
+            hashes = bytes(store.hashes)
+        # headers written without a close : the hashes file is behind
+        store = HeaderStore(self.path, check_bits=False)
+        store.extend_raw(b''.join(headers[6:]))
+        store.map.flush()
+        reopened = HeaderStore(self.path, check_bits=False)
+        self.assertEqual(len(reopened), 10)
+        self.assertEqual(reopened.saved, 6)
+        self.assertEqual(bytes(reopened.hashes[:6 * 32]), hashes)
+        self.assertEqual(reopened.height_of(hash256(headers[9])[::-1]), 9)
+        reopened.close()
+        store.close()
+        # a hashes file that does not match is ignored
+        with open(self.path + '.hashes', 'r+b') as f:
+            f.seek(9 * 32)
+            f.write(bytes(32))
+        with HeaderStore(self.path, check_bits=False) as store:
+            self.assertEqual(len(store), 10)
+            self.assertEqual(store.block_hash(9), hash256(headers[9])[::-1])
+
+    def test_old_hashes_found_by_height(self):
+        headers = mine_headers(12)
+        with mock.patch('headerstore.RECENT_HASHES', 4):
+            with HeaderStore(self.path, check_bits=False) as store:
+                store.extend_raw(b''.join(headers))
+                self.assertEqual(len(store.recent), 4)
+                self.assertEqual(set(store.recent.values()), {8, 9, 10, 11})
+                for height in range(12):
+                    self.assertEqual(store.height_of(store.block_hash(height)), height)
+                # 32 bytes straddling two hashes are not a hash
+                self.assertIsNone(store.height_of(bytes(store.hashes[16:48])))
+                self.assertIsNone(store.height_of(store.block_hash(0)[:31]))
+
+    def test_locator(self):
+        headers = mine_headers(30)
+        with HeaderStore(self.path, check_bits=False) as store:
+            store.extend_raw(b''.join(headers))
+            heights = [store.height_of(h) for h in store.locator()]
+        self.assertEqual(heights, [29, 28, 27, 26, 25, 24, 23, 22, 21, 20, 18, 14, 6, 0])
+
+    def test_check_bits(self):
+        headers = mine_headers(2)
+        with HeaderStore(self.path) as store:
+            store.append(headers[0])
+            store.append(headers[1])
+            self.assertEqual(store.expected_bits(2), REGTEST_BITS)
+            self.assertEqual(little_endian_to_int(store.bits(1)), little_endian_to_int(REGTEST_BITS))
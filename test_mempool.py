@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from io import BytesIO
+from unittest import TestCase
+
+from helper import hash256
+from mempool import Mempool
+from script import script
+from Tx import Tx, TxInput, TxOutput
+from test_tx import SEGWIT_TX
+
+
+def make_tx(prev_tx, prev_index=0, outputs=1, tag=b''):
+    '''tx spending prev_tx:prev_index, tag makes txs with the same input differ'''
+    tx_outs = [TxOutput(1000, script([0x51, tag])) for _ in range(outputs)]
+    return Tx(1, [TxInput(prev_tx, prev_index)], tx_outs, 0)
+
+
+def confirmed(n):
+    '''txid of an output outside of the pool'''
+    return hash256(bytes([n]))
+
+
+class MempoolTest(TestCase):
+
+    def test_add(self):
+        pool = Mempool()
+        tx = make_tx(confirmed(1))
+        entry = pool.add(tx, fee=500)
+        self.assertIn(entry.txid, pool)
+        self.assertIs(pool.get(entry.txid), tx)
+        self.assertEqual(entry.txid, tx.hash())
+        self.assertEqual(entry.size, len(tx.serialize()))
+        self.assertIs(pool.add(tx, fee=500), entry)
+        self.assertEqual(pool.spender(confirmed(1), 0), entry.txid)
+        self.assertTrue(pool.is_spent(confirmed(1), 0))
+        self.assertFalse(pool.is_spent(confirmed(1), 1))
+        with self.assertRaises(RuntimeError):
+            pool.add(make_tx(confirmed(1), tag=b'double spend'), fee=1000)
+        with self.assertRaises(RuntimeError):
+            pool.add(make_tx(confirmed(2)), fee=-1)
+
+    def test_segwit_size(self):
+        tx = Tx.parse(BytesIO(SEGWIT_TX))
+        entry = Mempool().add(tx, fee=1000)
+        self.assertEqual(entry.size, tx.vsize())
+        self.assertLess(entry.size, len(tx.serialize_segwit()))
+        self.assertGreater(entry.size, len(tx.serialize()))
+
+    def test_package_totals(self):
+        pool = Mempool()
+        parent = pool.add(make_tx(confirmed(1), outputs=2), fee=100)
+        child = pool.add(make_tx(parent.txid, 0), fee=1000)
+        grandchild = pool.add(make_tx(child.txid, 0), fee=10)
+        self.assertEqual(pool.ancestors(grandchild.txid), {parent.txid, child.txid})
+        self.assertEqual(pool.descendants(parent.txid), {child.txid, grandchild.txid})
+        self.assertEqual(grandchild.ancestor_fee, 1110)
+        self.assertEqual(parent.descendant_fee, 1110)
+        self.assertEqual(parent.descendant_size, parent.size + child.size + grandchild.size)
+        pool.remove(grandchild.txid)
+        self.assertEqual(parent.descendant_fee, 1100)
+        self.assertEqual(child.descendant_size, child.size)
+
+    def test_remove_with_descendants(self):
+        pool = Mempool()
+        parent = pool.add(make_tx(confirmed(1), outputs=2), fee=100)
+        child = pool.add(make_tx(parent.txid, 0), fee=100)
+        other = pool.add(make_tx(parent.txid, 1), fee=100)
+        grandchild = pool.add(make_tx(child.txid, 0), fee=100)
+        self.assertEqual(pool.remove(child.txid), {child.txid, grandchild.txid})
+        self.assertEqual(set(pool.txs), {parent.txid, other.txid})
+        self.assertEqual(parent.children, {other.txid})
+        self.assertFalse(pool.is_spent(child.txid, 0))
+        self.assertEqual(pool.total_size, parent.size + other.size)
+        self.assertEqual(pool.remove(child.txid), set())
+
+    def test_remove_for_block(self):
+        pool = Mempool()
+        parent = pool.add(make_tx(confirmed(1)), fee=100)
+        child = pool.add(make_tx(parent.txid), fee=200)
+        conflicting = pool.add(make_tx(confirmed(2)), fee=300)
+        block_tx = make_tx(confirmed(2), tag=b'in block')
+        removed = pool.remove_for_block([parent.tx, block_tx])
+        self.assertEqual(removed, {parent.txid, conflicting.txid})
+        # the child stays, its package is itself now
+        self.assertEqual(set(pool.txs), {child.txid})
+        self.assertEqual(child.parents, set())
+        self.assertEqual((child.ancestor_fee, child.ancestor_size), (200, child.size))
+
+    def test_trim_keeps_parent_paid_by_child(self):
+        size = len(make_tx(confirmed(1)).serialize())
+        pool = Mempool(max_size=3 * size)
+        parent = pool.add(make_tx(confirmed(1)), fee=0)
+        child = pool.add(make_tx(parent.txid), fee=10000)
+        middle = pool.add(make_tx(confirmed(2)), fee=500)
+        self.assertEqual(len(pool), 3)
+        pool.max_size = 2 * size
+        self.assertEqual(pool.trim(), {middle.txid})
+        self.assertEqual(set(pool.txs), {parent.txid, child.txid})
+        self.assertEqual(pool.min_fee_rate(), child.fee / (parent.size + child.size))
+
+    def test_trim_evicts_descendants(self):
+        size = len(make_tx(confirmed(1)).serialize())
+        pool = Mempool(max_size=3 * size)
+        parent = pool.add(make_tx(confirmed(1)), fee=10)
+        child = pool.add(make_tx(parent.txid), fee=20)
+        rich = pool.add(make_tx(confirmed(2)), fee=5000)
+        pool.max_size = 2 * size
+        self.assertEqual(pool.trim(), {parent.txid, child.txid})
+        self.assertEqual(set(pool.txs), {rich.txid})
+
+    def test_add_evicted_raises(self):
+        size = len(make_tx(confirmed(1)).serialize())
+        pool = Mempool(max_size=2 * size)
+        pool.add(make_tx(confirmed(1)), fee=1000)
+        pool.add(make_tx(confirmed(2)), fee=1000)
+        cheap = make_tx(confirmed(3))
+        with self.assertRaises(RuntimeError):
+            pool.add(cheap, fee=1)
+        self.assertNotIn(cheap.hash(), pool)
+        self.assertFalse(pool.is_spent(confirmed(3), 0))
+        self.assertEqual(len(pool), 2)
+
+    def test_block_template_by_package(self):
+        size = len(make_tx(confirmed(1)).serialize())
+        pool = Mempool()
+        parent = pool.add(make_tx(confirmed(1)), fee=0)
+        middle = pool.add(make_tx(confirmed(2)), fee=500)
+        child = pool.add(make_tx(parent.txid), fee=10000)
+        txs, fees = pool.block_template(max_size=2 * size)
+        self.assertEqual(txs, [parent.tx, child.tx])
+        self.assertEqual(fees, 10000)
+        txs, fees = pool.block_template()
+        self.assertEqual(txs, [parent.tx, child.tx, middle.tx])
+        self.assertEqual(fees, 10500)
+
+    def test_block_template_order(self):
+        pool = Mempool()
+        parent = pool.add(make_tx(confirmed(1), outputs=2), fee=5000)
+        low_child = pool.add(make_tx(parent.txid, 0), fee=10)
+        high_child = pool.add(make_tx(parent.txid, 1), fee=4000)
+        grandchild = pool.add(make_tx(low_child.txid), fee=100000)
+        txs, fees = pool.block_template()
+        order = [tx.hash() for tx in txs]
+        self.assertEqual(fees, 109010)
+        self.assertEqual(order[0], parent.txid)
+        self.assertLess(order.index(low_child.txid), order.index(grandchild.txid))
+        # the grandchild pays for low_child, so both come before high_child
+        self.assertEqual(order[-1], high_child.txid)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import random
+
+from io import BytesIO
+from unittest import TestCase
+
+from helper import bytes_to_bit_field, hash256, merkle_parent, merkle_root
+from merkleblock import MerkleBlock, MerkleBlockBuilder, MerkleTree, merkle_block, verify_many
+from test_merkleindex import make_block, tx_hashes
+
+
+def recursive_walk(total, flag_bits, hashes):
+    '''(root, matched leaves) of a partial tree, walked recursively as in BIP37'''
+    max_depth = (total - 1).bit_length()
+    flags = iter(flag_bits)
+    hashes = iter(hashes)
+    matched = []
+
+    def width(depth):
+        return (total + (1 << (max_depth - depth)) - 1) >> (max_depth - depth)
+
+    def walk(depth, index):
+        flag = next(flags)
+        if depth == max_depth or not flag:
+            h = next(hashes)
+            if depth == max_depth and flag:
+                matched.append(h)
+            return h
+        left = walk(depth + 1, index * 2)
+        if index * 2 + 1 < width(depth + 1):
+            right = walk(depth + 1, index * 2 + 1)
+        else:
+            right = left
+        return merkle_parent(left, right)
+
+    return walk(0, 0), matched
+
+
+class MerkleTreeTest(TestCase):
+
+    def test_level_widths(self):
+        tree = MerkleTree(27)
+        self.assertEqual(tree.max_depth, 5)
+        self.assertEqual(tree.widths, [1, 2, 4, 7, 14, 27])
+        self.assertEqual(tree.offsets, [0, 1, 3, 7, 14, 28])
+        self.assertEqual(len(tree.nodes), 55)
+        self.assertEqual(MerkleTree(1).widths, [1])
+        with self.assertRaises(RuntimeError):
+            MerkleTree(0)
+
+    def test_populate_full(self):
+        for n in (1, 2, 3, 16, 27):
+            hashes = tx_hashes(n)
+            leaves = [h[::-1] for h in hashes]
+            tree = MerkleTree(n)
+            # every tx matched : every node flagged, every leaf given
+            builder = MerkleBlockBuilder(hashes)
+            proof_hashes, flags = builder.proof(hashes)
+            tree.populate_tree(bytes_to_bit_field(flags), [h[::-1] for h in proof_hashes])
+            self.assertEqual(tree.root(), merkle_root(list(leaves)))
+            self.assertEqual(tree.matched, leaves)
+            self.assertEqual(tree.level(tree.max_depth), leaves)
+
+    def test_populate_errors(self):
+        hashes = tx_hashes(5)
+        proof_hashes, flags = MerkleBlockBuilder(hashes).proof(hashes[1:2])
+        flag_bits = bytes_to_bit_field(flags)
+        proof_hashes = [h[::-1] for h in proof_hashes]
+        tree = MerkleTree(5)
+        with self.assertRaises(RuntimeError):
+            tree.populate_tree(flag_bits, proof_hashes[:-1])
+        tree.reset()
+        with self.assertRaises(RuntimeError):
+            tree.populate_tree(flag_bits, proof_hashes + [bytes(32)])
+        tree.reset()
+        tree.populate_tree(flag_bits, proof_hashes)
+        self.assertEqual(tree.matched, [hashes[1][::-1]])
+        # a set flag bit after the walk
+        tree.reset()
+        extra = flag_bits + [0] * 3 + [1]
+        with self.assertRaises(RuntimeError):
+            tree.populate_tree(extra, proof_hashes)
+        tree.reset()
+        tree.populate_tree(flag_bits + [0] * 4, proof_hashes)
+        self.assertEqual(tree.root(), merkle_root([h[::-1] for h in hashes]))
+        # not enough flag bits
+        tree.reset()
+        with self.assertRaises(RuntimeError):
+            tree.populate_tree(flag_bits[:2], proof_hashes)
+
+    def test_duplicate_siblings(self):
+        # two identical leaves would give the same root as a single leaf
+        leaf = hash256(b'leaf')
+        tree = MerkleTree(2)
+        with self.assertRaises(RuntimeError):
+            tree.populate_tree([1, 1, 1], [leaf, leaf])
+        # the same hash as leaves that are not siblings is fine
+        tree = MerkleTree(3)
+        tree.populate_tree([1] * 6, [leaf, hash256(b'other'), leaf])
+        self.assertEqual(tree.root(), merkle_root([leaf, hash256(b'other'), leaf]))
+
+    def test_same_as_recursive_walk(self):
+        rng = random.Random(42)
+        for n in (1, 2, 3, 5, 8, 13, 100):
+            hashes = tx_hashes(n)
+            builder = MerkleBlockBuilder(hashes)
+            for _ in range(5):
+                matched = sorted(rng.sample(hashes, rng.randint(0, n)), key=hashes.index)
+                proof_hashes, flags = builder.proof(matched)
+                flag_bits = bytes_to_bit_field(flags)
+                leaves = [h[::-1] for h in proof_hashes]
+                tree = MerkleTree(n)
+                tree.populate_tree(flag_bits, leaves)
+                self.assertEqual((tree.root(), tree.matched), recursive_walk(n, flag_bits, leaves))
+                self.assertEqual(tree.matched, [h[::-1] for h in matched])
+
+
+class MerkleBlockTest(TestCase):
+
+    def test_proofs(self):
+        hashes = tx_hashes(13)
+        block = make_block(hashes)
+        for matched in ([], hashes[:1], hashes[5:8], hashes[-1:], hashes):
+            mb = merkle_block(block, matched)
+            parsed = MerkleBlock.parse(BytesIO(mb.serialize()))
+            self.assertEqual(parsed.serialize(), mb.serialize())
+            self.assertTrue(parsed.is_valid())
+            self.assertEqual(parsed.matched_txids, matched)
+
+    def test_invalid(self):
+        hashes = tx_hashes(6)
+        block = make_block(hashes)
+        mb = merkle_block(block, hashes[2:3])
+        mb.merkle_root = hash256(b'other root')
+        self.assertFalse(mb.is_valid())
+        mb = merkle_block(block, hashes[2:3])
+        mb.hashes = mb.hashes[:-1]
+        self.assertFalse(mb.is_valid())
+        self.assertFalse(MerkleBlock(1, bytes(32), bytes(32), 0, bytes(4), bytes(4), 0, [], b'').is_valid())
+
+    def test_verify_many(self):
+        blocks = [make_block(tx_hashes(n)) for n in (3, 3, 8, 1)]
+        merkleblocks = [merkle_block(block, block.tx_hashes[-1:]) for block in blocks]
+        bad = merkle_block(blocks[1], blocks[1].tx_hashes[:1])
+        bad.hashes = list(reversed(bad.hashes))
+        empty = MerkleBlock(1, bytes(32), bytes(32), 0, bytes(4), bytes(4), 0, [], b'')
+        results = verify_many(merkleblocks + [bad, empty])
+        self.assertEqual(results, [True, True, True, True, False, False])
+        self.assertEqual([mb.matched_txids for mb in merkleblocks], [b.tx_hashes[-1:] for b in blocks])
+        self.assertEqual(results[:4], [mb.is_valid() for mb in merkleblocks])
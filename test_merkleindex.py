@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import tempfile
+
+from io import BytesIO
+from unittest import TestCase
+
+from block import Block
+from helper import hash256, merkle_root
+from merkleblock import MerkleBlockBuilder
+from merkleindex import MerkleIndex, MerkleLevels, level_widths, verify_merkle_proof
+
+
+def tx_hashes(n):
+    return [hash256(i.to_bytes(4, 'little'))[::-1] for i in range(n)]
+
+
+def make_block(hashes):
+    block = Block(1, bytes(32), merkle_root([h[::-1] for h in hashes])[::-1], 0, bytes.fromhex('ffff7f20'), bytes(4))
+    block.tx_hashes = hashes
+    return block
+
+
+class MerkleLevelsTest(TestCase):
+
+    def test_same_levels_as_builder(self):
+        for n in (1, 2, 3, 7, 8, 33):
+            hashes = tx_hashes(n)
+            levels = MerkleLevels.from_tx_hashes(hashes)
+            builder = MerkleBlockBuilder(hashes)
+            self.assertEqual(levels.widths, [len(level) for level in builder.levels])
+            self.assertEqual(levels.widths, level_widths(n))
+            for depth, level in enumerate(builder.levels):
+                for index, h in enumerate(level):
+                    self.assertEqual(levels.node(depth, index), h)
+            self.assertEqual(levels.root(), builder.root())
+
+    def test_proofs(self):
+        for n in (1, 2, 5, 16, 17):
+            hashes = tx_hashes(n)
+            root = make_block(hashes).merkle_root
+            levels = MerkleLevels.from_tx_hashes(hashes)
+            for index, txid in enumerate(hashes):
+                self.assertEqual(levels.index_of(txid), index)
+                proof_index, branch = levels.merkle_proof(txid)
+                self.assertEqual(proof_index, index)
+                self.assertTrue(verify_merkle_proof(txid, index, branch, root))
+                if index ^ 1 < n: # the last of an odd level is its own sibling
+                    self.assertFalse(verify_merkle_proof(txid, index ^ 1, branch, root))
+            self.assertIsNone(levels.merkle_proof(hash256(b'absent')))
+
+    def test_index_of_aligned_only(self):
+        hashes = tx_hashes(4)
+        levels = MerkleLevels.from_tx_hashes(hashes)
+        # 32 bytes straddling two leaves are not a leaf
+        straddling = (hashes[0][::-1][16:] + hashes[1][::-1][:16])[::-1]
+        self.assertIsNone(levels.index_of(straddling))
+        # interior nodes are not leaves either
+        self.assertIsNone(levels.index_of(levels.node(1, 0)[::-1]))
+
+    def test_serialize(self):
+        levels = MerkleLevels.from_tx_hashes(tx_hashes(9))
+        raw = levels.serialize()
+        parsed = MerkleLevels.parse(BytesIO(raw))
+        self.assertEqual(parsed.buffer, levels.buffer)
+        with self.assertRaises(RuntimeError):
+            MerkleLevels(9, levels.buffer[:-1])
+
+
+class MerkleIndexTest(TestCase):
+
+    def test_disk_and_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            index = MerkleIndex(directory, cache_size=2)
+            blocks = [make_block(tx_hashes(n)) for n in (3, 4, 5)]
+            for block in blocks:
+                index.add(block)
+            self.assertEqual(len(index.cache), 2)
+            first = blocks[0]
+            self.assertIn(first.hash256(), index)
+            self.assertNotIn(first.hash256(), index.cache)
+            txid = first.tx_hashes[2]
+            proof = index.merkle_proof(first.hash256(), txid)
+            self.assertEqual(proof[0], 2)
+            self.assertTrue(verify_merkle_proof(txid, *proof, first.merkle_root))
+            # a new index reads the stored files
+            reopened = MerkleIndex(directory)
+            self.assertEqual(reopened.merkle_proof(first.hash256(), txid), proof)
+            self.assertIsNone(reopened.merkle_proof(hash256(b'unknown'), txid))
+            self.assertEqual(len(os.listdir(directory)), 3)
+
+    def test_wrong_root(self):
+        with tempfile.TemporaryDirectory() as directory:
+            block = make_block(tx_hashes(3))
+            block.tx_hashes = tx_hashes(4)
+            with self.assertRaises(RuntimeError):
+                MerkleIndex(directory).add(block)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from unittest import TestCase, mock
+
+from block import Block
+from helper import hash256, little_endian_to_int
+from miner import Miner, grind, roll_extranonce
+from script import script
+from Tx import Tx, TxInput, TxOutput
+
+REGTEST_BITS = bytes.fromhex('ffff7f20')
+
+
+def make_block(txs=None):
+    tx_hashes = [tx.hash() for tx in txs] if txs else None
+    return Block(1, bytes(32), hash256(b'root')[::-1], 1600000000, REGTEST_BITS, bytes(4), tx_hashes, txs)
+
+
+class MinerTest(TestCase):
+
+    def test_grind(self):
+        header = make_block().serialize()
+        target = 2**250
+        nonce, hashes = grind(header, target)
+        self.assertEqual(hashes, nonce + 1)
+        self.assertLess(little_endian_to_int(hash256(header[:76] + nonce.to_bytes(4, 'little'))), target)
+        for other in range(nonce):
+            self.assertGreaterEqual(little_endian_to_int(hash256(header[:76] + other.to_bytes(4, 'little'))), target)
+        self.assertEqual(grind(header, 1, 0, 100), (None, 100))
+
+    def test_processes(self):
+        header = make_block().serialize()
+        miner = Miner(processes=2)
+        nonce = miner.search(header, 2**248)
+        self.assertLess(little_endian_to_int(hash256(header[:76] + nonce.to_bytes(4, 'little'))), 2**248)
+        self.assertGreater(miner.hashes, 0)
+
+    def test_processes_no_nonce(self):
+        header = make_block().serialize()
+        miner = Miner(processes=3)
+        # many progress messages per worker, all read before the workers are joined
+        with mock.patch('miner.PROGRESS_INTERVAL', 16):
+            self.assertIsNone(miner.search(header, 1, 0, 3000))
+        self.assertEqual(miner.hashes, 3000)
+
+    def test_mine(self):
+        block = make_block()
+        Miner(processes=1).mine(block)
+        self.assertTrue(block.check_pow())
+
+    def test_roll_extranonce(self):
+        coinbase = Tx(1, [TxInput(bytes(32), 0xffffffff, script([b'\x01', b'tag']))], [TxOutput(50, script([0x51]))], 0)
+        block = make_block([coinbase])
+        index = roll_extranonce(block, 1)
+        self.assertEqual(index, 1)
+        self.assertEqual(coinbase.tx_ins[0].script_sig.cmds, [b'\x01', (1).to_bytes(8, 'little'), b'tag'])
+        self.assertEqual(roll_extranonce(block, 2, index), 1)
+        self.assertEqual(block.tx_hashes[0], coinbase.hash())
+        self.assertTrue(block.validate_merkle_root())
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import itertools
+
+from unittest import TestCase
+
+from block import Block
+from helper import BufferReader
+from merkleblock import merkle_block
+from network import (
+    MAINNET_NETWORK_MAGIC,
+    MESSAGE_CLASSES,
+    BlockMessage,
+    EnvelopeFramer,
+    GenericMessage,
+    GetDataMessage,
+    GetHeadersMessage,
+    HeadersMessage,
+    InvMessage,
+    NetworkEnvelope,
+    PingMessage,
+    PongMessage,
+    TxMessage,
+    VerAckMessage,
+    VersionMessage,
+)
+from test_compactfilter import GENESIS_BLOCK
+from test_merkleindex import make_block, tx_hashes
+from test_tx import SEGWIT_TX
+from Tx import Tx
+
+
+def envelope(command, payload, testnet=False):
+    return NetworkEnvelope(command, payload, testnet).serialize()
+
+
+def frames(envelopes):
+    return [(e.command, bytes(e.payload)) for e in envelopes]
+
+
+def feed_chunks(framer, data, size):
+    result = []
+    for start in range(0, len(data), size):
+        result += framer.feed(data[start:start + size])
+    return result
+
+
+class EnvelopeFramerTest(TestCase):
+
+    def setUp(self):
+        self.messages = [
+            (b'ping', bytes(range(8))),
+            (b'verack', b''),
+            (b'tx', bytes(range(256)) * 3),
+            (b'inv', b'\x01' + bytes(36)),
+        ]
+        self.data = b''.join(envelope(command, payload) for command, payload in self.messages)
+
+    def test_one_chunk(self):
+        framer = EnvelopeFramer()
+        result = framer.feed(self.data)
+        self.assertEqual(frames(result), self.messages)
+        # payloads point into the chunk
+        self.assertIsInstance(result[2].payload, memoryview)
+        self.assertIsNone(result[2].checksum)
+        self.assertEqual(framer.pending(), 0)
+        self.assertEqual((framer.skipped, framer.bad_checksums), (0, 0))
+
+    def test_partial_chunks(self):
+        for size, checksum_limit in itertools.product((1, 2, 3, 7, 23, 24, 25, 100, 777), (None, 100)):
+            framer = EnvelopeFramer(checksum_limit=checksum_limit)
+            self.assertEqual(frames(feed_chunks(framer, self.data, size)), self.messages, size)
+            self.assertEqual(framer.pending(), 0)
+            self.assertEqual(framer.skipped, 0)
+
+    def test_pending(self):
+        framer = EnvelopeFramer()
+        tx = envelope(b'tx', bytes(1000))
+        self.assertEqual(framer.feed(tx[:10]), [])
+        self.assertEqual(framer.pending(), 10)
+        self.assertEqual(framer.feed(tx[10:500]), [])
+        self.assertEqual(framer.pending(), 500)
+        self.assertEqual(frames(framer.feed(tx[500:] + tx[:30])), [(b'tx', bytes(1000))])
+        self.assertEqual(framer.pending(), 30)
+
+    def test_resync_after_garbage(self):
+        # partial magics in the garbage, and noise between the ping (32 bytes) and the verack
+        garbage = b'\x00\xf9\xbe\xb4garbage' + MAINNET_NETWORK_MAGIC[:3]
+        noise = b'noise' + MAINNET_NETWORK_MAGIC[:2]
+        data = garbage + self.data[:32] + noise + self.data[32:]
+        for size, checksum_limit in itertools.product((len(data), 1, 5, 31), (None, 100)):
+            framer = EnvelopeFramer(checksum_limit=checksum_limit)
+            result = feed_chunks(framer, data, size)
+            self.assertEqual(frames(result), self.messages, size)
+            self.assertEqual(framer.skipped, len(garbage) + len(noise))
+            self.assertEqual(framer.pending(), 0)
+
+    def test_trailing_magic_prefix(self):
+        framer = EnvelopeFramer()
+        ping = envelope(b'ping', bytes(8))
+        self.assertEqual(framer.feed(b'x' * 40 + ping[:3]), [])
+        self.assertEqual(framer.skipped, 40)
+        self.assertEqual(frames(framer.feed(ping[3:])), [(b'ping', bytes(8))])
+
+    def test_bad_checksum(self):
+        bad = bytearray(envelope(b'tx', bytes(100)))
+        bad[20] ^= 1
+        framer = EnvelopeFramer()
+        result = framer.feed(bytes(bad) + self.data)
+        self.assertEqual(frames(result), self.messages)
+        self.assertEqual(framer.bad_checksums, 1)
+
+    def test_checksum_limit(self):
+        large = bytearray(envelope(b'block', bytes(5000)))
+        large[20] ^= 1
+        small = bytearray(envelope(b'tx', bytes(100)))
+        small[20] ^= 1
+        data = bytes(large) + bytes(small) + envelope(b'ping', bytes(8))
+        for size in (len(data), 1000):
+            framer = EnvelopeFramer(checksum_limit=1000)
+            result = feed_chunks(framer, data, size)
+            # the large one is left unchecked, the small one is dropped
+            self.assertEqual([e.command for e in result], [b'block', b'ping'])
+            self.assertEqual(framer.bad_checksums, 1)
+            self.assertIsNotNone(result[0].checksum)
+            self.assertFalse(result[0].verify_checksum())
+        good = envelope(b'block', bytes(5000))
+        result = EnvelopeFramer(checksum_limit=1000).feed(good)
+        self.assertTrue(result[0].verify_checksum())
+        self.assertIsNone(result[0].checksum)
+
+    def test_oversized_length(self):
+        framer = EnvelopeFramer(max_payload=1000)
+        oversized = envelope(b'block', bytes(2000))
+        result = framer.feed(oversized + self.data)
+        self.assertEqual(frames(result), self.messages)
+        self.assertEqual(framer.skipped, len(oversized))
+
+    def test_testnet(self):
+        data = envelope(b'ping', bytes(8), testnet=True)
+        self.assertEqual(EnvelopeFramer().feed(data), [])
+        result = EnvelopeFramer(testnet=True).feed(data)
+        self.assertEqual(result[0].message().nonce, bytes(8))
+        self.assertIsInstance(result[0].message(), PingMessage)
+
+
+def round_trip(message, testnet=False):
+    '''message parsed back from its envelope, as received by a node'''
+    data = NetworkEnvelope(message.command, message.serialize(), testnet).serialize()
+    result = EnvelopeFramer(testnet=testnet).feed(data)
+    return result[0].message()
+
+
+class MessageClassesTest(TestCase):
+
+    def test_registered(self):
+        for command, message_class in MESSAGE_CLASSES.items():
+            self.assertEqual(message_class.command, command)
+        self.assertEqual(len(MESSAGE_CLASSES), 11)
+
+    def test_round_trips(self):
+        block = Block.parse(BufferReader(GENESIS_BLOCK), include_txs=True)
+        header = Block.parse(BufferReader(GENESIS_BLOCK))
+        hashes = tx_hashes(5)
+        messages = [
+            VersionMessage(timestamp=1700000000, receiver_ip=bytes(range(16)), sender_port=18333,
+                           nonce=bytes(range(8)), latest_block=800000, relay=True),
+            VerAckMessage(),
+            PingMessage(bytes(range(8))),
+            PongMessage(bytes(range(8, 16))),
+            GetHeadersMessage(start_block=hashes[0], end_block=hashes[1]),
+            HeadersMessage([header, header]),
+            InvMessage([(1, hashes[0]), (2, hashes[1])]),
+            GetDataMessage([(3, hashes[2])]),
+            TxMessage(Tx.parse(BufferReader(SEGWIT_TX))),
+            BlockMessage(block),
+            merkle_block(make_block(hashes), hashes[1:2]),
+        ]
+        self.assertEqual({message.command for message in messages}, set(MESSAGE_CLASSES))
+        for message in messages:
+            parsed = round_trip(message)
+            self.assertIs(type(parsed), type(message))
+            self.assertEqual(parsed.serialize(), message.serialize(), message.command)
+        self.assertEqual(round_trip(messages[0]).receiver_ip, bytes(range(16)))
+        self.assertEqual(round_trip(messages[6]).data, messages[6].data)
+        self.assertEqual(round_trip(messages[8]).tx.serialize_segwit(), SEGWIT_TX)
+        self.assertEqual(round_trip(messages[9]).block.tx_hashes, block.tx_hashes)
+        self.assertTrue(round_trip(messages[10]).is_valid())
+
+    def test_generic(self):
+        data = envelope(b'sendheaders', b'payload')
+        message = EnvelopeFramer().feed(data)[0].message()
+        self.assertIsInstance(message, GenericMessage)
+        self.assertEqual((message.command, message.payload), (b'sendheaders', b'payload'))
+        # parsed once
+        result = EnvelopeFramer().feed(envelope(b'ping', bytes(8)))
+        self.assertIs(result[0].message(), result[0].message())
+
+    def test_getheaders_locator(self):
+        locator = tx_hashes(33)
+        end_block = tx_hashes(34)[33]
+        message = GetHeadersMessage(locator=locator, end_block=end_block)
+        self.assertEqual((message.num_hashes, message.start_block), (33, locator[0]))
+        raw = message.serialize()
+        self.assertEqual(len(raw), 4 + 1 + 32 * 34)
+        parsed = round_trip(message)
+        self.assertEqual(parsed.locator, locator)
+        self.assertEqual((parsed.num_hashes, parsed.start_block, parsed.end_block), (33, locator[0], end_block))
+        self.assertEqual(parsed.serialize(), raw)
+        # over 252 hashes the count is a 3 byte varint
+        long_locator = tx_hashes(300)
+        parsed = round_trip(GetHeadersMessage(locator=long_locator))
+        self.assertEqual(parsed.locator, long_locator)
+        self.assertEqual(parsed.end_block, bytes(32))
+        # headers from the end block only
+        empty = round_trip(GetHeadersMessage(locator=[], end_block=end_block))
+        self.assertEqual((empty.locator, empty.num_hashes, empty.start_block), ([], 0, None))
+        with self.assertRaises(RuntimeError):
+            GetHeadersMessage()
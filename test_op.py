@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from unittest import TestCase, mock
+
+from ecc import G, N, S256Point, Signature
+from op import decode_num, encode_num, matches_recovered, op_checkmultisig, op_checkmultisigverify, parse_sec
+from sigcache import SIG_CACHE
+
+Z = 0x3f1d8b6e2c7a9d0b5e1c8a4f2d7b3e9c6c2a7f3e9d0b4c1e8a5f2d7b3e9c0a4f
+SECRETS = [1111, 2222, 3333, 4444]
+POINTS = [secret * G for secret in SECRETS]
+
+
+def sign(secret, z, k):
+    r = (k * G).x.num
+    s = (z + r * secret) * pow(k, N - 2, N) % N
+    if s > N // 2:
+        s = N - s
+    return Signature(r, s).der() + b'\x01'
+
+
+def reference(sigs, secs, z):
+    '''signatures matched against pubkeys in order, verifying every pair'''
+    key_index = 0
+    for sig in sigs:
+        while key_index < len(secs):
+            key_index += 1
+            if S256Point.parse(secs[key_index - 1]).verify(z, Signature.parse(sig[:-1])):
+                break
+        else:
+            return False
+    return True
+
+
+class CheckMultisigTest(TestCase):
+
+    def setUp(self):
+        SIG_CACHE.flush()
+
+    def checkmultisig(self, sigs, secs, z=Z):
+        stack = [b''] + sigs + [encode_num(len(sigs))] + secs + [encode_num(len(secs))]
+        self.assertTrue(op_checkmultisig(stack, z))
+        self.assertEqual(len(stack), 1)
+        return decode_num(stack[0]) == 1
+
+    def test_in_order(self):
+        secs = [point.sec() for point in POINTS[:3]]
+        sigs = [sign(secret, Z, 100 + i) for i, secret in enumerate(SECRETS[:3])]
+        for a, b in [(0, 1), (0, 2), (1, 2)]:
+            SIG_CACHE.flush()
+            self.assertTrue(self.checkmultisig([sigs[a], sigs[b]], secs))
+        self.assertTrue(self.checkmultisig(sigs, secs))
+        self.assertTrue(self.checkmultisig([], secs))
+
+    def test_wrong_order(self):
+        secs = [point.sec() for point in POINTS[:3]]
+        sigs = [sign(secret, Z, 200 + i) for i, secret in enumerate(SECRETS[:3])]
+        for order in [(1, 0), (2, 0), (2, 1), (0, 0)]:
+            self.assertFalse(self.checkmultisig([sigs[i] for i in order], secs), order)
+        # still false once the pairs are cached
+        self.assertTrue(self.checkmultisig([sigs[0], sigs[1]], secs))
+        self.assertFalse(self.checkmultisig([sigs[1], sigs[0]], secs))
+
+    def test_same_as_reference(self):
+        secs = [POINTS[0].sec(), POINTS[1].sec(compressed=False), POINTS[2].sec(), POINTS[3].sec(compressed=False)]
+        good = [sign(secret, Z, 300 + i) for i, secret in enumerate(SECRETS)]
+        bad = [sign(secret, Z ^ 1, 400 + i) for i, secret in enumerate(SECRETS)]
+        cases = [
+            [good[0], good[3]],
+            [good[1], good[2], good[3]],
+            [good[3], good[1]],
+            [good[0], bad[1], good[2]],
+            [bad[0]],
+            [good[2]],
+        ]
+        for sigs in cases:
+            SIG_CACHE.flush()
+            self.assertEqual(self.checkmultisig(sigs, secs), reference(sigs, secs, Z))
+
+    def test_early_exit(self):
+        secs = [point.sec() for point in POINTS[:3]]
+        sigs = [sign(secret, Z, 500 + i) for i, secret in enumerate(SECRETS[:3])]
+        with mock.patch('op.S256Point.recover', wraps=S256Point.recover) as recover, \
+            mock.patch('op.parse_sec', wraps=parse_sec) as parsed:
+            # 3 of 3 with the first signature from the second key : once the first
+            # pubkey fails, too few pubkeys are left for the signatures
+            self.assertFalse(self.checkmultisig([sigs[1], sigs[1], sigs[2]], secs))
+        # one candidate per signature : verified directly, without recovery
+        recover.assert_not_called()
+        self.assertEqual(parsed.call_count, 1)
+
+    def test_recovery_once_per_signature(self):
+        secs = [point.sec() for point in POINTS]
+        sigs = [sign(SECRETS[3], Z, 600)]
+        with mock.patch('op.S256Point.recover', wraps=S256Point.recover) as recover, \
+            mock.patch('op.parse_sec') as parse_sec:
+            self.assertTrue(self.checkmultisig(sigs, secs))
+        # the four pubkeys are compared to the recovered points, none is parsed
+        self.assertEqual(recover.call_count, 1)
+        parse_sec.assert_not_called()
+        self.assertEqual(len(SIG_CACHE), 1)
+
+    def test_non_canonical_pubkey(self):
+        # a pubkey that is not a canonical SEC encoding is verified directly, and fails
+        secs = [b'\x05' + bytes(32), POINTS[0].sec()]
+        sigs = [sign(SECRETS[0], Z, 700)]
+        self.assertTrue(self.checkmultisig(sigs, secs))
+        self.assertFalse(self.checkmultisig(sigs, [b'\x05' + bytes(32), POINTS[1].sec()]))
+
+    def test_bad_stack(self):
+        self.assertFalse(op_checkmultisig([], Z))
+        self.assertFalse(op_checkmultisig([encode_num(2), b'key'], Z))
+        self.assertFalse(op_checkmultisig([encode_num(1), POINTS[0].sec(), encode_num(1)], Z))
+        # signature that is not DER
+        stack = [b'', b'\x30\x01\x01\x01', encode_num(1), POINTS[0].sec(), encode_num(1)]
+        self.assertFalse(op_checkmultisig(stack, Z))
+
+    def test_verify(self):
+        secs = [POINTS[0].sec()]
+        stack = [b'', sign(SECRETS[0], Z, 800), encode_num(1)] + secs + [encode_num(1)]
+        self.assertTrue(op_checkmultisigverify(stack, Z))
+        self.assertEqual(stack, [])
+        stack = [b'', sign(SECRETS[1], Z, 800), encode_num(1)] + secs + [encode_num(1)]
+        self.assertFalse(op_checkmultisigverify(stack, Z))
+
+    def test_matches_recovered(self):
+        point = POINTS[0]
+        self.assertTrue(matches_recovered(point.sec(), [POINTS[1], point]))
+        self.assertTrue(matches_recovered(point.sec(compressed=False), [point]))
+        self.assertFalse(matches_recovered(point.sec(), [POINTS[1]]))
+        self.assertIsNone(matches_recovered(b'\x06' + point.sec(compressed=False)[1:], [point]))
+        self.assertIsNone(matches_recovered(point.sec()[:-1], [point]))
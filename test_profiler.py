@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from unittest import TestCase, mock
+
+import script as script_module
+
+from helper import hash160
+from op import OP_CODE_FUNCTIONS
+from profiler import PROFILER, ScriptProfiler
+from script import evaluate_spend, get_p2pkh_script_lock, get_p2sh_script_lock, script
+
+
+class ScriptProfilerTest(TestCase):
+
+    def setUp(self):
+        PROFILER.reset()
+
+    def tearDown(self):
+        PROFILER.disable()
+        PROFILER.reset()
+
+    def test_enable_disable(self):
+        originals = dict(OP_CODE_FUNCTIONS)
+        dispatch = script_module.DISPATCH
+        PROFILER.enable()
+        PROFILER.enable() # no double wrapping
+        self.assertTrue(PROFILER.enabled)
+        for code, operation in originals.items():
+            self.assertIsNot(OP_CODE_FUNCTIONS[code], operation)
+            self.assertIs(PROFILER.originals[code], operation)
+        self.assertIsNot(script_module.DISPATCH, dispatch)
+        PROFILER.disable()
+        self.assertFalse(PROFILER.enabled)
+        self.assertEqual(OP_CODE_FUNCTIONS, originals)
+        self.assertEqual(PROFILER.originals, {})
+
+    def test_op_counts(self):
+        PROFILER.enable()
+        # compiled program (dispatch table) and generic interpreter
+        self.assertTrue(script([0x52, 0x52, 0x87]).evaluate(0))
+        self.assertTrue(script([b'\x01' * 600, 0x76, 0x87]).evaluate(0))
+        snapshot = PROFILER.snapshot()
+        self.assertEqual(snapshot['ops']['OP_2']['count'], 2)
+        self.assertEqual(snapshot['ops']['OP_EQUAL']['count'], 2)
+        self.assertEqual(snapshot['ops']['OP_DUP']['count'], 1)
+        self.assertEqual(snapshot['script_count'], 2)
+        self.assertEqual(snapshot['script_bytes'], 3)
+        self.assertEqual(snapshot['max_script_size'], 3)
+        self.assertEqual(snapshot['max_stack_depth'], 2)
+        self.assertEqual(len(snapshot['slowest_scripts']), 2)
+        # nothing is counted once disabled
+        PROFILER.disable()
+        script([0x52, 0x52, 0x87]).evaluate(0)
+        self.assertEqual(PROFILER.snapshot()['ops']['OP_2']['count'], 2)
+
+    def test_spend_types(self):
+        PROFILER.enable()
+        redeem = script([0x51]).raw_serialize()
+        evaluate_spend(script([redeem]), get_p2sh_script_lock(hash160(redeem)), 0)
+        evaluate_spend(script([b'sig', b'sec']), get_p2pkh_script_lock(hash160(b'other')), 0)
+        evaluate_spend(script([0x51]), script([0x51, 0x87]), 0)
+        spends = PROFILER.snapshot()['spends']
+        self.assertEqual({kind: stats['count'] for kind, stats in spends.items()},
+                         {'p2sh': 1, 'p2pkh': 1, 'non-standard': 1})
+        # the non-standard spend is also an evaluated script
+        self.assertEqual(PROFILER.script_count, 1)
+
+    def test_slowest(self):
+        profiler = ScriptProfiler()
+        with mock.patch('profiler.SLOWEST_SCRIPTS', 3):
+            for i in range(10):
+                profiler.record_script(i, i / 1000, bytes([i]) * 100)
+        slowest = profiler.snapshot()['slowest_scripts']
+        self.assertEqual([item['size'] for item in slowest], [9, 8, 7])
+        self.assertEqual(slowest[0]['hex'], '09' * 64)
+        self.assertEqual(profiler.max_script_size, 9)
+
+    def test_report(self):
+        PROFILER.enable()
+        script([0x52, 0x52, 0x87]).evaluate(0)
+        report = PROFILER.report()
+        self.assertIn('OP_EQUAL', report)
+        self.assertIn('scripts: 1', report)
+        self.assertIn('max stack depth: 2', report)
+        PROFILER.reset()
+        self.assertNotIn('OP_EQUAL', PROFILER.report())
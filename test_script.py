@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from io import BytesIO
+from unittest import TestCase, mock
+
+from helper import hash160
+from op import OP_CODE_FUNCTIONS
+from script import (
+    DISPATCH,
+    PUSH,
+    REDEEM_PROGRAMS,
+    Program,
+    execute,
+    get_p2sh_script_lock,
+    read_cmds,
+    redeem_program,
+    script,
+    stack_result,
+)
+
+
+def run(raw, z=0):
+    '''(result of the compiled program, result of the generic interpreter) on raw'''
+    stack = []
+    compiled = Program(raw).run(stack, [], z) and stack_result(stack)
+    stack = []
+    generic = execute(read_cmds(BytesIO(raw), len(raw)), stack, z) and stack_result(stack)
+    return compiled, generic
+
+
+class ProgramTest(TestCase):
+
+    def test_compile_pushes(self):
+        raw = bytes([0x00, 0x02]) + b'ab' + bytes([0x4c, 0x03]) + b'cde' \
+            + bytes([0x4d, 0x01, 0x01]) + b'f' * 257 + bytes([0x76, 0x87])
+        program = Program(raw)
+        self.assertEqual(list(program.ops), [PUSH, PUSH, PUSH, PUSH, 0x76, 0x87])
+        self.assertEqual([program.element(i) for i in range(4)], [b'', b'ab', b'cde', b'f' * 257])
+        self.assertEqual(len(program), 6)
+        self.assertEqual(program.p2sh_at, -1)
+        self.assertFalse(program.generic)
+
+    def test_truncated(self):
+        for raw in (bytes([0x02, 0x01]), bytes([0x4c]), bytes([0x4d, 0x01]), bytes([0x4c, 0x05, 0x01])):
+            with self.assertRaises(SyntaxError):
+                Program(raw)
+
+    def test_dispatch_table(self):
+        self.assertEqual(len(DISPATCH), 256)
+        for code in range(256):
+            if code in OP_CODE_FUNCTIONS and code not in (99, 100):
+                self.assertIsNotNone(DISPATCH[code], code)
+            else:
+                self.assertIsNone(DISPATCH[code], code)
+
+    def test_same_as_generic(self):
+        cases = [
+            (bytes([0x51]), True),
+            (bytes([0x00]), False),
+            (bytes([0x52, 0x52, 0x87]), True),
+            (bytes([0x52, 0x53, 0x87]), False),
+            (bytes([0x52, 0x52, 0x88, 0x51]), True),
+            (bytes([0x52, 0x53, 0x88, 0x51]), False),
+            (bytes([0x51, 0x69, 0x51]), True),
+            (bytes([0x01, 0x07, 0x76, 0xa9, 0x14]) + hash160(b'\x07') + bytes([0x87]), True),
+            (bytes([0x51, 0xba]), False), # unsupported op code
+            (b'', False),
+        ]
+        for raw, expected in cases:
+            self.assertEqual(run(raw), (expected, expected), raw.hex())
+
+    def test_op_if_uses_generic_interpreter(self):
+        raw = bytes([0x51, 0x63, 0x51, 0x68])
+        program = Program(raw)
+        self.assertTrue(program.generic)
+        with mock.patch('script.execute', wraps=execute) as generic:
+            stack = []
+            result = program.run(stack, [], 0)
+        generic.assert_called_once()
+        # OP_IF is not implemented : fails after OP_1 as in execute
+        self.assertFalse(result)
+        self.assertEqual(stack, [b'\x01'])
+        self.assertEqual(run(raw), (False, False))
+        self.assertTrue(Program(bytes([0x51, 0x64, 0x68])).generic)
+
+
+class P2shProgramTest(TestCase):
+
+    def setUp(self):
+        REDEEM_PROGRAMS.clear()
+
+    def test_p2sh_at(self):
+        redeem = bytes([0x52, 0x52, 0x87])
+        lock = get_p2sh_script_lock(hash160(redeem))
+        program = (script([redeem]) + lock).program()
+        self.assertEqual(program.p2sh_at, 0)
+        self.assertTrue(program.run([], [], 0))
+        self.assertIn(redeem, REDEEM_PROGRAMS)
+        # the redeem script runs on the remaining stack
+        stack = []
+        self.assertTrue((script([0x53, redeem]) + lock).program().run(stack, [], 0))
+        self.assertEqual(stack[-1], b'\x01')
+        # wrong redeem script
+        stack = []
+        self.assertFalse((script([redeem + b'\x51']) + lock).program().run(stack, [], 0))
+        # a 20 byte push that is not after OP_HASH160 is not p2sh
+        self.assertEqual(Program(bytes([0x01, 0x51, 0x14]) + bytes(20) + bytes([0x87])).p2sh_at, -1)
+
+    def test_redeem_cache(self):
+        first = redeem_program(bytes([0x51]))
+        self.assertIs(redeem_program(bytes([0x51])), first)
+        with mock.patch('script.REDEEM_PROGRAM_CACHE_SIZE', 2):
+            redeem_program(bytes([0x52]))
+            redeem_program(bytes([0x53]))
+        self.assertEqual(list(REDEEM_PROGRAMS), [bytes([0x52]), bytes([0x53])])
+
+
+class ScriptProgramTest(TestCase):
+
+    def test_cached(self):
+        lock = script([0x51, 0x87])
+        program = lock.program()
+        self.assertIs(lock.program(), program)
+        raw = script.from_raw(memoryview(lock.raw_serialize()))
+        self.assertIs(raw.program(), raw.program())
+        self.assertEqual(type(raw.program().raw), bytes)
+
+    def test_edit_in_place(self):
+        s = script([0x52, 0x52, 0x87])
+        self.assertTrue(s.evaluate(0))
+        s.cmds[1] = 0x53
+        self.assertFalse(s.evaluate(0))
+        s.cmds = [0x51]
+        self.assertTrue(s.evaluate(0))
+
+    def test_unserializable(self):
+        # too long to serialize : no program, the generic interpreter runs
+        s = script([b'\x01' * 600, 0x76, 0x87])
+        self.assertIsNone(s.program())
+        self.assertTrue(s.evaluate(0))
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from unittest import TestCase
+
+from ecc import G, N, Signature
+from op import decode_num, op_checksig
+from sigcache import SIG_CACHE
+
+
+class SignatureCacheTest(TestCase):
+
+    def setUp(self):
+        SIG_CACHE.flush()
+
+    def checksig(self, z, sec, der):
+        stack = [der + b'\x01', sec]
+        if not op_checksig(stack, z):
+            return False
+        return decode_num(stack.pop()) == 1
+
+    def test_shifted_boundary_is_not_a_hit(self):
+        z = 0x1234567890
+        secret, k = 8675309, 1234567
+        r = (k * G).x.num
+        s = (z + r * secret) * pow(k, N - 2, N) % N
+        sec = (secret * G).sec()
+        der = Signature(r, s).der()
+        forged_sec, forged_der = sec + der[:1], der[1:]
+        self.assertFalse(self.checksig(z, forged_sec, forged_der))
+        self.assertTrue(self.checksig(z, sec, der))
+        self.assertEqual(len(SIG_CACHE), 1)
+        # same concatenation, different split : still a miss after the valid pair is cached
+        self.assertFalse(self.checksig(z, forged_sec, forged_der))
+        self.assertTrue(self.checksig(z, sec, der))
+        self.assertEqual(SIG_CACHE.hits, 1)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from io import BytesIO
+from unittest import TestCase
+
+from block import Block
+from ecc import G, N, Signature
+from helper import BufferReader, hash160, merkle_root
+from script import get_p2pkh_script_lock, script
+from Tx import Tx, TxInput, TxOutput
+
+# BIP143 native P2WPKH example : a legacy input and a segwit input
+SEGWIT_TX = bytes.fromhex('01000000000102fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f00000000494830450221008b9d1dc26ba6a9cb62127b02742fa9d754cd3bebf337f7a55d114c8e5cdd30be022040529b194ba3f9281a99f2b1c0a19c0489bc22ede944ccf4ecbab4cc618ef3ed01eeffffffef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac000247304402203609e17b84f6a7d30c80bfa610b5b4542f32a8a0d5447a12fb1366d7f01cc44a0220573a954c4518331561406f90300e8f3358f51928d43c212a8caed02de67eebee0121025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee635711000000')
+SEGWIT_TXID = 'e8151a2af31c368a35053ddd4bdb285a8595c769a3ad83e0fa02314a602d4609'
+
+SECRET = 8675309
+SEC = (SECRET * G).sec()
+SCRIPT_LOCK = get_p2pkh_script_lock(hash160(SEC))
+
+
+class Unseekable:
+    '''a stream with read only, like a socket file'''
+
+    def __init__(self, raw):
+        self.stream = BytesIO(raw)
+
+    def read(self, n):
+        return self.stream.read(n)
+
+
+def spend(prev_tx, prev_index, amount):
+    '''tx spending SCRIPT_LOCK at prev_tx:prev_index to SCRIPT_LOCK, signed with SECRET'''
+    tx = Tx(1, [TxInput(prev_tx, prev_index)], [TxOutput(amount, SCRIPT_LOCK)], 0)
+    z = tx.sig_hash(0, SCRIPT_LOCK)
+    k = 12345
+    r = (k * G).x.num
+    s = (z + r * SECRET) * pow(k, N - 2, N) % N
+    if s > N // 2:
+        s = N - s
+    tx.tx_ins[0].script_sig = script([Signature(r, s).der() + b'\x01', SEC])
+    return tx
+
+
+def mine(txs):
+    tx_hashes = [tx.hash() for tx in txs]
+    root = merkle_root([h[::-1] for h in tx_hashes])[::-1]
+    block = Block(1, bytes(32), root, 0, bytes.fromhex('ffff7f20'), bytes(4), tx_hashes, txs)
+    nonce = 0
+    while not block.check_pow():
+        nonce += 1
+        block.nonce = nonce.to_bytes(4, 'little')
+    return block
+
+
+class TxParseTest(TestCase):
+
+    def test_segwit(self):
+        for stream in (BytesIO(SEGWIT_TX), BufferReader(SEGWIT_TX)):
+            tx = Tx.parse(stream, keep_raw=isinstance(stream, BufferReader))
+            self.assertEqual(stream.tell(), len(SEGWIT_TX))
+            self.assertTrue(tx.is_segwit())
+            self.assertEqual(tx.id(), SEGWIT_TXID)
+            self.assertEqual(tx.locktime, 17)
+            self.assertEqual(tx.tx_ins[0].witness, [])
+            self.assertEqual(len(tx.tx_ins[1].witness), 2)
+            self.assertEqual(tx.serialize_segwit(), SEGWIT_TX)
+
+    def test_legacy(self):
+        legacy = Tx.parse(BytesIO(SEGWIT_TX)).serialize()
+        tx = Tx.parse(BytesIO(legacy))
+        self.assertFalse(tx.is_segwit())
+        self.assertIsNone(tx.tx_ins[0].witness)
+        self.assertEqual(tx.id(), SEGWIT_TXID)
+        self.assertEqual(tx.serialize_segwit(), legacy)
+
+    def test_unseekable(self):
+        legacy = Tx.parse(BytesIO(SEGWIT_TX)).serialize()
+        for raw in (SEGWIT_TX, legacy):
+            tx = Tx.parse(Unseekable(raw))
+            self.assertEqual(tx.id(), SEGWIT_TXID)
+            self.assertEqual(tx.serialize_segwit(), raw)
+
+    def test_unknown_flag(self):
+        with self.assertRaises(RuntimeError):
+            Tx.parse(BytesIO(SEGWIT_TX[:5] + b'\x02' + SEGWIT_TX[6:]))
+
+
+class OfflineValidationTest(TestCase):
+
+    def setUp(self):
+        self.funding = hash160(b'funding tx').rjust(32, b'\x00')
+        self.utxos = {(self.funding, 1): TxOutput(50000, SCRIPT_LOCK)}
+        coinbase = Tx(1, [TxInput(bytes(32), 0xffffffff, script([b'\x01']))], [TxOutput(5000000000, SCRIPT_LOCK)], 0)
+        self.first = spend(self.funding, 1, 40000)
+        # spends an output created earlier in the same block
+        self.second = spend(self.first.hash(), 0, 30000)
+        self.coinbase = coinbase
+
+    def test_verify_input(self):
+        self.assertTrue(self.first.verify_input(0, self.utxos))
+        self.assertTrue(self.first.verify_scripts(self.utxos))
+        self.assertFalse(self.first.verify_input(0, {}))
+        other = {(self.funding, 1): TxOutput(50000, get_p2pkh_script_lock(hash160(b'other')))}
+        self.assertFalse(self.first.verify_input(0, other))
+
+    def test_block(self):
+        block = mine([self.coinbase, self.first, self.second])
+        self.assertEqual(block.spent_outputs(self.utxos), [
+            self.utxos,
+            {(self.first.hash(), 0): self.first.tx_outs[0]},
+        ])
+        self.assertTrue(block.validate(utxos=self.utxos))
+        # unknown prevout : invalid, not fetched
+        self.assertFalse(block.validate(utxos={}))
+        # outputs of later txs are not spendable
+        block = mine([self.coinbase, self.second, self.first])
+        self.assertFalse(block.validate(utxos=self.utxos))